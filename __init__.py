@@ -0,0 +1,59 @@
+"""
+The Sonoff LAN Mode integration.
+
+Devices can be configured on the switch and sensor platforms in YAML, or
+added from the integrations page (see config_flow.py), in which case every
+device is a config entry of its own. Entries share the connection manager
+with each other and with YAML devices, and only ever open and close their
+own device's session, so adding, reconfiguring or removing a device never
+disturbs the connections to the rest of the fleet.
+
+For more details about this integration, please refer to the documentation
+at https://github.com/beveradb/sonoff-lan-mode-homeassistant
+"""
+DOMAIN = 'sonoff_lan_mode'
+
+# The switch platform goes first, so the device's session is opened with
+# the entry's transport and device key before the sensors attach to it
+PLATFORMS = ['switch', 'sensor']
+
+DATA_UPDATE_LISTENERS = 'sonoff_lan_mode_update_listeners'
+
+
+async def async_setup(hass, config):
+    """Set up the integration, which has nothing to do until entries load.
+
+    Home Assistant won't set up a component without this, even if it only
+    has config entries.
+    """
+    return True
+
+
+async def async_setup_entry(hass, entry):
+    """Set up a device added from the integrations page."""
+    for platform in PLATFORMS:
+        await hass.config_entries.async_forward_entry_setup(entry, platform)
+
+    # Changing the entry's options sets its device up again
+    hass.data.setdefault(DATA_UPDATE_LISTENERS, {})[entry.entry_id] = \
+        entry.add_update_listener(async_update_options)
+    return True
+
+
+async def async_unload_entry(hass, entry):
+    """Remove a device's entities, closing its session."""
+    remove_listener = hass.data.get(DATA_UPDATE_LISTENERS, {}).pop(
+        entry.entry_id, None)
+    if remove_listener is not None:
+        remove_listener()
+
+    unloaded = True
+    for platform in PLATFORMS:
+        unloaded &= await hass.config_entries.async_forward_entry_unload(
+            entry, platform)
+    return unloaded
+
+
+async def async_update_options(hass, entry):
+    """Reload a device once its options have been changed."""
+    await hass.config_entries.async_reload(entry.entry_id)
@@ -0,0 +1,115 @@
+"""
+Config flow for adding Sonoff LAN Mode devices from the integrations page.
+
+Every device is its own config entry, identified by its device id (or its
+host, for devices added without one), with how to reach it as the entry's
+data and everything else as options, which can be changed later without
+restarting Home Assistant.
+"""
+import homeassistant.helpers.config_validation as cv
+import voluptuous as vol
+from homeassistant import config_entries
+from homeassistant.const import (CONF_HOST, CONF_NAME,
+                                 CONF_MONITORED_CONDITIONS)
+from homeassistant.core import callback
+
+from . import DOMAIN
+from .connection import (DEFAULT_COMMAND_DEADLINE, DEFAULT_PING_INTERVAL,
+                         DEFAULT_PING_TIMEOUT, DEFAULT_UPDATE_RATE)
+from .sensor import SENSOR_TYPES, TELEMETRY_TYPES
+from .switch import (CONF_COMMAND_DEADLINE, CONF_COMMAND_WINDOW,
+                     CONF_CONFIRM_TIMEOUT, CONF_DEVICE_ID, CONF_DEVICE_KEY,
+                     CONF_MAX_UPDATE_RATE, CONF_OPTIMISTIC, CONF_OUTLETS,
+                     CONF_PING_INTERVAL, CONF_PING_TIMEOUT, CONF_TRANSPORT,
+                     DEFAULT_CONFIRM_TIMEOUT, DEFAULT_NAME, TRANSPORTS)
+
+USER_SCHEMA = vol.Schema({
+    vol.Required(CONF_NAME, default=DEFAULT_NAME): str,
+    vol.Optional(CONF_HOST): str,
+    vol.Optional(CONF_DEVICE_ID): str,
+    vol.Optional(CONF_OUTLETS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_DEVICE_KEY): str,
+})
+
+SENSOR_NAMES = {condition: name for condition, (name, _, _)
+                in list(SENSOR_TYPES.items()) + list(TELEMETRY_TYPES.items())}
+
+
+class SonoffLanModeConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
+    """Add a Sonoff LAN Mode device."""
+
+    VERSION = 1
+    CONNECTION_CLASS = config_entries.CONN_CLASS_LOCAL_PUSH
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        """Return the flow for changing a device's options."""
+        return SonoffLanModeOptionsFlow(config_entry)
+
+    async def async_step_user(self, user_input=None):
+        """Ask for the device's address or id, and its name."""
+        errors = {}
+        if user_input is not None:
+            if not user_input.get(CONF_HOST) and \
+                    not user_input.get(CONF_DEVICE_ID):
+                errors['base'] = 'host_or_device_id'
+            else:
+                await self.async_set_unique_id(
+                    user_input.get(CONF_DEVICE_ID) or user_input[CONF_HOST])
+                self._abort_if_unique_id_configured()
+                return self.async_create_entry(title=user_input[CONF_NAME],
+                                               data=user_input)
+
+        return self.async_show_form(step_id='user', data_schema=USER_SCHEMA,
+                                    errors=errors)
+
+
+class SonoffLanModeOptionsFlow(config_entries.OptionsFlow):
+    """Change how a Sonoff LAN Mode device is talked to, and its sensors."""
+
+    def __init__(self, config_entry):
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input=None):
+        """Show the device's options, starting from their current values."""
+        if user_input is not None:
+            return self.async_create_entry(title='', data=user_input)
+
+        options = self.config_entry.options
+        non_negative = vol.All(vol.Coerce(float), vol.Range(min=0))
+        schema = vol.Schema({
+            vol.Optional(CONF_TRANSPORT,
+                         default=options.get(CONF_TRANSPORT, 'auto')):
+                vol.In(TRANSPORTS),
+            vol.Optional(CONF_OPTIMISTIC,
+                         default=options.get(CONF_OPTIMISTIC, False)): bool,
+            vol.Optional(CONF_CONFIRM_TIMEOUT,
+                         default=options.get(CONF_CONFIRM_TIMEOUT,
+                                             DEFAULT_CONFIRM_TIMEOUT)):
+                non_negative,
+            vol.Optional(CONF_COMMAND_WINDOW,
+                         default=options.get(CONF_COMMAND_WINDOW, 0)):
+                non_negative,
+            vol.Optional(CONF_COMMAND_DEADLINE,
+                         default=options.get(CONF_COMMAND_DEADLINE,
+                                             DEFAULT_COMMAND_DEADLINE)):
+                non_negative,
+            vol.Optional(CONF_MAX_UPDATE_RATE,
+                         default=options.get(CONF_MAX_UPDATE_RATE,
+                                             DEFAULT_UPDATE_RATE)):
+                non_negative,
+            vol.Optional(CONF_PING_INTERVAL,
+                         default=options.get(CONF_PING_INTERVAL,
+                                             DEFAULT_PING_INTERVAL)):
+                vol.All(vol.Coerce(float), vol.Range(min=1)),
+            vol.Optional(CONF_PING_TIMEOUT,
+                         default=options.get(CONF_PING_TIMEOUT,
+                                             DEFAULT_PING_TIMEOUT)):
+                vol.All(vol.Coerce(float), vol.Range(min=0.5)),
+            vol.Optional(CONF_MONITORED_CONDITIONS,
+                         default=options.get(CONF_MONITORED_CONDITIONS, [])):
+                cv.multi_select(SENSOR_NAMES),
+        })
+
+        return self.async_show_form(step_id='init', data_schema=schema)
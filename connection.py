@@ -0,0 +1,1299 @@
+"""
+Shared connection management for Sonoff LAN Mode devices.
+
+A single SonoffConnectionManager is created per Home Assistant instance and
+owns one SonoffDeviceSession (connection) per device, identified by its
+device id where known, or otherwise by its host.
+Entities never talk to a session directly, instead they are handed a
+lightweight SonoffDeviceHandle which forwards commands to the session and is
+notified whenever the device announces a new state.
+
+Multi-outlet devices (e.g. 4-gang switches, which report a "switches" array
+rather than a single "switch" value) are modelled as one handle per outlet on
+the same session, so they cost one connection however many entities they
+are exposed as. Commands issued for several outlets in the same event loop
+iteration, or within the session's optional command window, are coalesced
+into a single update frame with the last command for each outlet winning.
+
+Every update frame carries a sequence number, which the device echoes back
+when it has applied the change; callers can wait for that confirmation (or
+an update showing the requested state) to measure round-trip latency.
+
+Commands issued while a device is reconnecting are held (one per outlet, so
+newer commands supersede older ones) and sent as soon as it is available
+again, and frames lost with a connection before being confirmed are queued
+to be sent again, in both cases until the session's command deadline.
+
+State updates from a device are passed on to its entities at no more than
+the session's update rate (a token bucket, so short bursts go straight
+through). Beyond that, updates are coalesced until the next token with the
+latest state winning, except that an outlet which switched and switched
+back in the meantime (e.g. a momentary input) is still reported in both
+states (once per wait: several excursions within the same wait are
+reported as one). Repeats of the last update frame are dropped undecoded. This
+keeps a device in a reboot loop or a flood of updates from swamping the
+event loop and the recorder.
+
+Power monitoring devices (e.g. the POW and S31) report power, voltage and
+current readings in their updates, which are downsampled into a ring
+buffer per reading (the min, max and mean per interval) for sensors to
+read at their own pace. Updates carrying nothing but readings don't wake
+the switches.
+
+The last known state of every device can be snapshotted (for persisting
+across restarts) and restored into new sessions, which then report that
+state as stale until the device confirms or contradicts it.
+
+The manager also keeps an index of device id -> address, fed by discovery,
+so a session follows its device to a new IP address (e.g. after a DHCP lease
+change) without anything being reconfigured.
+
+Sessions connect in the background: first attempts are spread over a short
+startup window (sessions opened after it connect straight away), at most
+max_connecting connection attempts are in flight at once, and each session
+backs off exponentially while its device is offline, so a large fleet with
+some devices unplugged doesn't stall startup.
+
+Keepalive pings for every session are driven from one timer wheel, so the
+event loop wakes up once per tick regardless of how many devices are
+configured, rather than once per device per ping interval.
+Each session may use its own ping interval, and waits for a pong for a few
+of its measured round trip times rather than a fixed timeout, so a device
+which has gone silent (e.g. been unplugged, which doesn't close the TCP
+connection) is reported unavailable within seconds on a healthy LAN.
+TCP keepalives are enabled on every connection as a backstop, and a failed
+write marks the device unavailable straight away.
+
+Sessions talk to devices through a transport (see transport.py): the
+original WebSocket protocol, or the HTTP API of DIY mode and v3 firmware,
+with state pushed over mDNS. Either can be forced per device, otherwise the
+WebSocket is tried first and HTTP used if the device doesn't speak it (or
+announces its state over mDNS), and the protocol found is remembered.
+Devices paired to an eWeLink account encrypt their HTTP API payloads and
+mDNS announcements (see encryption.py); sessions given the device's key
+go straight to HTTP, and decrypt with a cipher derived from the key once,
+when the manager first sees it, rather than for every message.
+
+This module deliberately has no Home Assistant imports so it can also be
+driven from the scripts in non-hass-scripts/.
+"""
+import asyncio
+import math
+import random
+import time
+
+import websockets.exceptions
+
+from .codec import UpdateEncoder, decode, encode_user_online
+from .encryption import DecryptionError, DeviceCipher
+from .stats import DeviceMetrics, DownsamplingBuffer
+from .transport import (
+    TRANSPORT_AUTO, TRANSPORT_HTTP, TRANSPORT_WEBSOCKET, HttpConnectionPool,
+    HttpError, HttpTransport, WebSocketTransport)
+
+DEFAULT_PORT = 8081
+DEFAULT_PING_INTERVAL = 30
+DEFAULT_PING_TIMEOUT = 5
+MIN_PING_TIMEOUT = 1
+DEFAULT_KEEPALIVE_TICK = 5
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+DEFAULT_MAX_CONNECTING = 20
+DEFAULT_STARTUP_JITTER = 2
+DEFAULT_COMMAND_DEADLINE = 10
+DEFAULT_UPDATE_RATE = 10
+RECENT_CONFIRMATIONS = 32
+
+SWITCH_STATE_ON = 'on'
+SWITCH_STATE_OFF = 'off'
+
+TELEMETRY_PARAMS = ('power', 'voltage', 'current')
+# Updates with only these params need only wake the outlets they mention
+PARTIAL_UPDATE_PARAMS = frozenset(('switch', 'switches') + TELEMETRY_PARAMS)
+
+
+def valid_switches(switches):
+    """Return the well formed outlet states of a "switches" param.
+
+    Entries without an outlet number and a state are skipped, rather than
+    trusted to be there.
+    """
+    if not isinstance(switches, list):
+        return []
+    return [switch for switch in switches
+            if isinstance(switch, dict) and
+            isinstance(switch.get('outlet'), int) and 'switch' in switch]
+
+
+class SonoffConnectionManager:
+    """Owns every device session and their shared keepalive timer wheel."""
+
+    def __init__(self, loop, logger, ping_interval=DEFAULT_PING_INTERVAL,
+                 ping_timeout=DEFAULT_PING_TIMEOUT,
+                 tick=DEFAULT_KEEPALIVE_TICK,
+                 max_connecting=DEFAULT_MAX_CONNECTING,
+                 startup_jitter=DEFAULT_STARTUP_JITTER):
+        self.loop = loop
+        self.logger = logger
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.tick = tick
+        self.startup_jitter = startup_jitter
+        self.connecting = asyncio.Semaphore(max_connecting)
+        self.pings_sent = 0
+        self.ticks = 0
+        self.addresses = {}
+        self.restored = {}
+        self.state_listener = None
+        self.http_listener = None
+        self.push_capable = set()
+        self.http_pool = HttpConnectionPool()
+        self.started = loop.time()
+        self.startup_complete = False
+
+        self._sessions = {}
+        self._devices = {}
+        self._ciphers = {}
+        self._wheel = [set() for _ in
+                       range(max(1, int(math.ceil(ping_interval / tick))))]
+        self._cursor = 0
+        self._next_slot = 0
+        self._timer = None
+
+    @property
+    def sessions(self):
+        """Return the currently open sessions, keyed by device id or host."""
+        return self._sessions
+
+    def async_get_handle(self, host, callback, outlet=None,
+                         command_window=None, deviceid=None,
+                         ping_interval=None, ping_timeout=None,
+                         command_deadline=None, update_rate=None,
+                         transport=None, devicekey=None):
+        """Return a handle onto the session for a device, opening it if needed.
+
+        Devices are identified by deviceid if given, in which case host is
+        only the initial address and may be None if discovery is expected to
+        find the device.
+
+        The callback is awaited with the handle as its only argument every
+        time the device announces a state change for the handle's outlet, or
+        the device's availability changes, unless it is None (e.g. for
+        entities which only poll the session's metrics). Pass an outlet index
+        for one channel of a multi-outlet device, or None for single-outlet
+        devices.
+
+        A command_window (in seconds) makes the session hold commands for
+        that long before sending, collapsing rapid bursts into one frame.
+
+        ping_interval and ping_timeout override the manager's defaults for
+        this device, e.g. to notice a critical device going offline sooner.
+        command_deadline is how long (in seconds) commands are held for, or
+        retried, while the device is unavailable.
+        update_rate limits how many state updates per second from the device
+        are passed on to callbacks, coalescing the rest (0 for no limit).
+        transport forces the protocol used to talk to the device, otherwise
+        it is detected.
+        devicekey is the API key of a device which encrypts its payloads;
+        EncryptionUnavailable is raised if cryptography isn't installed.
+        """
+        cipher = None
+        if devicekey is not None:
+            cipher = self._get_cipher(devicekey)
+
+        key = deviceid or host
+        session = self._sessions.get(key)
+
+        if session is None:
+            if deviceid is not None:
+                host = self.addresses.get(deviceid, host)
+            session = SonoffDeviceSession(self, host, deviceid=deviceid)
+            session.key = key
+            if key in self.restored:
+                session.restore(self.restored.pop(key))
+            self._sessions[key] = session
+            if session.deviceid is not None:
+                self._devices[session.deviceid] = session
+            self._wheel_add(session)
+            session.start()
+
+        if command_window is not None:
+            session.command_window = command_window
+        if ping_interval is not None:
+            session.ping_interval = ping_interval
+        if ping_timeout is not None:
+            session.ping_timeout = ping_timeout
+        if command_deadline is not None:
+            session.command_deadline = command_deadline
+        if update_rate is not None:
+            session.update_rate = update_rate
+        if transport is not None:
+            session.transport = transport
+        if cipher is not None:
+            session.cipher = cipher
+
+        return session.attach(callback, outlet)
+
+    def _get_cipher(self, devicekey):
+        """Return the cipher for a device key, deriving it only once."""
+        cipher = self._ciphers.get(devicekey)
+        if cipher is None:
+            cipher = self._ciphers[devicekey] = DeviceCipher(devicekey)
+        return cipher
+
+    async def async_release(self, session):
+        """Close a session once its last handle has been released."""
+        if self._sessions.get(session.key) is not session:
+            return
+
+        del self._sessions[session.key]
+        if self._devices.get(session.deviceid) is session:
+            del self._devices[session.deviceid]
+        self._wheel[session.wheel_slot].discard(session)
+
+        if not self._sessions and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        await session.async_stop()
+
+    async def async_stop(self):
+        """Close every session, e.g. when Home Assistant is shutting down."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Keep the final states around to be saved after shutdown
+        self.restored = self.snapshot()
+
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        self._devices.clear()
+        for slot in self._wheel:
+            slot.clear()
+
+        await asyncio.gather(*[session.async_stop() for session in sessions])
+        self.http_pool.close()
+
+    def session_available(self, session):
+        """Record a session becoming available for the first time.
+
+        The resulting debug log lines form a startup timeline, ending with
+        an info line once every configured device is available.
+        """
+        elapsed = self.loop.time() - self.started
+        session.first_available = elapsed
+        available = sum(1 for other in self._sessions.values()
+                        if other.first_available is not None)
+
+        self.logger.debug("Sonoff LAN Mode device %s available %.2fs after "
+                          "startup (%d/%d)", session.host, elapsed, available,
+                          len(self._sessions))
+
+        if available == len(self._sessions) and not self.startup_complete:
+            self.startup_complete = True
+            self.logger.info("All %d Sonoff LAN Mode devices available "
+                             "%.2fs after startup", available, elapsed)
+
+    def snapshot(self):
+        """Return the last known state of every device, for persisting.
+
+        Devices which were restored but haven't had a session opened this
+        time are kept too, so a device isn't forgotten just because its
+        entities failed to set up once.
+        """
+        devices = dict(self.restored)
+        for key, session in self._sessions.items():
+            if session.basic_info is not None:
+                devices[key] = session.snapshot()
+        return devices
+
+    def state_changed(self, session):
+        """Tell the state listener, if any, that a device's state changed."""
+        if self.state_listener is not None:
+            self.state_listener()
+
+    def http_detected(self, session):
+        """Tell the HTTP listener, if any, a session has switched to HTTP.
+
+        Such devices announce their state changes over mDNS, so whatever
+        discovers devices needs to be running for the session to hear them.
+        """
+        if self.http_listener is not None:
+            self.http_listener()
+
+    def index_device(self, session):
+        """Record which session talks to a device, once its id is known."""
+        self._devices.setdefault(session.deviceid, session)
+
+    async def async_set_address(self, deviceid, host):
+        """Update a device's address, moving its session if it has one."""
+        self.addresses[deviceid] = host
+
+        session = self._devices.get(deviceid)
+        if session is not None and session.host != host:
+            self.logger.info("Sonoff LAN Mode device %s moved from %s to %s",
+                             deviceid, session.host, host)
+            await session.async_set_host(host)
+
+    async def async_push_state(self, deviceid, params, iv=None):
+        """Pass on state a device announced over mDNS to its session.
+
+        Encrypted states are passed as the ciphertext and its iv.
+        """
+        self.push_capable.add(deviceid)
+
+        session = self._devices.get(deviceid)
+        if session is not None:
+            session.push_state(params, iv)
+
+    def _wheel_add(self, session):
+        """Spread new sessions evenly across the wheel's slots."""
+        session.wheel_slot = self._next_slot
+        self._wheel[self._next_slot].add(session)
+        self._next_slot = (self._next_slot + 1) % len(self._wheel)
+
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.tick, self._keepalive_tick)
+
+    def _wheel_schedule(self, session, delay):
+        """Move a session to the slot due roughly delay seconds from now.
+
+        Delays longer than one turn of the wheel are capped; the session is
+        just looked at early and put back, so any ping interval works.
+        """
+        ticks = max(1, min(int(math.ceil(delay / self.tick)),
+                           len(self._wheel)))
+        session.wheel_slot = (self._cursor + ticks) % len(self._wheel)
+        self._wheel[session.wheel_slot].add(session)
+
+    def _keepalive_tick(self):
+        """Advance the wheel by one slot and ping the idle sessions in it.
+
+        Any session which has received a frame since it was scheduled is
+        known to be alive already, so it is put back in the slot its ping
+        is now due in, and only idle sessions are pinged, all from a single
+        task.
+        """
+        self.ticks += 1
+        self._cursor = (self._cursor + 1) % len(self._wheel)
+        now = self.loop.time()
+
+        slot = self._wheel[self._cursor]
+        self._wheel[self._cursor] = set()
+        idle = []
+
+        for session in slot:
+            due = session.last_seen + session.ping_interval
+            if session.connected and now >= due - self.tick:
+                idle.append(session)
+                self._wheel_schedule(session, session.ping_interval)
+            elif session.connected:
+                self._wheel_schedule(session, due - now)
+            else:
+                self._wheel_schedule(session, session.ping_interval)
+
+        if idle:
+            self.pings_sent += len(idle)
+            self.loop.create_task(self._async_ping_all(idle))
+
+        self._timer = self.loop.call_later(self.tick, self._keepalive_tick)
+
+    async def _async_ping_all(self, sessions):
+        await asyncio.gather(*[session.async_ping() for session in sessions])
+
+
+class SonoffDeviceSession:
+    """A single connection to a device, shared by its entities.
+
+    The host may carry an explicit port ("192.168.0.72:8081"), which is
+    mostly useful for pointing sessions at the mock devices used in testing.
+    It may also be None for a device whose address has not been discovered
+    yet, in which case the session waits for async_set_host.
+    """
+
+    def __init__(self, manager, host, port=DEFAULT_PORT, deviceid=None):
+        self.manager = manager
+        self.key = host
+        self.host = host
+        self.port = port
+        self.deviceid = deviceid
+        self.basic_info = None
+        self.params = {}
+        self.outlets = {}
+        self.available = False
+        self.stale = False
+        self.last_seen = 0.0
+        self.metrics = DeviceMetrics(manager.loop.time())
+        self.first_available = None
+        self.connect_failures = 0
+        self.wheel_slot = None
+        self.ping_interval = manager.ping_interval
+        self.ping_timeout = manager.ping_timeout
+        self.command_window = 0
+        self.command_deadline = DEFAULT_COMMAND_DEADLINE
+        self.transport = TRANSPORT_AUTO
+        self.protocol = None
+        self.cipher = None
+        self.telemetry = {}
+        self.update_rate = DEFAULT_UPDATE_RATE
+        self.frames_malformed = 0
+
+        self._handles = []
+        self._transport = None
+        self._task = None
+        self._pending = {}
+        self._flush = None
+        self._flush_commands = False
+        self._ready = asyncio.Event()
+        self._last_sequence = 0
+        self._encoder = None
+        self._confirmations = {}
+        self._confirmed = {}
+        self._retrying = {}
+        self._srtt = None
+        self._rttvar = None
+        self._wakeup = asyncio.Event()
+        self._update_tokens = 0.0
+        self._update_stamp = 0.0
+        self._last_update = None
+        self._deferred = None
+        self._deferred_task = None
+        self._notified = {}
+        self._echoes = {}
+        self._edges = {}
+
+    @property
+    def connected(self):
+        return self._transport is not None
+
+    def snapshot(self):
+        """Return the device's last known state in a compact, JSON-able form.
+
+        The update frame's params are stored once, rather than both in
+        params and inside basic_info.
+        """
+        return {
+            'deviceid': self.deviceid,
+            'params': self.params,
+            'info': {key: value for key, value in self.basic_info.items()
+                     if key != 'params'},
+        }
+
+    def restore(self, snapshot):
+        """Start from a snapshot's state, marked stale until reconciled."""
+        if self.deviceid is None:
+            self.deviceid = snapshot.get('deviceid')
+        self.params = dict(snapshot['params'])
+        for switch in valid_switches(self.params.get('switches')):
+            self.outlets[switch['outlet']] = switch['switch']
+        self.basic_info = dict(snapshot['info'], params=self.params)
+        self.stale = True
+
+    def attach(self, callback, outlet=None):
+        handle = SonoffDeviceHandle(self, callback, outlet)
+        self._handles.append(handle)
+        return handle
+
+    async def async_detach(self, handle):
+        if handle in self._handles:
+            self._handles.remove(handle)
+
+        if not self._handles:
+            await self.manager.async_release(self)
+
+    def start(self):
+        if self._task is None:
+            self._task = self.manager.loop.create_task(self._async_run())
+
+    async def async_stop(self):
+        if self._deferred_task is not None:
+            self._deferred_task.cancel()
+            self._deferred_task = None
+        if self._flush is not None:
+            self._flush[1].cancel()
+            self._flush = None
+        self._pending.clear()
+        self._fail_confirmations()
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def async_set_host(self, host):
+        """Point the session at a new address and reconnect straight away."""
+        self.host = host
+        self._wakeup.set()
+
+        if self._transport is not None:
+            await self._transport.close()
+
+    @property
+    def pong_timeout(self):
+        """How long to wait for a pong before giving up on the device.
+
+        Like TCP's retransmission timeout this is the smoothed round trip
+        time plus four deviations, kept between MIN_PING_TIMEOUT and the
+        session's ping_timeout, which also applies until a pong has been
+        measured.
+        """
+        if self._srtt is None:
+            return self.ping_timeout
+        return min(self.ping_timeout,
+                   max(MIN_PING_TIMEOUT, self._srtt + 4 * self._rttvar))
+
+    def _record_rtt(self, rtt):
+        self.metrics.ping_rtt = rtt
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+    async def async_ping(self):
+        """Ping the device, dropping the connection if no pong arrives."""
+        transport = self._transport
+        if transport is None:
+            return
+
+        try:
+            sent = self.manager.loop.time()
+            pong_waiter = await transport.ping()
+            await asyncio.wait_for(pong_waiter, self.pong_timeout)
+            self.last_seen = self.manager.loop.time()
+            self._record_rtt(self.last_seen - sent)
+        except HttpError as ex:
+            self.manager.logger.warning(
+                "Sonoff LAN Mode device %s answered ping with an error, "
+                "reconnecting: %s", self.host, ex)
+            await self._async_connection_lost(transport)
+        except (OSError, asyncio.TimeoutError,
+                websockets.exceptions.WebSocketException):
+            self.manager.logger.warning(
+                "Sonoff LAN Mode device %s did not answer ping within "
+                "%.1fs, reconnecting", self.host, self.pong_timeout)
+            await self._async_connection_lost(transport)
+
+    def push_state(self, params, iv=None):
+        """Pass on state the device announced over mDNS.
+
+        Encrypted states (with an iv) are decrypted first, and dropped if
+        that isn't possible.
+        """
+        if not isinstance(self._transport, HttpTransport):
+            return
+
+        if iv is not None:
+            if self.cipher is None:
+                self.manager.logger.debug(
+                    "Sonoff LAN Mode device %s announced an encrypted state, "
+                    "but has no device key", self.host)
+                return
+            try:
+                params = self.cipher.decrypt(iv, params)
+            except DecryptionError as ex:
+                self.manager.logger.warning(
+                    "Sonoff LAN Mode device %s announced a state which "
+                    "couldn't be decrypted, check its device key: %s",
+                    self.host, ex)
+                return
+
+        self._transport.push(params)
+
+    async def _async_connection_lost(self, transport):
+        """Report the device unavailable now, then drop the connection.
+
+        A dead device never completes the closing handshake, so the listen
+        loop can take a while to notice; entities shouldn't wait for it.
+        """
+        if self._transport is transport:
+            self._transport = None
+        self._requeue_unconfirmed()
+        if self.available:
+            self.available = False
+            self._ready.clear()
+            await self._async_notify()
+        transport.abort()
+
+    def _next_sequence(self):
+        # Millisecond timestamps like the eWeLink app, kept strictly
+        # increasing so that coalesced frames never share a sequence.
+        sequence = max(int(time.time() * 1000), self._last_sequence + 1)
+        self._last_sequence = sequence
+        return str(sequence)
+
+    def _add_confirmation(self, sequence, expected=None, deadline=None):
+        """Track a frame until it is confirmed, failed or given up on.
+
+        Each entry is [future, expected, sent, deadline], where sent is the
+        time the frame was (last) sent and deadline the time after which
+        it is no longer retried.
+        """
+        now = self.manager.loop.time()
+        if deadline is None:
+            deadline = now + self.command_deadline
+        confirmation = [self.manager.loop.create_future(), expected or {},
+                        now, deadline]
+        self._confirmations[sequence] = confirmation
+        return confirmation
+
+    async def async_send_update(self, params, expected=None, sequence=None):
+        """Send an update frame to the device.
+
+        Returns the frame's sequence, which can be passed to
+        async_wait_confirmed, or None if the device is not connected. A
+        frame lost with the connection as it was sent is retried (see
+        _requeue_unconfirmed), and its sequence still returned.
+        The expected dict of outlet -> state lets a state update from the
+        device confirm the frame too, as not every firmware echoes sequences.
+        A sequence already being tracked (i.e. that of a queued command)
+        may be given, otherwise a new one is used.
+        """
+        transport = self._transport
+        if transport is None or self.deviceid is None:
+            self.manager.logger.warning(
+                "Sonoff LAN Mode device %s is not connected, dropping "
+                "command %s", self.host, params)
+            if sequence is not None:
+                self._expire(sequence)
+            return None
+
+        if self._encoder is None:
+            self._encoder = UpdateEncoder(self.deviceid)
+
+        if sequence is None:
+            sequence = self._next_sequence()
+            self._add_confirmation(sequence, expected)
+        else:
+            self._confirmations[sequence][2] = self.manager.loop.time()
+        future = self._confirmations[sequence][0]
+        self._echoes.update(self._confirmations[sequence][1])
+
+        try:
+            await self._async_send(transport,
+                                   self._encoder.encode(params, sequence))
+        except (OSError, websockets.exceptions.ConnectionClosed) as ex:
+            retried = not future.done()
+            self.manager.logger.warning(
+                "Sonoff LAN Mode device %s connection lost sending "
+                "command %s, %s: %s", self.host, params,
+                'will retry' if retried else 'dropping it', ex)
+            return sequence if retried else None
+        return sequence
+
+    async def _async_send(self, transport, message):
+        """Send a frame, marking the device unavailable if that fails."""
+        try:
+            await transport.send(message)
+        except (OSError, websockets.exceptions.ConnectionClosed):
+            await self._async_connection_lost(transport)
+            raise
+        self.metrics.messages_out += 1
+        self.metrics.bytes_out += len(message)
+
+    async def async_wait_confirmed(self, sequence, timeout):
+        """Wait for the device to confirm a frame, returning True if it did.
+
+        Unconfirmed frames are forgotten once the timeout has expired.
+        A frame being retried is confirmed along with its retry.
+        """
+        if sequence in self._confirmations:
+            future, pending = self._confirmations[sequence][0], sequence
+        elif sequence in self._retrying:
+            future, pending = self._retrying[sequence]
+        else:
+            # The reply may have beaten the caller here (e.g. over HTTP)
+            return self._confirmed.get(sequence, False)
+
+        # Commands held for a reconnect get the full timeout once sent
+        if self._flush is not None and self._flush[0] == pending:
+            await asyncio.shield(self._flush[1])
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self._confirmations.pop(sequence, None)
+            return False
+
+    def _resolve_confirmations(self, sequence=None, error=0):
+        """Resolve confirmations by echoed sequence, or by matching state."""
+        now = self.manager.loop.time()
+
+        if sequence is not None:
+            if sequence in self._confirmations:
+                future, _, sent, _ = self._confirmations.pop(sequence)
+                if not future.done():
+                    self.metrics.command_latency.add(now - sent)
+                    future.set_result(error == 0)
+                    self._remember_confirmed(sequence, error == 0)
+            return
+
+        for sequence, (future, expected, sent, _) in list(
+                self._confirmations.items()):
+            if self._flush is not None and self._flush[0] == sequence:
+                continue  # Not sent yet
+            if expected and all(self.get_switch(outlet) == state
+                                for outlet, state in expected.items()):
+                del self._confirmations[sequence]
+                if not future.done():
+                    self.metrics.command_latency.add(now - sent)
+                    future.set_result(True)
+                    self._remember_confirmed(sequence, True)
+
+    def _retried(self, sequence, future):
+        self._retrying.pop(sequence, None)
+        if not future.cancelled():
+            self._remember_confirmed(sequence, future.result())
+
+    def _remember_confirmed(self, sequence, confirmed):
+        self._confirmed[sequence] = confirmed
+        if len(self._confirmed) > RECENT_CONFIRMATIONS:
+            del self._confirmed[next(iter(self._confirmed))]
+
+    def _fail_confirmations(self):
+        for future, _, _, _ in self._confirmations.values():
+            if not future.done():
+                future.set_result(False)
+        self._confirmations.clear()
+
+    def _expire(self, sequence):
+        confirmation = self._confirmations.pop(sequence, None)
+        if confirmation is not None and not confirmation[0].done():
+            confirmation[0].set_result(False)
+
+    def _requeue_unconfirmed(self):
+        """Queue the commands of frames lost with the connection to resend.
+
+        Each command is retried until its deadline, unless a newer command
+        for the same outlet has superseded it in the meantime, and the
+        original frame's confirmation follows the retry's.
+        """
+        now = self.manager.loop.time()
+
+        for sequence, (future, expected, _, deadline) in list(
+                self._confirmations.items()):
+            if self._flush is not None and self._flush[0] == sequence:
+                continue  # Not sent yet
+            del self._confirmations[sequence]
+            if future.done():
+                continue
+
+            retry = {outlet: state for outlet, state in expected.items()
+                     if outlet not in self._pending}
+            if not retry or now >= deadline:
+                self.metrics.commands_expired += len(retry)
+                future.set_result(False)
+                continue
+
+            self.metrics.commands_retried += len(retry)
+            self._pending.update(retry)
+            retry_sequence = self._schedule_flush(deadline)
+            confirmation = self._confirmations[retry_sequence]
+            confirmation[1].update(retry)
+            confirmation[0].add_done_callback(
+                lambda retried, future=future: future.done() or
+                future.set_result(retried.result()))
+            self._retrying[sequence] = (future, retry_sequence)
+            future.add_done_callback(
+                lambda done, sequence=sequence: self._retried(sequence, done))
+
+        self.metrics.queue_depth = len(self._pending)
+
+    def get_switch(self, outlet):
+        if outlet is None:
+            return self.params.get('switch')
+        return self.outlets.get(outlet)
+
+    async def async_set_switch(self, outlet, state):
+        """Switch one outlet (or the only one, if None) on or off.
+
+        The change is queued and sent by a flush task which runs once every
+        caller in the current event loop iteration (or command window) has
+        queued its change, so switching all four channels of a 4-gang device
+        costs one frame, and a burst of toggles only sends the final state.
+
+        Returns the sequence of the frame the change is sent in. While the
+        device is unavailable the change is held until it is back (or the
+        command deadline passes), and the sequence is returned straight
+        away, so callers can still wait for the change to be confirmed.
+        """
+        self.metrics.commands_queued += 1
+        if outlet in self._pending:
+            self.metrics.commands_superseded += 1
+        self._pending[outlet] = state
+        self.metrics.queue_depth = len(self._pending)
+
+        sequence = self._schedule_flush()
+        self._flush_commands = True
+        self._confirmations[sequence][1][outlet] = state
+
+        if not self.available:
+            return sequence
+        return await asyncio.shield(self._flush[1])
+
+    def _schedule_flush(self, deadline=None):
+        """Start a flush task for the queued commands, if there isn't one.
+
+        The flush's frame sequence is chosen up front, so it can be waited
+        on before the frame is sent. It is given up on once the latest
+        deadline of the commands in it has passed.
+        """
+        if self._flush is None:
+            sequence = self._next_sequence()
+            self._add_confirmation(sequence, deadline=deadline)
+            self._flush = (sequence, self.manager.loop.create_task(
+                self._async_flush(sequence)))
+        elif deadline is not None:
+            confirmation = self._confirmations[self._flush[0]]
+            confirmation[3] = max(confirmation[3], deadline)
+
+        return self._flush[0]
+
+    async def _async_flush(self, sequence):
+        if self.command_window:
+            await asyncio.sleep(self.command_window)
+
+        loop = self.manager.loop
+        confirmation = self._confirmations[sequence]
+        while not self.available:
+            try:
+                await asyncio.wait_for(self._ready.wait(),
+                                       confirmation[3] - loop.time())
+            except asyncio.TimeoutError:
+                self.manager.logger.warning(
+                    "Sonoff LAN Mode device %s is not available, dropping "
+                    "command %s", self.host, self._pending)
+                self.metrics.commands_expired += len(self._pending)
+                self._pending = {}
+                self.metrics.queue_depth = 0
+                self._flush = None
+                self._flush_commands = False
+                self._expire(sequence)
+                return None
+
+        pending, self._pending = self._pending, {}
+        self._flush = None
+        self.metrics.queue_depth = 0
+        # Frames only resending commands lost with a connection are counted
+        # apart, so command_frames against commands_queued shows what
+        # coalescing saved
+        if self._flush_commands:
+            self.metrics.command_frames += 1
+        else:
+            self.metrics.retry_frames += 1
+        self._flush_commands = False
+        self.metrics.command_age.add(loop.time() - confirmation[2])
+
+        params = {}
+        if None in pending:
+            params['switch'] = pending.pop(None)
+
+        if pending:
+            switches = dict(self.outlets)
+            switches.update(pending)
+            params['switches'] = [{'switch': state, 'outlet': outlet}
+                                  for outlet, state in sorted(switches.items())]
+
+        return await self.async_send_update(params, sequence=sequence)
+
+    async def _async_run(self):
+        logger = self.manager.logger
+
+        # Don't let every configured device connect in the same instant.
+        # Devices added once the manager is up (e.g. a config entry being
+        # reloaded) connect straight away, as they're added one at a time.
+        jitter = self.manager.startup_jitter - \
+            (self.manager.loop.time() - self.manager.started)
+        if jitter > 0:
+            await asyncio.sleep(random.uniform(0, jitter))
+
+        while True:
+            self._wakeup.clear()
+            if self.host is None:
+                await self._wakeup.wait()
+                continue
+
+            try:
+                await self._async_connect_and_listen()
+            except HttpError as ex:
+                # e.g. a wrong device key, which retrying won't fix, so it
+                # shouldn't only show up in debug logs
+                if self.connect_failures:
+                    logger.debug("Sonoff LAN Mode device %s connection "
+                                 "lost: %s", self.host, ex)
+                else:
+                    logger.warning("Sonoff LAN Mode device %s refused the "
+                                   "connection: %s", self.host, ex)
+            except (OSError, asyncio.TimeoutError,
+                    websockets.exceptions.WebSocketException) as ex:
+                logger.debug("Sonoff LAN Mode device %s connection lost: "
+                             "%s", self.host, ex)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                # Whatever went wrong, the session must not die with it;
+                # the device is reconnected to like any other failure.
+                logger.exception("Error talking to Sonoff LAN Mode device "
+                                 "%s, reconnecting", self.host)
+
+            self._requeue_unconfirmed()
+            self.connect_failures += 1
+
+            if self.available or self.stale:
+                # Restored state can't be trusted once the device has
+                # turned out to be unreachable.
+                self.available = False
+                self.stale = False
+                self._ready.clear()
+                await self._async_notify()
+
+            # Reconnect early if the device has been seen at a new address
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.reconnect_delay)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def reconnect_delay(self):
+        """Exponential backoff, with jitter, while the device is offline."""
+        delay = min(RECONNECT_MIN_DELAY * 2 ** (self.connect_failures - 1),
+                    RECONNECT_MAX_DELAY)
+        return delay * random.uniform(0.75, 1.25)
+
+    async def _async_open_transport(self):
+        """Connect to the device with the configured or detected protocol.
+
+        When detecting, a device which turns down the WebSocket handshake
+        (or has announced its state over mDNS, or has a device key) is tried
+        over HTTP, and the protocol which worked is used from then on.
+        """
+        host, _, port = self.host.partition(':')
+        port = int(port) if port else self.port
+        protocol = self.protocol or self.transport
+        if protocol == TRANSPORT_AUTO and (
+                self.cipher is not None or
+                self.deviceid in self.manager.push_capable):
+            protocol = TRANSPORT_HTTP
+
+        if protocol != TRANSPORT_HTTP:
+            transport = WebSocketTransport(host, port)
+            try:
+                await transport.connect()
+                self.protocol = TRANSPORT_WEBSOCKET
+                return transport
+            except websockets.exceptions.InvalidHandshake:
+                if protocol != TRANSPORT_AUTO:
+                    raise
+                self.manager.logger.debug(
+                    "Sonoff LAN Mode device %s doesn't speak WebSocket, "
+                    "trying HTTP", self.host)
+
+        transport = HttpTransport(host, port, self.manager.http_pool,
+                                  self.deviceid, self.cipher)
+        await transport.connect()
+        if self.protocol != TRANSPORT_HTTP:
+            self.protocol = TRANSPORT_HTTP
+            self.manager.http_detected(self)
+        return transport
+
+    async def _async_connect_and_listen(self):
+        async with self.manager.connecting:
+            transport = await self._async_open_transport()
+
+        metrics = self.metrics
+        self.connect_failures = 0
+        self._transport = transport
+        self.last_seen = self.manager.loop.time()
+        metrics.connected(self.last_seen)
+        metrics.transport = transport.name
+        try:
+            await self._async_send(transport, encode_user_online())
+
+            while True:
+                message = await transport.recv()
+                if self._transport is not transport:
+                    break  # Given up on by _async_connection_lost
+                self.last_seen = self.manager.loop.time()
+                metrics.messages_in += 1
+                metrics.bytes_in += len(message)
+                metrics.last_message = self.last_seen
+                await self._async_handle_message(message)
+        finally:
+            self._transport = None
+            metrics.disconnected(self.manager.loop.time())
+            await transport.close()
+
+    async def _async_handle_message(self, message):
+        if self._deferred is not None and message == self._last_update:
+            # Nothing new, and the device is already being rate limited
+            self.metrics.frames_dropped += 1
+            return
+
+        try:
+            data = decode(message)
+        except ValueError as ex:
+            self._drop_malformed(message, ex)
+            return
+        if not isinstance(data, dict) or \
+                not isinstance(data.get('params', {}), dict):
+            self._drop_malformed(message, 'not a JSON object')
+            return
+
+        if self.deviceid is None and 'deviceid' in data:
+            self.deviceid = data['deviceid']
+            self.manager.index_device(self)
+
+        if 'action' not in data and 'sequence' in data:
+            self._resolve_confirmations(data['sequence'],
+                                        data.get('error', 0))
+
+        if data.get('action') == 'update' and 'params' in data:
+            self._last_update = message
+            params = data['params']
+            changed = None
+            was_available = self.available
+
+            for key in TELEMETRY_PARAMS:
+                if key in params:
+                    self._record_telemetry(key, params[key])
+
+            # Only wake the entities whose outlet was actually mentioned,
+            # unless this is the first update or carries other params.
+            if self.available and set(params) <= PARTIAL_UPDATE_PARAMS:
+                changed = set()
+                if 'switch' in params:
+                    changed.add(None)
+
+            for switch in valid_switches(params.get('switches')):
+                self.outlets[switch['outlet']] = switch['switch']
+                if changed is not None:
+                    changed.add(switch['outlet'])
+
+            self.params.update(params)
+            if self.outlets:
+                self.params['switches'] = [
+                    {'switch': state, 'outlet': outlet}
+                    for outlet, state in sorted(self.outlets.items())]
+
+            self.basic_info = data
+            if self.first_available is None:
+                self.manager.session_available(self)
+            self.available = True
+            self.stale = False
+            self._ready.set()
+            if self._confirmations:
+                self._resolve_confirmations()
+            if changed is not None and not changed:
+                return  # Only readings, which sensors poll for
+            self.manager.state_changed(self)
+            if was_available and not self._is_echo(changed):
+                await self._async_notify_update(changed)
+            else:
+                await self._async_notify(changed)
+
+    def _drop_malformed(self, message, reason):
+        """Log a frame which can't be understood, and carry on without it.
+
+        Only the first one is a warning, so a device sending garbage can't
+        flood the log.
+        """
+        log = self.manager.logger.debug if self.frames_malformed else \
+            self.manager.logger.warning
+        self.frames_malformed += 1
+        log("Sonoff LAN Mode device %s sent a malformed frame, dropping it "
+            "(%s): %.200r", self.host, reason, message)
+
+    def _record_telemetry(self, key, value):
+        """Add a power, voltage or current reading to its buffer."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+
+        buffer = self.telemetry.get(key)
+        if buffer is None:
+            buffer = self.telemetry[key] = DownsamplingBuffer()
+        buffer.add(value, self.manager.loop.time())
+
+    def _is_echo(self, outlets):
+        """Return True for the device reporting a state it was sent.
+
+        Such updates confirm a command, so they are never rate limited.
+        Each sent state only lets one update through.
+        """
+        if not outlets or not self._echoes:
+            return False
+        if any(outlet not in self._echoes or
+               self._echoes[outlet] != self.get_switch(outlet)
+               for outlet in outlets):
+            return False
+        for outlet in outlets:
+            del self._echoes[outlet]
+        return True
+
+    async def _async_notify_update(self, outlets=None):
+        """Pass a state update on to the handles, unless rate limited."""
+        if outlets is None:
+            outlets = {handle.outlet for handle in self._handles}
+
+        if self._deferred is None and self._take_update_token():
+            await self._async_notify(outlets)
+            return
+
+        if self._deferred is None:
+            self._deferred = set()
+            self._deferred_task = self.manager.loop.create_task(
+                self._async_notify_deferred())
+        else:
+            self.metrics.updates_coalesced += 1
+        self._deferred |= outlets
+
+        # Remember any state the handles haven't seen, in case the outlet
+        # is back to its last reported state by the time they're notified.
+        for outlet in outlets:
+            state = self.get_switch(outlet)
+            if state != self._notified.get(outlet):
+                self._edges[outlet] = state
+
+    def _take_update_token(self):
+        if not self.update_rate:
+            return True
+
+        now = self.manager.loop.time()
+        self._update_tokens = min(
+            self.update_rate, self._update_tokens +
+            (now - self._update_stamp) * self.update_rate)
+        self._update_stamp = now
+        if self._update_tokens < 1:
+            return False
+        self._update_tokens -= 1
+        return True
+
+    async def _async_notify_deferred(self):
+        await asyncio.sleep((1 - self._update_tokens) / self.update_rate)
+        self._take_update_token()
+
+        outlets, self._deferred = self._deferred, None
+        self._deferred_task = None
+        edges, self._edges = self._edges, {}
+
+        replay = {outlet: state for outlet, state in edges.items()
+                  if outlet in outlets and
+                  self.get_switch(outlet) == self._notified.get(outlet)}
+        if replay:
+            await self._async_notify(set(replay), replay)
+            # Let the state writes scheduled for the edge run first
+            await asyncio.sleep(0)
+        await self._async_notify(outlets)
+
+    async def _async_notify(self, outlets=None, edges=None):
+        """Await the callbacks of the handles for the given outlets.
+
+        edges maps outlets to a state their handles should report while
+        their callbacks run, in place of the current one (an edge the
+        outlet has already switched back from); nothing else sees it.
+        """
+        for handle in list(self._handles):
+            if handle.callback is None or \
+                    outlets is not None and handle.outlet not in outlets:
+                continue
+            if edges is not None:
+                handle.edge = edges[handle.outlet]
+            self._notified[handle.outlet] = handle.state
+            try:
+                await handle.callback(handle)
+            except Exception:  # pylint: disable=broad-except
+                self.manager.logger.exception(
+                    "Error in Sonoff LAN Mode update callback for %s",
+                    self.host)
+            finally:
+                handle.edge = None
+
+
+class SonoffDeviceHandle:
+    """Per-entity view onto a shared SonoffDeviceSession."""
+
+    __slots__ = ('session', 'callback', 'outlet', 'polled', 'edge')
+
+    SWITCH_STATE_ON = SWITCH_STATE_ON
+    SWITCH_STATE_OFF = SWITCH_STATE_OFF
+
+    def __init__(self, session, callback, outlet=None):
+        self.session = session
+        self.callback = callback
+        self.outlet = outlet
+        self.polled = None
+        self.edge = None
+
+    @property
+    def available(self):
+        return self.session.available
+
+    @property
+    def basic_info(self):
+        return self.session.basic_info
+
+    @property
+    def stale(self):
+        """Return True while the state is restored rather than reported."""
+        return self.session.stale
+
+    @property
+    def state(self):
+        if self.edge is not None:
+            return self.edge
+        return self.session.get_switch(self.outlet)
+
+    @property
+    def metrics(self):
+        return self.session.metrics
+
+    def metrics_attributes(self):
+        """Return the session's health metrics as state attributes."""
+        return self.session.metrics.as_attributes(
+            self.session.manager.loop.time())
+
+    def telemetry(self, key, window):
+        """Summarise the device's power, voltage or current readings.
+
+        Returns (min, max, mean, count) of the readings since this handle
+        last asked (or over the last window seconds, the first time). If
+        there were none, the latest reading is returned with a count of 0
+        as long as it arrived within the window, otherwise None, as it
+        is for a device which has never reported the reading.
+        """
+        buffer = self.session.telemetry.get(key)
+        if buffer is None:
+            return None
+
+        now = self.session.manager.loop.time()
+        summary = buffer.summary(now, window, self.polled)
+        self.polled = now
+        if summary is None:
+            if now - buffer.last_time > max(window, buffer.interval):
+                return None  # The device has gone quiet
+            return buffer.last, buffer.last, buffer.last, 0
+        return summary
+
+    async def turn_on(self):
+        """Switch on, returning the sequence of the frame which was sent."""
+        return await self.session.async_set_switch(self.outlet,
+                                                   SWITCH_STATE_ON)
+
+    async def turn_off(self):
+        """Switch off, returning the sequence of the frame which was sent."""
+        return await self.session.async_set_switch(self.outlet,
+                                                   SWITCH_STATE_OFF)
+
+    async def async_wait_confirmed(self, sequence, timeout):
+        return await self.session.async_wait_confirmed(sequence, timeout)
+
+    async def async_close(self):
+        """Release this handle, closing the session if it was the last."""
+        await self.session.async_detach(self)
@@ -0,0 +1,138 @@
+"""
+Zeroconf / mDNS discovery of Sonoff LAN Mode devices.
+
+Devices in LAN mode announce themselves as "_ewelink._tcp" services, with
+their device id in the "id" TXT record. SonoffDiscovery browses for these
+announcements and feeds every (device id, address) pair it sees into the
+connection manager's address index, so that sessions follow their devices
+to new IP addresses as soon as they re-announce themselves.
+
+Devices running DIY mode or v3 firmware also announce their state in the
+"data1" (to "data4", for long states) TXT records, with a "seq" record
+which increases with every change, and re-announce on every change; that
+state is pushed to their sessions, as those devices have no WebSocket to
+report it over. Devices paired to an eWeLink account encrypt that state,
+in which case it is passed on still encrypted, with the "iv" record, for
+the device's session to decrypt with its key.
+
+Like connection.py, this module has no Home Assistant imports.
+"""
+from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
+
+from .codec import decode
+from .connection import DEFAULT_PORT
+
+EWELINK_SERVICE_TYPE = '_ewelink._tcp.local.'
+SERVICE_INFO_TIMEOUT = 3000  # milliseconds
+
+
+def parse_service_info(info):
+    """Return (deviceid, host) from an _ewelink._tcp ServiceInfo."""
+    properties = info.properties or {}
+    deviceid = properties.get(b'id')
+    addresses = info.parsed_addresses()
+
+    if not deviceid or not addresses:
+        return None, None
+
+    host = addresses[0]
+    if info.port and info.port != DEFAULT_PORT:
+        host = '%s:%d' % (host, info.port)
+
+    return deviceid.decode('utf-8'), host
+
+
+def parse_push_state(info):
+    """Return (seq, params, iv) announced in an _ewelink._tcp ServiceInfo.
+
+    For encrypted states params is the base64 ciphertext, and iv its
+    initialisation vector; otherwise iv is None. Returns
+    (None, None, None) if the service doesn't carry a readable state.
+    """
+    properties = info.properties or {}
+    data = b''.join(properties.get(b'data%d' % index) or b''
+                    for index in range(1, 5))
+    if not data:
+        return None, None, None
+
+    if properties.get(b'encrypt', b'').lower() == b'true':
+        iv = properties.get(b'iv')
+        if not iv:
+            return None, None, None
+        return (properties.get(b'seq'), data.decode('ascii', 'replace'),
+                iv.decode('ascii', 'replace'))
+
+    try:
+        params = decode(data)
+    except ValueError:
+        return None, None, None
+    if not isinstance(params, dict):
+        return None, None, None
+
+    return properties.get(b'seq'), params, None
+
+
+class SonoffDiscovery:
+    """Browses for LAN Mode devices and updates the manager's addresses.
+
+    Zeroconf calls back from its own thread; address changes are handed over
+    to the manager on the event loop.
+    """
+
+    def __init__(self, manager, zeroconf=None):
+        self.manager = manager
+        self.announcements = 0
+
+        self.pushes = 0
+
+        self._zeroconf = zeroconf
+        self._owns_zeroconf = zeroconf is None
+        self._browser = None
+        self._push_seqs = {}
+
+    def start(self):
+        """Start browsing. Does blocking socket setup, so use an executor."""
+        if self._zeroconf is None:
+            self._zeroconf = Zeroconf()
+
+        self._browser = ServiceBrowser(self._zeroconf, EWELINK_SERVICE_TYPE,
+                                       handlers=[self._on_service_change])
+
+    def stop(self):
+        """Stop browsing. Blocking, like start."""
+        if self._browser is not None:
+            self._browser.cancel()
+            self._browser = None
+
+        if self._owns_zeroconf and self._zeroconf is not None:
+            self._zeroconf.close()
+            self._zeroconf = None
+
+    def _on_service_change(self, zeroconf, service_type, name, state_change):
+        if state_change is ServiceStateChange.Removed:
+            return
+
+        info = zeroconf.get_service_info(service_type, name,
+                                         SERVICE_INFO_TIMEOUT)
+        if info is None:
+            return
+
+        deviceid, host = parse_service_info(info)
+        if deviceid is None:
+            return
+
+        self.announcements += 1
+        self.manager.loop.call_soon_threadsafe(
+            self.manager.loop.create_task,
+            self.manager.async_set_address(deviceid, host))
+
+        seq, params, iv = parse_push_state(info)
+        if params is None or \
+                seq is not None and self._push_seqs.get(deviceid) == seq:
+            return
+
+        self._push_seqs[deviceid] = seq
+        self.pushes += 1
+        self.manager.loop.call_soon_threadsafe(
+            self.manager.loop.create_task,
+            self.manager.async_push_state(deviceid, params, iv))
@@ -0,0 +1,83 @@
+"""
+Payload encryption for Sonoff devices paired to an eWeLink account.
+
+Devices running v3 firmware which aren't in DIY mode encrypt the "data" of
+their HTTP API requests, responses and mDNS state announcements with
+AES-128-CBC, keyed with the MD5 digest of the device's API key (its
+"devicekey", as shown by the eWeLink app or returned when pairing). Every
+message carries its own random IV, base64 encoded alongside the base64
+encoded ciphertext, and the plaintext is PKCS#7 padded JSON.
+
+Deriving the key and setting up the AES algorithm is done once, when a
+DeviceCipher is created for a session, rather than for every message.
+
+Encryption needs the cryptography package (which Home Assistant itself
+depends on); it is only imported when a device key is configured, and
+DeviceCipher raises EncryptionUnavailable if it is missing.
+
+Like connection.py, this module has no Home Assistant imports.
+"""
+import base64
+import hashlib
+import os
+
+from .codec import decode, dumps
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes)
+except ImportError:
+    Cipher = None
+
+BLOCK_SIZE = 16
+
+
+class EncryptionUnavailable(RuntimeError):
+    """A device key was configured, but cryptography isn't installed."""
+
+
+class DecryptionError(ValueError):
+    """A payload couldn't be decrypted, most likely with the wrong key."""
+
+
+def derive_key(devicekey):
+    """Return the AES key for a device's API key."""
+    return hashlib.md5(devicekey.encode('utf-8')).digest()
+
+
+class DeviceCipher:
+    """Encrypts and decrypts the payloads of one device."""
+
+    def __init__(self, devicekey):
+        if Cipher is None:
+            raise EncryptionUnavailable(
+                "Encrypted LAN mode needs the cryptography package")
+
+        self.devicekey = devicekey
+        self._algorithm = algorithms.AES(derive_key(devicekey))
+
+    def encrypt(self, data):
+        """Return (iv, ciphertext), both base64 encoded, for a JSON object."""
+        iv = os.urandom(BLOCK_SIZE)
+        padder = padding.PKCS7(BLOCK_SIZE * 8).padder()
+        plaintext = padder.update(dumps(data).encode('utf-8')) + \
+            padder.finalize()
+
+        encryptor = Cipher(self._algorithm, modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        return (base64.b64encode(iv).decode('ascii'),
+                base64.b64encode(ciphertext).decode('ascii'))
+
+    def decrypt(self, iv, ciphertext):
+        """Return the JSON object in a base64 encoded ciphertext."""
+        try:
+            decryptor = Cipher(self._algorithm,
+                               modes.CBC(base64.b64decode(iv))).decryptor()
+            plaintext = decryptor.update(base64.b64decode(ciphertext)) + \
+                decryptor.finalize()
+
+            unpadder = padding.PKCS7(BLOCK_SIZE * 8).unpadder()
+            return decode(unpadder.update(plaintext) + unpadder.finalize())
+        except ValueError as ex:
+            raise DecryptionError(str(ex)) from ex
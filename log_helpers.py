@@ -0,0 +1,58 @@
+"""
+Logging helpers for the Sonoff LAN Mode platform.
+
+Per-message diagnostics are useful when investigating a single device, but
+with a large fleet they can flood the log (and cost formatting time) when a
+device becomes chatty, so they go through a RateLimitedLogger.
+"""
+import logging
+import time
+
+DEFAULT_DIAGNOSTICS_PER_MINUTE = 10
+
+
+class RateLimitedLogger:
+    """Logger wrapper which emits at most per_minute messages a minute.
+
+    Messages are only formatted if they are actually emitted, and the number
+    of suppressed messages is logged once the next minute starts. A limit of
+    0 disables rate limiting.
+    """
+
+    __slots__ = ('logger', 'per_minute', '_window_start', '_emitted',
+                 '_suppressed')
+
+    def __init__(self, logger, per_minute=DEFAULT_DIAGNOSTICS_PER_MINUTE):
+        self.logger = logger
+        self.per_minute = per_minute
+        self._window_start = 0.0
+        self._emitted = 0
+        self._suppressed = 0
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        if self.per_minute:
+            now = time.monotonic()
+            if now - self._window_start >= 60:
+                if self._suppressed:
+                    self.logger.log(level, "%d similar messages suppressed "
+                                           "in the last minute",
+                                    self._suppressed)
+                self._window_start = now
+                self._emitted = 0
+                self._suppressed = 0
+
+            if self._emitted >= self.per_minute:
+                self._suppressed += 1
+                return
+            self._emitted += 1
+
+        self.logger.log(level, msg, *args)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# This script measures how long a whole-house scene takes to apply, switching
+# every device one after another vs. with the `sonoff_lan_mode.bulk_set`
+# service, which sends up to --max-concurrent commands at once.
+# When executed (e.g. from a terminal with
+# `python bench_bulk_set.py --devices 20 --latency 0.05`), it will start a
+# fleet of mock devices (with the given response latency) in a background
+# thread, set up the real switch platform (on the minimal Home Assistant
+# stand-in in `hass_standin.py`) with one entity per device, then repeatedly
+# switch them all on and off both ways and report the time until every
+# device had confirmed, plus the per-device latencies reported by bulk_set.
+
+import argparse
+import asyncio
+import time
+
+import hass_standin
+import component
+from measure import percentile
+from mock_fleet import MockFleet
+
+hass_standin.install()
+switch = component.load('switch')
+
+
+async def run(hosts, args):
+    hass = hass_standin.FakeHass(asyncio.get_event_loop())
+
+    for host in hosts:
+        config = switch.PLATFORM_SCHEMA({
+            'platform': 'sonoff_lan_mode', 'host': host, 'name': host})
+        await switch.async_setup_platform(hass, config,
+                                          hass.async_add_entities)
+
+    while not all(entity.available for entity in hass.entities):
+        await asyncio.sleep(0.05)
+
+    entity_ids = [entity.entity_id for entity in hass.entities]
+    serial, bulk, latencies, failures = [], [], [], 0
+
+    for repeat in range(args.repeats):
+        state = repeat % 2 == 0
+
+        started = time.monotonic()
+        for entity in hass.entities:
+            if await entity.async_switch_confirmed(state) is None:
+                failures += 1
+        serial.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await hass.services.async_call(
+            switch.DOMAIN, switch.SERVICE_BULK_SET,
+            {'entity_id': entity_ids, 'state': not state,
+             'max_concurrent': args.max_concurrent})
+        bulk.append(time.monotonic() - started)
+
+        _, event = hass.bus.events[-1]
+        for result in event[switch.ATTR_RESULTS].values():
+            if result['success']:
+                latencies.append(result['latency_ms'] / 1000)
+            else:
+                failures += 1
+
+    await hass.async_stop()
+
+    print('devices=%d latency=%ss failures=%d' % (len(hosts), args.latency,
+                                                  failures))
+    print('one by one: %.1fms per scene' % (
+        1000 * sum(serial) / len(serial)))
+    print('bulk_set:   %.1fms per scene, per-device latency p50=%sms '
+          'max=%sms' % (1000 * sum(bulk) / len(bulk),
+                        percentile(latencies, 50), percentile(latencies, 100)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mock device response latency')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--max-concurrent', type=int,
+                        default=switch.DEFAULT_BULK_CONCURRENCY)
+    args = parser.parse_args()
+
+    fleet = MockFleet(args.devices, seed=1, latency=args.latency)
+    hosts = fleet.start_in_thread()
+    asyncio.run(run(hosts, args))
+
+
+if __name__ == '__main__':
+    main()
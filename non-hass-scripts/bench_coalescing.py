@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# This script measures how many WebSocket frames command coalescing saves
+# when a device is toggled in rapid bursts (e.g. scene changes or flicker
+# protection loops in automations).
+# When executed (e.g. from a terminal with `python bench_coalescing.py`), it
+# will start `mock_sonoff.py` in a subprocess, connect to it through the
+# component's connection manager with a range of command windows, and report
+# commands issued, frames actually sent and frames saved for each window.
+
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+
+import component
+
+connection = component.load('connection')
+
+MOCK_SONOFF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'mock_sonoff.py')
+
+
+async def run(window, args):
+    loop = asyncio.get_event_loop()
+    manager = connection.SonoffConnectionManager(
+        loop, logging.getLogger('bench_coalescing'))
+    connected = asyncio.Event()
+
+    async def device_update_callback(handle):
+        if handle.available:
+            connected.set()
+
+    handle = manager.async_get_handle(args.host, device_update_callback,
+                                      command_window=window)
+    await asyncio.wait_for(connected.wait(), 30)
+
+    for _ in range(args.bursts):
+        commands = []
+        for toggle in range(args.toggles):
+            command = handle.turn_on if toggle % 2 == 0 else handle.turn_off
+            commands.append(loop.create_task(command()))
+            await asyncio.sleep(args.gap)
+        await asyncio.gather(*commands)
+
+    metrics = handle.metrics
+    await manager.async_stop()
+    return metrics.commands_queued, metrics.command_frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1:8081')
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--toggles', type=int, default=10)
+    parser.add_argument('--gap', type=float, default=0.02,
+                        help='seconds between toggles within a burst')
+    parser.add_argument('--windows', default='0,0.05,0.1,0.25',
+                        help='comma separated command windows, in seconds')
+    parser.add_argument('--no-mock', action='store_true',
+                        help="don't start mock_sonoff.py, e.g. to use a "
+                             "real device")
+    args = parser.parse_args()
+
+    mock = None
+    if not args.no_mock:
+        mock = subprocess.Popen([sys.executable, MOCK_SONOFF],
+                                stdout=subprocess.DEVNULL)
+
+    try:
+        for window in [float(w) for w in args.windows.split(',')]:
+            commands, frames = asyncio.run(run(window, args))
+            print('window=%.3fs commands=%d frames=%d saved=%d (%.0f%%)' % (
+                window, commands, frames, commands - frames,
+                100.0 * (commands - frames) / commands))
+    finally:
+        if mock is not None:
+            mock.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# This script measures how many frames per second (on a single core) the
+# Home Assistant component can encode and decode.
+# When executed (e.g. from a terminal with `python bench_codec.py`), it
+# will time building update and userOnline frames and parsing typical
+# device frames with:
+# - "before": the previous approach of building each frame as a dict and
+#   serialising it with the standard library's json.dumps
+# - "json": the codec's templates, with the standard library backend
+# - "orjson": the codec's templates, with the orjson backend (if installed)
+# and print the frames per second of each.
+
+import argparse
+import json
+import random
+import time
+import timeit
+
+import component
+
+codec = component.load('codec')
+
+DEVICEID = '100060af40'
+
+INBOUND = {
+    'ack': json.dumps({'error': 0, 'deviceid': DEVICEID,
+                       'apikey': 'apikey', 'sequence': '1571141259100'}),
+    'update': json.dumps({
+        'userAgent': 'device', 'apikey': 'apikey', 'deviceid': DEVICEID,
+        'action': 'update', 'params': {'switch': 'on'}}),
+    'update_4ch': json.dumps({
+        'userAgent': 'device', 'apikey': 'apikey', 'deviceid': DEVICEID,
+        'action': 'update', 'params': {
+            'switches': [{'switch': 'on', 'outlet': outlet}
+                         for outlet in range(4)],
+            'configure': [{'startup': 'off', 'outlet': outlet}
+                          for outlet in range(4)],
+            'pulses': [{'pulse': 'off', 'width': 1000, 'outlet': outlet}
+                       for outlet in range(4)],
+            'sledOnline': 'on', 'fwVersion': '2.6.1', 'rssi': -52}}),
+}
+
+SWITCHES_PARAMS = {'switches': [{'switch': 'on', 'outlet': outlet}
+                                for outlet in range(4)]}
+
+
+def user_online_payload():
+    """The handshake frame, as it was built before the codec."""
+    return {
+        'action': 'userOnline',
+        'userAgent': 'app',
+        'version': 6,
+        'nonce': ''.join([str(random.randint(0, 9)) for _ in range(15)]),
+        'apkVesrion': '1.8',
+        'os': 'ios',
+        'at': 'at',
+        'apikey': 'apikey',
+        'ts': str(int(time.time())),
+        'model': 'iPhone10,6',
+        'romVersion': '11.1.2',
+        'sequence': str(time.time()).replace('.', '')
+    }
+
+
+def update_payload(deviceid, params, sequence):
+    """An update frame, as it was built before the codec."""
+    return {
+        'action': 'update',
+        'userAgent': 'app',
+        'params': params,
+        'apikey': 'apikey',
+        'deviceid': str(deviceid),
+        'sequence': sequence,
+        'controlType': 4,
+        'ts': 0
+    }
+
+
+def cases(backend):
+    if backend == 'before':
+        return {
+            'encode update': lambda: json.dumps(update_payload(
+                DEVICEID, {'switch': 'on'}, '1571141259100')),
+            'encode update_4ch': lambda: json.dumps(update_payload(
+                DEVICEID, SWITCHES_PARAMS, '1571141259100')),
+            'encode userOnline': lambda: json.dumps(user_online_payload()),
+            'decode ack': lambda: json.loads(INBOUND['ack']),
+            'decode update': lambda: json.loads(INBOUND['update']),
+            'decode update_4ch': lambda: json.loads(INBOUND['update_4ch']),
+        }
+
+    encoder = codec.UpdateEncoder(DEVICEID)
+    return {
+        'encode update': lambda: encoder.encode({'switch': 'on'},
+                                                '1571141259100'),
+        'encode update_4ch': lambda: encoder.encode(SWITCHES_PARAMS,
+                                                    '1571141259100'),
+        'encode userOnline': codec.encode_user_online,
+        'decode ack': lambda: codec.decode(INBOUND['ack']),
+        'decode update': lambda: codec.decode(INBOUND['update']),
+        'decode update_4ch': lambda: codec.decode(INBOUND['update_4ch']),
+    }
+
+
+def use_backend(backend):
+    if backend == 'orjson':
+        codec.dumps, codec.loads = codec._orjson_dumps, codec.orjson.loads
+    else:
+        codec.dumps, codec.loads = codec._stdlib_dumps, json.loads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    backends = ['before', 'json']
+    if codec.orjson is not None:
+        backends.append('orjson')
+
+    results = {}
+    for backend in backends:
+        use_backend(backend)
+        for name, case in cases(backend).items():
+            seconds = min(timeit.repeat(case, number=args.number, repeat=3))
+            results.setdefault(name, {})[backend] = args.number / seconds
+
+    print('%-20s' % 'frames/s' + ''.join('%12s' % backend
+                                         for backend in backends))
+    for name, rates in results.items():
+        print('%-20s' % name + ''.join('%12.0f' % rates[backend]
+                                       for backend in backends))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# This script measures how many commands survive brief disconnects, with
+# and without the component's command queue.
+# When executed (e.g. from a terminal with `python bench_command_queue.py`),
+# it will connect to --devices mock devices, then for --rounds rounds drop
+# every device's connection and either:
+# - "reconnecting": send each device a command while it is reconnecting, or
+# - "in flight": send each device a command which is lost along with the
+#   connection, before the device has applied or acknowledged it
+# and report how many commands reached their device and were confirmed,
+# with command_deadline=0 (commands are dropped while a device is
+# unavailable, as before the queue) and with the default deadline, along
+# with how long delivered commands took to confirm.
+
+import argparse
+import asyncio
+import logging
+import time
+
+import component
+from mock_fleet import MockDevice
+
+connection = component.load('connection')
+
+
+async def close_connections(device):
+    await asyncio.gather(*[websocket.close() for websocket in list(device.clients)])
+
+
+async def send_command(handle, state, timeout):
+    started = time.monotonic()
+    sequence = await (handle.turn_on() if state else handle.turn_off())
+    if sequence is not None and await handle.async_wait_confirmed(sequence, timeout):
+        return time.monotonic() - started
+    return None
+
+
+async def run(deadline, scenario, args):
+    loop = asyncio.get_event_loop()
+    logger = logging.getLogger('bench_command_queue')
+    # Every dropped command is logged otherwise
+    logger.setLevel(logging.ERROR)
+    manager = connection.SonoffConnectionManager(loop, logger, startup_jitter=0)
+
+    async def device_update_callback(handle):
+        pass
+
+    devices = [MockDevice('1000%06x' % index) for index in range(args.devices)]
+    handles = []
+    for device in devices:
+        host = await device.start()
+        handles.append(manager.async_get_handle(host, device_update_callback, command_deadline=deadline))
+
+    async def wait_available():
+        while not all(handle.available for handle in handles):
+            await asyncio.sleep(0.05)
+
+    sent, delivered, latencies = 0, 0, []
+    for round_ in range(args.rounds):
+        await wait_available()
+        state = round_ % 2 == 0
+
+        if scenario == 'reconnecting':
+            await asyncio.gather(*[close_connections(device) for device in devices])
+            while any(handle.available for handle in handles):
+                await asyncio.sleep(0.01)
+            results = await asyncio.gather(*[send_command(handle, state, args.timeout) for handle in handles])
+        else:
+            # The devices swallow the commands, then the connections drop
+            for device in devices:
+                device.drop = 1.0
+            commands = [loop.create_task(send_command(handle, state, args.timeout)) for handle in handles]
+            await asyncio.sleep(0.05)
+            for device in devices:
+                device.drop = 0.0
+            await asyncio.gather(*[close_connections(device) for device in devices])
+            results = await asyncio.gather(*commands)
+
+        expected = 'on' if state else 'off'
+        sent += len(devices)
+        for device, latency in zip(devices, results):
+            if latency is not None and device.params['switch'] == expected:
+                delivered += 1
+                latencies.append(latency)
+
+    retried = sum(handle.session.metrics.commands_retried for handle in handles)
+    expired = sum(handle.session.metrics.commands_expired for handle in handles)
+
+    await manager.async_stop()
+    for device in devices:
+        await device.stop()
+
+    latencies.sort()
+    print('%-13s command_deadline=%-4s delivered %d/%d  retried=%d expired=%d  latency p50=%s max=%s' % (
+        scenario, deadline, delivered, sent, retried, expired,
+        '%.2fs' % latencies[len(latencies) // 2] if latencies else '-',
+        '%.2fs' % latencies[-1] if latencies else '-'))
+
+
+async def main_async(args):
+    for scenario in ('reconnecting', 'in flight'):
+        for deadline in (0, connection.DEFAULT_COMMAND_DEADLINE):
+            await run(deadline, scenario, args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=2,
+                        help='seconds to wait for a confirmation once a command is sent')
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
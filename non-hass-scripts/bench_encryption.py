@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# This script measures what encrypted LAN mode (AES-128-CBC, for devices
+# paired to an eWeLink account) costs the component.
+# When executed (e.g. from a terminal with `python bench_encryption.py`), it
+# will report:
+# - CPU time per command (encrypting the request and decrypting the reply)
+#   and per pushed update (decrypting an mDNS announcement), with the key and
+#   AES setup cached per session as the component does, and derived afresh
+#   for every message, along with the share of one CPU core a fleet of
+#   --devices devices sending --updates-per-minute updates each would take
+# - end to end command -> confirmation and push latency against --http-devices
+#   mock HTTP devices (see `mock_fleet.py`), with and without encryption
+# It needs the cryptography package.
+
+import argparse
+import asyncio
+import logging
+import time
+
+import component
+from measure import summarise
+from mock_fleet import MockDevice
+
+connection = component.load('connection')
+encryption = component.load('encryption')
+
+DEVICEKEY = '0123456789abcdef0123456789abcdef'
+
+
+def time_per_call(function, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        function()
+    return (time.process_time() - started) / iterations
+
+
+def bench_cpu(args):
+    params = {'switches': [{'switch': 'on', 'outlet': outlet} for outlet in range(4)]}
+    reply = {'seq': 1, 'error': 0}
+    cached = encryption.DeviceCipher(DEVICEKEY)
+    iv, pushed = cached.encrypt(params)
+    reply_iv, reply_data = cached.encrypt(reply)
+
+    def command_cached():
+        cached.encrypt(params)
+        cached.decrypt(reply_iv, reply_data)
+
+    def command_uncached():
+        encryption.DeviceCipher(DEVICEKEY).encrypt(params)
+        encryption.DeviceCipher(DEVICEKEY).decrypt(reply_iv, reply_data)
+
+    def push_cached():
+        cached.decrypt(iv, pushed)
+
+    def push_uncached():
+        encryption.DeviceCipher(DEVICEKEY).decrypt(iv, pushed)
+
+    per_second = args.devices * args.updates_per_minute / 60
+    for name, command, push in (('cached', command_cached, push_cached),
+                                ('per message', command_uncached, push_uncached)):
+        command_cost = time_per_call(command, args.iterations)
+        push_cost = time_per_call(push, args.iterations)
+        print('%-12s command %6.1fus  push %6.1fus  %d devices x %g updates/min: %.3f%% of a core' % (
+            name, command_cost * 1e6, push_cost * 1e6, args.devices, args.updates_per_minute,
+            100 * push_cost * per_second))
+
+
+async def bench_end_to_end(name, devicekey, args):
+    loop = asyncio.get_event_loop()
+    logger = logging.getLogger('bench_encryption')
+    manager = connection.SonoffConnectionManager(loop, logger, startup_jitter=0)
+
+    pushed = {}
+
+    async def device_update_callback(handle):
+        waiter = pushed.pop(handle, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(loop.time())
+
+    def push_listener(deviceid, params, iv):
+        loop.create_task(manager.async_push_state(deviceid, params, iv))
+
+    devices = [MockDevice('1000%06x' % index, protocol='http', devicekey=devicekey)
+               for index in range(args.http_devices)]
+    handles = []
+    for device in devices:
+        device.push_listeners.append(push_listener)
+        host = await device.start()
+        handles.append(manager.async_get_handle(host, device_update_callback, deviceid=device.deviceid,
+                                                transport='http', devicekey=devicekey))
+
+    while not all(handle.available for handle in handles):
+        await asyncio.sleep(0.01)
+
+    async def command(handle, state):
+        sent = loop.time()
+        sequence = await (handle.turn_on() if state else handle.turn_off())
+        if await handle.async_wait_confirmed(sequence, 5):
+            return loop.time() - sent
+        return None
+
+    latencies, misses = [], 0
+    for index in range(args.commands // len(handles)):
+        results = await asyncio.gather(*[command(handle, index % 2 == 0) for handle in handles])
+        latencies += [latency for latency in results if latency is not None]
+        misses += results.count(None)
+
+    push_latencies = []
+    for _ in range(args.pushes):
+        # Stay under the sessions' update rate limit
+        await asyncio.sleep(1.5 / connection.DEFAULT_UPDATE_RATE)
+        waiters = {}
+        for handle in handles:
+            waiters[handle] = pushed[handle] = loop.create_future()
+        started = loop.time()
+        await asyncio.gather(*[device.toggle() for device in devices])
+        for waiter in waiters.values():
+            push_latencies.append(await asyncio.wait_for(waiter, 5) - started)
+
+    await manager.async_stop()
+    for device in devices:
+        await device.stop()
+
+    print('%-10s command %s (misses=%d)  push %s' % (
+        name, summarise(latencies), misses, summarise(push_latencies)))
+
+
+async def main_async(args):
+    await bench_end_to_end('plain', None, args)
+    await bench_end_to_end('encrypted', DEVICEKEY, args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--devices', type=int, default=1000, help='fleet size to project CPU usage for')
+    parser.add_argument('--updates-per-minute', type=float, default=6,
+                        help='pushed updates per device per minute to project CPU usage for')
+    parser.add_argument('--http-devices', type=int, default=10)
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--pushes', type=int, default=50)
+    args = parser.parse_args()
+
+    bench_cpu(args)
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
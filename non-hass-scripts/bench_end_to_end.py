@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# This script is a reproducible end-to-end benchmark of the Home Assistant
+# component, to catch regressions in the hot path before upgrading.
+# When executed (e.g. from a terminal with
+# `python bench_end_to_end.py --devices 10,100,250 --output results.json`),
+# for each device count it will start `mock_fleet.py` in a subprocess, set up
+# the real switch platform (on the minimal Home Assistant stand-in in
+# `hass_standin.py`) with one entity per mock device, then for --duration
+# seconds toggle random entities and report:
+# - command -> confirmed state latency percentiles, measured from calling
+#   turn_on/turn_off until the entity writes the new state
+# - state writes per second ingested (commands plus spontaneous toggles)
+# - event loop lag percentiles
+# - CPU usage and RSS of this process (the mock fleet runs separately)
+# Results are printed as a table and written as JSON to --output.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import time
+
+import hass_standin
+import component
+from measure import measure_loop_lag, percentile
+from mock_fleet import start_fleet
+
+hass_standin.install()
+switch = component.load('switch')
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except (OSError, ValueError):
+        # Peak rather than current RSS, in KB on Linux but bytes on macOS
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                     1024, 1)
+
+
+async def run(count, hosts, args):
+    loop = asyncio.get_event_loop()
+    hass = hass_standin.FakeHass(loop)
+
+    for host in hosts:
+        config = switch.PLATFORM_SCHEMA({
+            'platform': 'sonoff_lan_mode', 'host': host, 'name': host})
+        await switch.async_setup_platform(hass, config,
+                                          hass.async_add_entities)
+
+    started = time.monotonic()
+    while not all(entity.available for entity in hass.entities):
+        if time.monotonic() - started > args.timeout * 10:
+            raise RuntimeError('Not all mock devices became available')
+        await asyncio.sleep(0.05)
+    time_to_available = time.monotonic() - started
+
+    waiters = {}
+
+    def state_written(entity):
+        target, future = waiters.get(entity, (None, None))
+        if future is not None and entity.is_on == target and \
+                not future.done():
+            future.set_result(None)
+
+    hass.state_listeners.append(state_written)
+
+    latencies = []
+    misses = 0
+
+    async def command(entity):
+        nonlocal misses
+        target = not entity.is_on
+        future = loop.create_future()
+        waiters[entity] = (target, future)
+        sent = loop.time()
+        try:
+            if target:
+                await entity.turn_on()
+            else:
+                await entity.turn_off()
+            await asyncio.wait_for(future, args.timeout)
+            latencies.append(loop.time() - sent)
+        except asyncio.TimeoutError:
+            misses += 1
+        finally:
+            del waiters[entity]
+
+    lag = []
+    stop = asyncio.Event()
+    lag_task = loop.create_task(measure_loop_lag(stop, lag))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_started = usage.ru_utime + usage.ru_stime
+    writes_started = hass.state_writes
+    started = time.monotonic()
+
+    while time.monotonic() - started < args.duration:
+        batch = random.sample(hass.entities,
+                              min(args.concurrency, len(hass.entities)))
+        await asyncio.gather(*[command(entity) for entity in batch])
+
+    elapsed = time.monotonic() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_started
+    writes = hass.state_writes - writes_started
+
+    stop.set()
+    await lag_task
+    rss = current_rss_mb()
+    await hass.async_stop()
+
+    return {
+        'devices': count,
+        'time_to_available_s': round(time_to_available, 3),
+        'commands': len(latencies) + misses,
+        'confirm_misses': misses,
+        'latency_ms': {'p50': percentile(latencies, 50),
+                       'p90': percentile(latencies, 90),
+                       'p99': percentile(latencies, 99),
+                       'max': percentile(latencies, 100)},
+        'state_writes_per_s': round(writes / elapsed, 1),
+        'loop_lag_ms': {'p50': percentile(lag, 50),
+                        'p99': percentile(lag, 99),
+                        'max': percentile(lag, 100)},
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'rss_mb': rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', default='10,50,100',
+                        help='comma separated device counts to run')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='commands in flight at once')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds before a command counts as missed')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mock device response latency')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--toggle-interval', type=float, default=30,
+                        help='mean seconds between spontaneous toggles of '
+                             'each mock device')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write JSON results to')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+
+    for count in [int(count) for count in args.devices.split(',')]:
+        fleet, devices = start_fleet(
+            count, '--latency', args.latency, '--jitter', args.jitter,
+            '--toggle-interval', args.toggle_interval, '--seed', args.seed)
+        hosts = [host for _, host in devices]
+        try:
+            result = asyncio.run(run(count, hosts, args))
+        finally:
+            fleet.terminate()
+            fleet.wait()
+
+        results.append(result)
+        print('devices=%(devices)d commands=%(commands)d '
+              'misses=%(confirm_misses)d writes/s=%(state_writes_per_s)s '
+              'cpu=%(cpu_percent)s%% rss=%(rss_mb)sMB' % result)
+        print('    latency ms %s, loop lag ms %s' % (
+            json.dumps(result['latency_ms']),
+            json.dumps(result['loop_lag_ms'])))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'args': vars(args), 'results': results}, output,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
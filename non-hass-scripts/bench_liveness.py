@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# This script measures how long the component takes to notice that a device
+# has died (e.g. been unplugged), for a range of keepalive ping intervals.
+# When executed (e.g. from a terminal with `python bench_liveness.py`), for
+# each ping interval it will connect to --devices mock devices, wait for
+# their round trip times to be measured, then "unplug" them all at once
+# (they stop answering without closing their connections) and report the
+# time until each session was marked unavailable, along with the adaptive
+# pong timeout which was in use.
+# The old fixed keepalive (a ping every 145s, with a 10s timeout) took up to
+# 155s to notice the same thing.
+
+import argparse
+import asyncio
+import logging
+import time
+
+import component
+from mock_fleet import MockDevice
+
+connection = component.load('connection')
+
+
+def summarise(values):
+    values = sorted(values)
+    return 'mean=%.2fs p50=%.2fs max=%.2fs' % (
+        sum(values) / len(values), values[len(values) // 2], values[-1])
+
+
+async def run(ping_interval, args):
+    loop = asyncio.get_event_loop()
+    manager = connection.SonoffConnectionManager(
+        loop, logging.getLogger('bench_liveness'),
+        ping_interval=ping_interval, ping_timeout=args.ping_timeout,
+        tick=args.tick, startup_jitter=0)
+    lost = {}
+
+    async def device_update_callback(handle):
+        if not handle.available and handle not in lost:
+            lost[handle] = time.monotonic()
+
+    devices = [MockDevice('1000%06x' % index) for index in range(args.devices)]
+    handles = []
+    for device in devices:
+        host = await device.start()
+        handles.append(manager.async_get_handle(host, device_update_callback))
+
+    while not all(handle.available for handle in handles):
+        await asyncio.sleep(0.05)
+
+    # Let every session be pinged at least once, so its RTT is known
+    await asyncio.sleep(ping_interval * 1.5 + args.tick)
+    timeouts = [handle.session.pong_timeout for handle in handles]
+
+    unplugged = time.monotonic()
+    for device in devices:
+        device.freeze()
+
+    while len(lost) < len(handles):
+        if time.monotonic() - unplugged > ping_interval + args.ping_timeout \
+                + args.tick * 2 + 5:
+            raise RuntimeError('Not every dead device was detected')
+        await asyncio.sleep(0.01)
+
+    await manager.async_stop()
+    for device in devices:
+        await device.stop()
+
+    print('ping_interval=%ss pong timeout %s, time to detect %s' % (
+        ping_interval, summarise(timeouts),
+        summarise([lost[handle] - unplugged for handle in handles])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--intervals', default='10,5',
+                        help='comma separated ping intervals to measure')
+    parser.add_argument('--ping-timeout', type=float,
+                        default=connection.DEFAULT_PING_TIMEOUT)
+    parser.add_argument('--tick', type=float, default=1)
+    parser.add_argument('--devices', type=int, default=10)
+    args = parser.parse_args()
+
+    for ping_interval in [float(value) for value in args.intervals.split(',')]:
+        asyncio.run(run(ping_interval, args))
+
+
+if __name__ == '__main__':
+    main()
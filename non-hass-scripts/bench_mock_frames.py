@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# This script measures how fast `mock_sonoff.py` can read frames from a
+# client, so it can keep up with (and saturate) the code under test.
+# When executed (e.g. from a terminal with `python bench_mock_frames.py`),
+# for a range of payload sizes it will stream --frames masked text frames
+# over a local socket pair into:
+# - "before": the handler from the websocket_server package, which the mock
+#   used to share, unmasking a byte at a time
+# - "after": the mock's handler, unmasking word-wise over a reused buffer
+# and report MB/s and frames/s for each, then check that the mock's handler
+# reassembles messages split into fragments, with pings in between.
+
+import argparse
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+import websocket_server
+
+import mock_sonoff
+
+
+class CountingServer:
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.messages = []
+        self.count = 0
+        self.pings = 0
+
+    def _message_received_(self, handler, message):
+        self.count += 1
+        if self.keep:
+            self.messages.append(message)
+
+    def _ping_received_(self, handler, message):
+        self.pings += 1
+
+    def _pong_received_(self, handler, message):
+        pass
+
+    def _client_left_(self, handler):
+        pass
+
+
+def encode_frame(payload, opcode=websocket_server.OPCODE_TEXT, fin=True):
+    """Build a masked client frame, as a browser or websockets would."""
+    header = bytearray([(websocket_server.FIN if fin else 0) | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(websocket_server.MASKED | length)
+    elif length < 2 ** 16:
+        header.append(websocket_server.MASKED | 126)
+        header += struct.pack('>H', length)
+    else:
+        header.append(websocket_server.MASKED | 127)
+        header += struct.pack('>Q', length)
+    mask = os.urandom(4)
+    masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+    return bytes(header) + mask + masked
+
+
+def read_stream(handler_class, stream, frames, server):
+    """Feed a stream of frames to a handler over a socket pair, returning the seconds taken."""
+    reader, writer = socket.socketpair()
+    handler = handler_class.__new__(handler_class)
+    handler.request = reader
+    handler.server = server
+    handler.setup()
+
+    sender = threading.Thread(target=writer.sendall, args=(stream,))
+    started = time.perf_counter()
+    sender.start()
+    for _ in range(frames):
+        handler.read_next_message()
+    elapsed = time.perf_counter() - started
+
+    sender.join()
+    handler.finish()
+    reader.close()
+    writer.close()
+    return elapsed
+
+
+def check_fragments():
+    message = '{"action":"update","params":{"switch":"on"},"pad":"%s"}' % ('x' * 1000)
+    data = message.encode('utf8')
+    parts = [data[index:index + 300] for index in range(0, len(data), 300)]
+    stream = b''
+    for index, part in enumerate(parts):
+        opcode = websocket_server.OPCODE_TEXT if index == 0 else websocket_server.OPCODE_CONTINUATION
+        stream += encode_frame(part, opcode, fin=index == len(parts) - 1)
+        if index == 0:
+            stream += encode_frame(b'ping', websocket_server.OPCODE_PING)
+    stream += encode_frame(data, websocket_server.OPCODE_BINARY)
+
+    server = CountingServer(keep=True)
+    read_stream(mock_sonoff.MockWebSocketHandler, stream, len(parts) + 2, server)
+    ok = server.messages == [message, message] and server.pings == 1
+    print('fragmented message (%d fragments + ping) and binary message reassembled: %s' % (
+        len(parts), 'ok' if ok else 'FAILED %r' % server.messages))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=5000)
+    parser.add_argument('--sizes', default='128,4096,65536', help='comma separated payload sizes in bytes')
+    args = parser.parse_args()
+
+    # The handlers log pings and the like
+    logging.getLogger().setLevel(logging.ERROR)
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        payload = ('{"action":"update","params":{"switch":"on"},"pad":"%s"}' % ('x' * size))[:size].encode('utf8')
+        frames = max(10, min(args.frames, (256 * 2 ** 20) // size))
+        stream = encode_frame(payload) * frames
+        megabytes = len(payload) * frames / 2 ** 20
+
+        results = []
+        for handler_class in (websocket_server.WebSocketHandler, mock_sonoff.MockWebSocketHandler):
+            server = CountingServer()
+            elapsed = read_stream(handler_class, stream, frames, server)
+            assert server.count == frames
+            results.append('%8.1f MB/s %9.0f frames/s' % (megabytes / elapsed, frames / elapsed))
+
+        print('payload=%-6d before %s   after %s' % (size, results[0], results[1]))
+
+    check_fragments()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# This micro-benchmark measures the cost of the entity properties Home
+# Assistant reads on every state write (name, available, is_on).
+# When executed (e.g. from a terminal with `python bench_properties.py`), it
+# compares the current HassSonoffSwitch with a copy of the old properties,
+# which formatted (and, because the platform forced its logger to DEBUG,
+# emitted) a debug message on every access.
+
+import argparse
+import asyncio
+import logging
+import timeit
+
+import hass_standin
+import component
+
+hass_standin.install()
+switch = component.load('switch')
+
+
+class EagerLoggingSwitch(switch.HassSonoffSwitch):
+    """The property implementations before lazy logging was introduced."""
+
+    @property
+    def name(self):
+        switch._LOGGER.debug("HassSonoffSwitch returning _name: %s" %
+                             self._name)
+        return self._name
+
+    @property
+    def available(self):
+        switch._LOGGER.debug("HassSonoffSwitch returning _available: %s" %
+                             self._available)
+        return self._available
+
+    @property
+    def is_on(self):
+        switch._LOGGER.debug("HassSonoffSwitch returning _state: %s" %
+                             self._state)
+        return self._state
+
+
+def read_properties(entity):
+    return entity.name, entity.available, entity.is_on
+
+
+def measure(entity, number):
+    seconds = min(timeit.repeat(lambda: read_properties(entity),
+                                number=number, repeat=5))
+    return seconds / number * 1e9
+
+
+async def run(args):
+    hass = hass_standin.FakeHass(asyncio.get_event_loop())
+    # Nothing listens here, the entities never need to connect
+    old = EagerLoggingSwitch(hass, '127.0.0.1:9', 'Old', 'mdi:flash')
+    new = switch.HassSonoffSwitch(hass, '127.0.0.1:9', 'New', 'mdi:flash')
+
+    logger = switch._LOGGER
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    logger.setLevel(logging.DEBUG)
+    results = [('old, forced DEBUG level', measure(old, args.number))]
+    logger.setLevel(logging.WARNING)
+    results.append(('old, WARNING level', measure(old, args.number)))
+    results.append(('new, WARNING level', measure(new, args.number)))
+    logger.setLevel(logging.DEBUG)
+    results.append(('new, DEBUG level', measure(new, args.number)))
+
+    await hass.async_stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    for label, nanoseconds in asyncio.run(run(args)):
+        print('%-24s %8.0f ns per state write' % (label, nanoseconds))
+
+
+if __name__ == '__main__':
+    main()
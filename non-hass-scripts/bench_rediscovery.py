@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# This script measures how long the component takes to find a device again
+# after its address changes (e.g. a new DHCP lease).
+# When executed (e.g. from a terminal with `python bench_rediscovery.py`), it
+# will start a mock device and announce it over mDNS with `mock_mdns.py`,
+# connect to it by device id only, then "move" the device to a new port,
+# re-announce it and report the time until the session is available again.
+
+import argparse
+import asyncio
+import logging
+import time
+
+import component
+from mock_fleet import MockDevice
+from mock_mdns import MockMdnsResponder
+
+connection = component.load('connection')
+discovery = component.load('discovery')
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    manager = connection.SonoffConnectionManager(
+        loop, logging.getLogger('bench_rediscovery'))
+    browser = discovery.SonoffDiscovery(manager)
+    responder = MockMdnsResponder()
+    available = asyncio.Event()
+
+    async def device_update_callback(handle):
+        if handle.available:
+            available.set()
+        else:
+            available.clear()
+
+    old_device = MockDevice(args.deviceid)
+    old_host = await old_device.start()
+    await loop.run_in_executor(None, responder.announce, args.deviceid,
+                               '127.0.0.1', int(old_host.split(':')[1]))
+    await loop.run_in_executor(None, browser.start)
+
+    started = time.monotonic()
+    handle = manager.async_get_handle(None, device_update_callback,
+                                      deviceid=args.deviceid)
+    await asyncio.wait_for(available.wait(), args.timeout)
+    print('discovered and connected in %.2fs' % (time.monotonic() - started))
+
+    # The device drops off the network, then comes back somewhere else
+    await old_device.stop()
+    while handle.available:
+        await asyncio.sleep(0.05)
+
+    new_device = MockDevice(args.deviceid)
+    new_host = await new_device.start()
+    started = time.monotonic()
+    await loop.run_in_executor(None, responder.announce, args.deviceid,
+                               '127.0.0.1', int(new_host.split(':')[1]))
+    await asyncio.wait_for(available.wait(), args.timeout)
+    print('rediscovered after address change in %.2fs' % (
+        time.monotonic() - started))
+
+    await manager.async_stop()
+    await loop.run_in_executor(None, browser.stop)
+    await loop.run_in_executor(None, responder.close)
+    await new_device.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--deviceid', default='100060af40')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
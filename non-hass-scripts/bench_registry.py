@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# This script measures the per-message cost of the device registry used by
+# `test_sonoff.py` to dispatch updates, as the number of devices one client
+# talks to grows.
+# When executed (e.g. from a terminal with
+# `python bench_registry.py --devices 10,100,1000,5000`), for each device
+# count it will register that many devices (half of them 4-outlet), then
+# feed `Sonoff.on_message` random switch updates and report the time per
+# message, compared with the previous approach of scanning a list of devices
+# (and formatting the whole list into a debug message) for every update.
+
+import argparse
+import json
+import logging
+import random
+import time
+
+import test_sonoff
+
+
+def update_frame(deviceid, outlets, rng):
+    if outlets:
+        params = {'switches': [{'switch': rng.choice(['on', 'off']), 'outlet': rng.randrange(outlets)}]}
+    else:
+        params = {'switch': rng.choice(['on', 'off'])}
+    return json.dumps({'userAgent': 'device', 'apikey': 'apikey', 'deviceid': deviceid, 'action': 'update',
+                       'params': params})
+
+
+def linear_on_message(devices, message, logger):
+    """The update path of Sonoff.on_message before the registry."""
+    data = json.loads(message)
+    logger.debug('searching for deviceid: {} in known devices {}'.format(devices.__str__(), data['deviceid']))
+    for idx, device in enumerate(devices):
+        if device['deviceid'] == data['deviceid']:
+            devices[idx]['params'] = data['params']
+            return
+    devices.append(data)
+
+
+def measure(count, args):
+    rng = random.Random(args.seed)
+    logger = logging.getLogger('bench_registry')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    sonoff = test_sonoff.Sonoff.__new__(test_sonoff.Sonoff)
+    sonoff.logger = logger
+    sonoff._devices = test_sonoff.DeviceRegistry()
+    linear = []
+
+    devices = [('1000%06x' % index, 4 if index % 2 else 0) for index in range(count)]
+    for deviceid, outlets in devices:
+        if outlets:
+            params = {'switches': [{'switch': 'off', 'outlet': outlet} for outlet in range(outlets)]}
+        else:
+            params = {'switch': 'off'}
+        message = json.dumps({'deviceid': deviceid, 'action': 'update', 'params': params})
+        sonoff.on_message(message)
+        linear_on_message(linear, message, logger)
+
+    messages = [update_frame(deviceid, outlets, rng) for deviceid, outlets in
+                (rng.choice(devices) for _ in range(args.messages))]
+
+    # The old approach gets slow quickly, so give it at most a few seconds
+    started = time.perf_counter()
+    handled = 0
+    for message in messages:
+        linear_on_message(linear, message, logger)
+        handled += 1
+        if time.perf_counter() - started > args.max_seconds:
+            break
+    linear_cost = (time.perf_counter() - started) / handled
+
+    started = time.perf_counter()
+    for message in messages:
+        sonoff.on_message(message)
+    registry_cost = (time.perf_counter() - started) / len(messages)
+
+    print('devices=%-6d registry %.1fus/msg   linear scan %.1fus/msg' % (
+        count, registry_cost * 1e6, linear_cost * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', default='10,100,1000,5000', help='comma separated device counts to run')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--max-seconds', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for count in [int(count) for count in args.devices.split(',')]:
+        measure(count, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# This script measures how long adding, reconfiguring or removing one device
+# takes when devices are config entries, and checks that the rest of the
+# fleet isn't disturbed by it.
+# When executed (e.g. from a terminal with `python bench_reload.py`), it will
+# start `mock_fleet.py` in a subprocess with --devices + 1 devices, add each
+# of them as a config entry of the real integration (on the minimal Home
+# Assistant stand-in in `hass_standin.py`) and wait for them to connect,
+# then --rounds times:
+# - reload one entry, as the integrations page does
+# - change the entry's options, which reloads it through its update listener
+# - remove the entry and add it back, as when a device is hot added
+# and report the time taken until the device's switch is available again,
+# whether it got a new session every time, the event loop lag meanwhile, and
+# whether any of the other devices reconnected, changed session or had a
+# state written. For comparison, it also reports the time for every device to
+# become available after setting them all up from scratch, as after a restart
+# of Home Assistant, which is what adding a device to the YAML config costs.
+
+import argparse
+import asyncio
+
+import hass_standin
+import component
+from measure import measure_loop_lag, percentile, summarise
+from mock_fleet import start_fleet
+
+hass_standin.install()
+switch = component.load('switch')
+integration = component.integration()
+
+def make_entry(deviceid, host):
+    return hass_standin.ConfigEntry(integration.DOMAIN, deviceid, {'host': host, 'name': deviceid},
+                                    options={'max_update_rate': 10}, unique_id=deviceid)
+
+
+async def wait_available(hass, entity_ids, timeout=30):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        entities = [entity for entity in hass.entities if entity.entity_id in entity_ids]
+        if len(entities) == len(entity_ids) and all(entity.available for entity in entities):
+            return
+        if loop.time() > deadline:
+            raise TimeoutError('devices did not become available')
+        await asyncio.sleep(0.001)
+
+
+async def run(devices, args):
+    loop = asyncio.get_event_loop()
+    hass = hass_standin.FakeHass(loop)
+
+    started = loop.time()
+    entries = [make_entry(deviceid, host) for deviceid, host in devices]
+    for entry in entries:
+        await hass.config_entries.async_add(entry)
+    all_ids = {entity.entity_id for entity in hass.entities}
+    await wait_available(hass, all_ids, timeout=60)
+    setup_time = loop.time() - started
+
+    target, others = entries[0], entries[1:]
+    target_ids = {'switch.%s' % target.unique_id}
+    manager = hass.data[switch.DATA_MANAGER]
+    before = {key: (session, session.metrics.connections) for key, session in manager.sessions.items()
+              if key != target.data['host']}
+
+    disturbed_writes = 0
+    other_hosts = {entry.data['host'] for entry in others}
+
+    def state_written(entity):
+        nonlocal disturbed_writes
+        if entity.entity_id not in target_ids:
+            disturbed_writes += 1
+
+    hass.state_listeners.append(state_written)
+
+    lag, stop = [], asyncio.Event()
+    lag_task = loop.create_task(measure_loop_lag(stop, lag, interval=0.005))
+    timings = {'reload': [], 'options change': [], 'remove + add': []}
+    reopened = 0
+
+    def target_session():
+        return manager.sessions.get(target.data['host'])
+
+    for round_ in range(args.rounds):
+        session = target_session()
+        started = loop.time()
+        await hass.config_entries.async_reload(target.entry_id)
+        await wait_available(hass, target_ids)
+        timings['reload'].append(loop.time() - started)
+        reopened += target_session() is not session
+
+        session = target_session()
+        started = loop.time()
+        await asyncio.gather(*hass.config_entries.async_update_entry(
+            target, dict(target.options, command_window=0.01 * (round_ % 2))))
+        await wait_available(hass, target_ids)
+        timings['options change'].append(loop.time() - started)
+        reopened += target_session() is not session
+
+        session = target_session()
+        started = loop.time()
+        await hass.config_entries.async_remove(target.entry_id)
+        target = make_entry(target.unique_id, target.data['host'])
+        await hass.config_entries.async_add(target)
+        await wait_available(hass, target_ids)
+        timings['remove + add'].append(loop.time() - started)
+        reopened += target_session() is not session
+
+    stop.set()
+    await lag_task
+
+    after = {key: (session, session.metrics.connections) for key, session in manager.sessions.items()
+             if key in other_hosts}
+    reconnected = sum(1 for key, (session, connections) in before.items()
+                      if after.get(key, (None, None))[0] is not session or after[key][1] != connections)
+
+    print('set up %d devices from scratch (as after a restart): %.2fs' % (len(entries), setup_time))
+    for name, values in timings.items():
+        print('%-15s one device available again: %s' % (name, summarise(values, (50, 100))))
+    print('reloaded device: new session %d of %d times' % (reopened, 3 * args.rounds))
+    print('event loop lag meanwhile ms: p99=%s max=%s' % (percentile(lag, 99), percentile(lag, 100)))
+    print('other devices: %d reconnected or changed session, %d state writes (%s)' % (
+        reconnected, disturbed_writes, 'undisturbed' if not reconnected and not disturbed_writes else 'DISTURBED'))
+
+    await hass.async_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=100, help='devices which should stay undisturbed')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    fleet, devices = start_fleet(args.devices + 1)
+    try:
+        asyncio.run(run(devices, args))
+    finally:
+        fleet.terminate()
+        fleet.wait()
+
+
+if __name__ == '__main__':
+    main()
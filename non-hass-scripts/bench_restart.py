@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# This script measures how long switches take to show the correct state
+# after a Home Assistant restart, with and without the persisted state cache.
+# When executed (e.g. from a terminal with `python bench_restart.py`), it
+# will start a fleet of mock devices in random states in a background thread,
+# set up the real switch platform (on the minimal Home Assistant stand-in in
+# `hass_standin.py`) once to populate the cache, switch --changed of the
+# devices "while Home Assistant is down", then restart with the cache and
+# without it, reporting for each:
+# - the fraction of switches showing the correct state as soon as they are
+#   set up, and the time until every switch shows the correct state
+# - the time until every switch's state has been confirmed by its device
+# - the number of state writes made until then
+
+import argparse
+import asyncio
+import random
+import shutil
+import tempfile
+import time
+
+import hass_standin
+import component
+from mock_fleet import MockFleet
+
+hass_standin.install()
+switch = component.load('switch')
+
+
+async def start(hosts, config_dir):
+    hass = hass_standin.FakeHass(asyncio.get_event_loop(), config_dir)
+    for host in hosts:
+        config = switch.PLATFORM_SCHEMA({
+            'platform': 'sonoff_lan_mode', 'host': host, 'name': host})
+        await switch.async_setup_platform(hass, config,
+                                          hass.async_add_entities)
+    return hass
+
+
+async def populate(hosts, config_dir):
+    hass = await start(hosts, config_dir)
+    while not all(entity.available for entity in hass.entities):
+        await asyncio.sleep(0.05)
+    await hass.async_stop()
+
+
+async def restart(fleet, hosts, config_dir, args):
+    started = time.monotonic()
+    hass = await start(hosts, config_dir)
+    devices = {device.host: device for device in fleet.devices}
+
+    def correct(entity):
+        device = devices[entity.name]
+        return entity.available and \
+            entity.is_on == (device.params['switch'] == 'on')
+
+    initially_correct = sum(1 for entity in hass.entities if correct(entity))
+    all_correct = None
+
+    while True:
+        elapsed = time.monotonic() - started
+        if all_correct is None and all(correct(entity)
+                                       for entity in hass.entities):
+            all_correct = elapsed
+        if all(correct(entity) and not entity.assumed_state
+               for entity in hass.entities):
+            break
+        if elapsed > args.timeout:
+            raise RuntimeError('Not every switch reached the correct state')
+        await asyncio.sleep(0.01)
+
+    writes = hass.state_writes
+    await hass.async_stop()
+    return initially_correct / len(hosts), all_correct, elapsed, writes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='fraction of devices to switch while Home '
+                             'Assistant is down')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    fleet = MockFleet(args.devices, seed=args.seed)
+    for device in fleet.devices:
+        device.params['switch'] = rng.choice(['on', 'off'])
+    hosts = fleet.start_in_thread()
+
+    cached_dir, empty_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        asyncio.run(populate(hosts, cached_dir))
+
+        for device in rng.sample(fleet.devices,
+                                 int(args.changed * args.devices)):
+            device.params['switch'] = \
+                'off' if device.params['switch'] == 'on' else 'on'
+
+        for name, config_dir in (('cached', cached_dir),
+                                 ('no cache', empty_dir)):
+            initially, correct, confirmed, writes = asyncio.run(
+                restart(fleet, hosts, config_dir, args))
+            print('%-8s correct at setup=%3.0f%% all correct after %.2fs, '
+                  'all confirmed after %.2fs, state writes=%d' % (
+                      name, 100 * initially, correct, confirmed, writes))
+    finally:
+        shutil.rmtree(cached_dir)
+        shutil.rmtree(empty_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# This script measures how long it takes for a large fleet of devices to all
+# become available after Home Assistant starts, when some of the configured
+# devices are offline.
+# When executed (e.g. from a terminal with `python bench_startup.py`), it will
+# start mock devices in a background thread, configure them along with a
+# number of unreachable hosts, and print a startup timeline (time until 10%,
+# 50%, 90% and all of the reachable devices are available).
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import component
+from mock_fleet import MockFleet
+
+connection = component.load('connection')
+
+
+async def run(online, offline, args):
+    loop = asyncio.get_event_loop()
+    manager = connection.SonoffConnectionManager(
+        loop, logging.getLogger('bench_startup'),
+        max_connecting=args.max_connecting,
+        startup_jitter=args.startup_jitter)
+
+    async def device_update_callback(handle):
+        pass
+
+    started = time.monotonic()
+    hosts = online + offline
+    random.shuffle(hosts)
+    for host in hosts:
+        manager.async_get_handle(host, device_update_callback)
+    setup_time = time.monotonic() - started
+
+    sessions = [manager.sessions[host] for host in online]
+    while any(session.first_available is None for session in sessions):
+        await asyncio.sleep(0.05)
+
+    timeline = sorted(session.first_available for session in sessions)
+    await manager.async_stop()
+    return setup_time, timeline
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--offline', type=int, default=20,
+                        help='number of configured hosts which never answer')
+    parser.add_argument('--offline-host', default='10.255.255.1',
+                        help='unroutable address used for offline devices')
+    parser.add_argument('--max-connecting', type=int,
+                        default=connection.DEFAULT_MAX_CONNECTING)
+    parser.add_argument('--startup-jitter', type=float,
+                        default=connection.DEFAULT_STARTUP_JITTER)
+    args = parser.parse_args()
+
+    online = MockFleet(args.devices).start_in_thread()
+    offline = ['%s:%d' % (args.offline_host, 8081 + i)
+               for i in range(args.offline)]
+
+    setup_time, timeline = asyncio.run(run(online, offline, args))
+    print('setup returned in %.1fms' % (setup_time * 1000))
+    for percent in (10, 50, 90):
+        index = max(0, int(len(timeline) * percent / 100) - 1)
+        print('%3d%% of %d devices available after %.2fs' % (
+            percent, len(timeline), timeline[index]))
+    print('all %d devices available after %.2fs (%d offline hosts, '
+          'max_connecting=%d)' % (len(timeline), timeline[-1], args.offline,
+                                  args.max_connecting))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# This script measures how much Home Assistant state the component writes
+# for power monitoring devices (e.g. the POW and S31), which report power,
+# voltage and current readings many times a minute.
+# When executed (e.g. from a terminal with
+# `python bench_telemetry.py --devices 50 --telemetry 1`), it will start
+# `mock_fleet.py` in a subprocess with every device switched on and reporting
+# --telemetry readings per second, set up the real switch and sensor
+# platforms (on the minimal Home Assistant stand-in in `hass_standin.py`)
+# with power, voltage and current sensors for every device, poll the sensors
+# every --scan-interval seconds as Home Assistant would for --duration
+# seconds, and report:
+# - readings received, which is how many states sensors written straight
+#   from the device would have recorded
+# - state changes recorded for the sensors and the switches
+# - whether the sensors' "samples" attributes account for every reading
+#   received in the intervals they covered
+# - CPU usage of this process and event loop lag percentiles
+# Beforehand, it times DownsamplingBuffer.add and checks its min/max/mean
+# against the statistics module.
+
+import argparse
+import asyncio
+import math
+import random
+import resource
+import statistics
+import time
+from datetime import timedelta
+
+import hass_standin
+import component
+from measure import measure_loop_lag, percentile
+from mock_fleet import start_fleet
+
+hass_standin.install()
+switch = component.load('switch')
+sensor = component.load('sensor')
+stats = component.load('stats')
+
+
+def bench_buffer(iterations=200000):
+    buffer = stats.DownsamplingBuffer(interval=1)
+    values = [random.gauss(1000, 50) for _ in range(1000)]
+
+    started = time.perf_counter()
+    for index in range(iterations):
+        buffer.add(values[index % 1000], index / 1000)
+    elapsed = time.perf_counter() - started
+
+    # One reading per millisecond, so the last whole interval holds values
+    low, high, mean, count = buffer.summary(iterations / 1000, 1)
+    expected = (min(values), max(values), statistics.mean(values), len(values))
+    ok = (low, high, count) == expected[:2] + expected[3:] and abs(mean - expected[2]) < 1e-6
+    print('DownsamplingBuffer.add %.0fns per reading, summary matches statistics: %s' % (
+        elapsed / iterations * 1e9, 'ok' if ok else 'FAILED %r != %r' % ((low, high, mean, count), expected)))
+
+
+async def run(hosts, args):
+    loop = asyncio.get_event_loop()
+    hass = hass_standin.FakeHass(loop)
+    for host in hosts:
+        await switch.async_setup_platform(hass, switch.PLATFORM_SCHEMA({
+            'platform': 'sonoff_lan_mode', 'host': host, 'name': host}), hass.async_add_entities)
+        await sensor.async_setup_platform(hass, sensor.PLATFORM_SCHEMA({
+            'platform': 'sonoff_lan_mode', 'host': host, 'name': host,
+            'monitored_conditions': list(sensor.TELEMETRY_TYPES),
+            'scan_interval': timedelta(seconds=args.scan_interval)}), hass.async_add_entities)
+
+    switches = [entity for entity in hass.entities if entity.entity_id.startswith('switch.')]
+    sensors = [entity for entity in hass.entities if entity.entity_id.startswith('sensor.')]
+    while not all(entity.available for entity in switches):
+        await asyncio.sleep(0.05)
+    await asyncio.gather(*[entity.turn_on() for entity in switches])
+
+    sessions = list(hass.data[switch.DATA_MANAGER].sessions.values())
+    buffer_interval = stats.DEFAULT_TELEMETRY_INTERVAL
+
+    # Start polling on an interval boundary, and give the first poll a full
+    # window of readings to summarise
+    now = loop.time()
+    await asyncio.sleep(buffer_interval - now % buffer_interval + args.scan_interval + 0.5)
+
+    lag, stop = [], asyncio.Event()
+    readings = sum(session.metrics.messages_in for session in sessions)
+    switch_writes = hass.state_writes
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_started = usage.ru_utime + usage.ru_stime
+    lag_task = loop.create_task(measure_loop_lag(stop, lag))
+
+    sensor_writes, samples, polls = 0, 0, 0
+    last = {entity: None for entity in sensors}
+    started = loop.time()
+    first_interval = int(started // buffer_interval) - int(math.ceil(args.scan_interval / buffer_interval))
+    while polls * args.scan_interval < args.duration:
+        last_interval = int(loop.time() // buffer_interval) - 1
+        for entity in sensors:
+            await entity.async_update()
+            state = (entity.state, tuple(sorted(entity.device_state_attributes.items())))
+            if state != last[entity]:
+                sensor_writes += 1
+                last[entity] = state
+            samples += entity.device_state_attributes.get(sensor.ATTR_SAMPLES, 0)
+        polls += 1
+        await asyncio.sleep(started + polls * args.scan_interval - loop.time())
+
+    stop.set()
+    await lag_task
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_started
+    elapsed = loop.time() - started
+    readings = sum(session.metrics.messages_in for session in sessions) - readings
+    switch_writes = hass.state_writes - switch_writes
+
+    # Readings in the intervals the polls covered, counted from the buffers
+    covered = 0
+    for session in sessions:
+        for buffer in session.telemetry.values():
+            for number in range(first_interval, last_interval + 1):
+                index = number % len(buffer.numbers)
+                if buffer.numbers[index] == number:
+                    covered += buffer.counts[index]
+
+    # Every update frame carries a power, voltage and current reading
+    readings *= len(sensor.TELEMETRY_TYPES)
+    print('%d devices x %g updates/s over %.0fs: readings received=%d (%.1f/s)' % (
+        len(sessions), args.telemetry, elapsed, readings, readings / elapsed))
+    print('sensor state changes=%d (%.2f/s)  switch state writes=%d  reduction %.0fx' % (
+        sensor_writes, sensor_writes / elapsed, switch_writes,
+        readings / max(1, sensor_writes + switch_writes)))
+    print('samples reported by sensors=%d, readings in the windows polled=%d: %s' % (
+        samples, covered, 'ok' if samples == covered else 'MISMATCH'))
+    print('cpu=%.1f%% loop lag ms p50=%s p99=%s max=%s' % (
+        100 * cpu / elapsed, percentile(lag, 50), percentile(lag, 99), percentile(lag, 100)))
+
+    await hass.async_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--telemetry', type=float, default=1, help='updates (power, voltage and current readings) per second sent by each device')
+    parser.add_argument('--scan-interval', type=float, default=10, help='seconds between sensor polls')
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    bench_buffer()
+
+    fleet, devices = start_fleet(args.devices, '--telemetry', args.telemetry)
+    hosts = [host for _, host in devices]
+    try:
+        asyncio.run(run(hosts, args))
+    finally:
+        fleet.terminate()
+        fleet.wait()
+
+
+if __name__ == '__main__':
+    main()
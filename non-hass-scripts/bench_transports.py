@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# This script compares the latency of the component's transports: the
+# WebSocket protocol of LAN mode, and the HTTP API of DIY mode and v3
+# firmware, with and without pooled keep-alive connections.
+# When executed (e.g. from a terminal with `python bench_transports.py`), for
+# each transport it will start --devices mock devices speaking its protocol
+# (see `mock_fleet.py`), connect to them through the connection manager
+# with the transport chosen automatically, then report:
+# - the transport which was detected, and how long connecting took
+# - command -> confirmation latency percentiles over --commands commands
+# - push latency percentiles, from a device changing state by itself (an
+#   mDNS announcement, for HTTP devices) to its handle being called back
+# - HTTP connections opened, showing what the pool saves
+
+import argparse
+import asyncio
+import logging
+import time
+
+import component
+from measure import summarise
+from mock_fleet import MockDevice
+
+connection = component.load('connection')
+transport = component.load('transport')
+
+
+async def run(name, protocol, pool_size, args):
+    loop = asyncio.get_event_loop()
+    logger = logging.getLogger('bench_transports')
+    manager = connection.SonoffConnectionManager(loop, logger, startup_jitter=0)
+    manager.http_pool.size = pool_size
+
+    pushed = {}
+
+    async def device_update_callback(handle):
+        waiter = pushed.pop(handle, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(loop.time())
+
+    def push_listener(deviceid, params, iv):
+        loop.create_task(manager.async_push_state(deviceid, params, iv))
+
+    devices = [MockDevice('1000%06x' % index, protocol=protocol) for index in range(args.devices)]
+    handles = []
+    started = time.monotonic()
+    for device in devices:
+        device.push_listeners.append(push_listener)
+        host = await device.start()
+        handles.append(manager.async_get_handle(host, device_update_callback, deviceid=device.deviceid))
+
+    while not all(handle.available for handle in handles):
+        await asyncio.sleep(0.01)
+    connect_time = time.monotonic() - started
+    detected = {handle.session.protocol for handle in handles}
+
+    async def command(handle, state):
+        sent = loop.time()
+        sequence = await (handle.turn_on() if state else handle.turn_off())
+        if await handle.async_wait_confirmed(sequence, 5):
+            return loop.time() - sent
+        return None
+
+    latencies, misses = [], 0
+    for index in range(args.commands // len(handles)):
+        results = await asyncio.gather(*[command(handle, index % 2 == 0) for handle in handles])
+        latencies += [latency for latency in results if latency is not None]
+        misses += results.count(None)
+
+    push_latencies = []
+    for _ in range(args.pushes):
+        # Stay under the sessions' update rate limit, which would otherwise
+        # hold back updates on purpose
+        await asyncio.sleep(1.5 / connection.DEFAULT_UPDATE_RATE)
+        waiters = {}
+        for handle, device in zip(handles, devices):
+            waiters[handle] = pushed[handle] = loop.create_future()
+        started = loop.time()
+        await asyncio.gather(*[device.toggle() for device in devices])
+        for waiter in waiters.values():
+            push_latencies.append(await asyncio.wait_for(waiter, 5) - started)
+
+    opened = manager.http_pool.connections_opened
+    await manager.async_stop()
+    for device in devices:
+        await device.stop()
+
+    print('%-15s detected=%-10s connect %.2fs  command %s (misses=%d)  push %s  http connections=%d' % (
+        name, ','.join(sorted(detected)), connect_time, summarise(latencies), misses,
+        summarise(push_latencies), opened))
+
+
+async def main_async(args):
+    await run('websocket', 'websocket', transport.DEFAULT_POOL_SIZE, args)
+    await run('http pooled', 'http', transport.DEFAULT_POOL_SIZE, args)
+    await run('http unpooled', 'http', 0, args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--pushes', type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# This script measures how well the Home Assistant component copes with
+# devices flooding it with updates, with and without inbound rate limiting.
+# When executed (e.g. from a terminal with
+# `python bench_update_storm.py --devices 5 --flood 2000`), it will start
+# `mock_fleet.py` in a subprocess with every device sending --flood updates
+# per second (momentary on/off pulses, or repeats of the same state with
+# --flood-repeat), set up the real switch platform (on the minimal Home
+# Assistant stand-in in `hass_standin.py`) with max_update_rate=0 (no
+# limit, as before rate limiting) and with the default rate, and report for
+# each over --duration seconds:
+# - frames received, and state writes per second
+# - pulses seen (state writes showing a switch on), which must not drop to
+#   zero when updates are coalesced, as every batch of pulses ends off
+# - updates coalesced and frames dropped by the rate limiter
+# - event loop lag percentiles and CPU usage of this process
+
+import argparse
+import asyncio
+import resource
+
+import hass_standin
+import component
+from measure import measure_loop_lag, percentile
+from mock_fleet import start_fleet
+
+hass_standin.install()
+switch = component.load('switch')
+connection = component.load('connection')
+
+
+async def run(hosts, rate, args):
+    loop = asyncio.get_event_loop()
+    hass = hass_standin.FakeHass(loop)
+    for host in hosts:
+        config = switch.PLATFORM_SCHEMA({'platform': 'sonoff_lan_mode', 'host': host, 'name': host,
+                                         'max_update_rate': rate})
+        await switch.async_setup_platform(hass, config, hass.async_add_entities)
+
+    while not all(entity.available for entity in hass.entities):
+        await asyncio.sleep(0.05)
+
+    pulses = 0
+
+    def state_written(entity):
+        nonlocal pulses
+        if entity.is_on:
+            pulses += 1
+
+    hass.state_listeners.append(state_written)
+
+    lag, stop = [], asyncio.Event()
+    sessions = list(hass.data[switch.DATA_MANAGER].sessions.values())
+    frames = sum(session.metrics.messages_in for session in sessions)
+    writes = hass.state_writes
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_started = usage.ru_utime + usage.ru_stime
+
+    lag_task = loop.create_task(measure_loop_lag(stop, lag))
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await lag_task
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_started
+    frames = sum(session.metrics.messages_in for session in sessions) - frames
+    writes = hass.state_writes - writes
+
+    print('max_update_rate=%-4s frames/s=%-7.0f writes/s=%-7.1f pulses seen=%-5d coalesced=%-6d dropped=%-6d '
+          'cpu=%.0f%% loop lag ms p50=%s p99=%s max=%s' % (
+              rate, frames / args.duration, writes / args.duration, pulses,
+              sum(session.metrics.updates_coalesced for session in sessions),
+              sum(session.metrics.frames_dropped for session in sessions),
+              100 * cpu / args.duration, percentile(lag, 50), percentile(lag, 99), percentile(lag, 100)))
+
+    await hass.async_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=5)
+    parser.add_argument('--flood', type=float, default=2000, help='updates per second sent by each device')
+    parser.add_argument('--flood-repeat', action='store_true',
+                        help='flood with repeats of the same state rather than on/off pulses')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    for rate in (0, connection.DEFAULT_UPDATE_RATE):
+        options = ['--flood', args.flood] + (['--flood-repeat'] if args.flood_repeat else [])
+        fleet, devices = start_fleet(args.devices, *options)
+        hosts = [host for _, host in devices]
+        try:
+            asyncio.run(run(hosts, rate, args))
+        finally:
+            fleet.terminate()
+            fleet.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# This script measures how often the event loop driving the Home Assistant
+# component has to wake up to keep a fleet of Sonoff devices connected.
+# When executed (e.g. from a terminal with `python bench_wakeups.py`), it will
+# start N mock devices in a background thread, connect to all of them through
+# the component's connection manager, and report event-loop wakeups per minute
+# both with the shared keepalive timer wheel ("shared") and with one keepalive
+# timer per device ("isolated"), which is how each entity used to behave.
+
+import argparse
+import asyncio
+import logging
+import random
+import selectors
+
+import component
+from mock_fleet import MockFleet
+
+connection = component.load('connection')
+
+
+class CountingSelector(selectors.DefaultSelector):
+    """Selector which counts every time select() returns, i.e. a wakeup."""
+
+    def __init__(self):
+        super().__init__()
+        self.wakeups = 0
+
+    def select(self, timeout=None):
+        events = super().select(timeout)
+        self.wakeups += 1
+        return events
+
+
+async def run(mode, hosts, args, selector):
+    loop = asyncio.get_event_loop()
+    logger = logging.getLogger('bench_wakeups')
+    managers = []
+
+    async def device_update_callback(handle):
+        pass
+
+    for host in hosts:
+        if mode == 'isolated' or not managers:
+            managers.append(connection.SonoffConnectionManager(
+                loop, logger, ping_interval=args.ping_interval,
+                tick=args.ping_interval if mode == 'isolated' else args.tick))
+        managers[-1].async_get_handle(host, device_update_callback)
+        # Devices never all connect in the same instant in real life
+        await asyncio.sleep(random.uniform(0, args.ping_interval) / len(hosts))
+
+    await asyncio.sleep(args.warmup)
+    start_wakeups = selector.wakeups
+    await asyncio.sleep(args.duration)
+    wakeups = selector.wakeups - start_wakeups
+
+    await asyncio.gather(*[manager.async_stop() for manager in managers])
+    return wakeups * 60.0 / args.duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=150)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--ping-interval', type=float, default=30)
+    parser.add_argument('--tick', type=float,
+                        default=connection.DEFAULT_KEEPALIVE_TICK)
+    parser.add_argument('--mode', choices=['shared', 'isolated', 'both'],
+                        default='both')
+    args = parser.parse_args()
+
+    hosts = MockFleet(args.devices).start_in_thread()
+    modes = ['isolated', 'shared'] if args.mode == 'both' else [args.mode]
+
+    for mode in modes:
+        selector = CountingSelector()
+        loop = asyncio.SelectorEventLoop(selector)
+        asyncio.set_event_loop(loop)
+        per_minute = loop.run_until_complete(run(mode, hosts, args, selector))
+        loop.close()
+        print('%-8s devices=%d ping_interval=%ss wakeups/min=%.1f' % (
+            mode, args.devices, args.ping_interval, per_minute))
+
+
+if __name__ == '__main__':
+    main()
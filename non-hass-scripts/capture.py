@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Reading and writing of traffic captures, as recorded by `test_sonoff.py
+# --capture` and played back by `replay.py`.
+# A capture is newline-delimited JSON (gzipped if the file name ends in
+# .gz). The first line is a header recording when the capture started, then
+# every line is either a frame or a connection event, with the seconds since
+# the capture started:
+#   {"t":0.0123,"host":"192.168.0.112:8081","dir":"in","frame":"{...}"}
+#   {"t":5.2,"host":"192.168.0.112:8081","event":"disconnect"}
+# "in" frames were received from the device and "out" frames sent to it,
+# and frames are stored exactly as they were on the wire.
+
+import gzip
+import json
+import time
+
+FORMAT_VERSION = 1
+
+
+def open_capture(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class TrafficCapture:
+    """Appends frames and connection events to a capture file."""
+
+    def __init__(self, path):
+        self.started = time.time()
+        self.frames = 0
+        self._clock = time.monotonic
+        self._monotonic_start = self._clock()
+        self._file = open_capture(path, 'w')
+        self._write({'capture': FORMAT_VERSION, 'started': self.started})
+
+    def frame(self, host, direction, frame):
+        self.frames += 1
+        self._write({'t': self._elapsed(), 'host': host, 'dir': direction, 'frame': frame})
+
+    def event(self, host, event):
+        self._write({'t': self._elapsed(), 'host': host, 'event': event})
+
+    def close(self):
+        self._file.close()
+
+    def _elapsed(self):
+        return round(self._clock() - self._monotonic_start, 4)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def read_capture(path):
+    """Return a capture's header and a list of its records, in time order."""
+    with open_capture(path, 'r') as capture:
+        header = json.loads(capture.readline())
+        if header.get('capture') != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d capture' % (path, FORMAT_VERSION))
+        records = [json.loads(line) for line in capture if line.strip()]
+    records.sort(key=lambda record: record['t'])
+    return header, records
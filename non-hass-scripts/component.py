@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# Helper used by the benchmark scripts in this folder to import modules from
+# the Home Assistant component in the parent directory, without needing Home
+# Assistant installed or the repository checked out under a particular name.
+# The component's own __init__.py is run as the package, so integration() can
+# be used to set up config entries, as Home Assistant does.
+
+import importlib
+import importlib.util
+import os
+import sys
+
+PACKAGE = 'sonoff_lan_mode'
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def integration():
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE, os.path.join(COMPONENT_DIR, '__init__.py'),
+            submodule_search_locations=[COMPONENT_DIR])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE] = package
+        spec.loader.exec_module(package)
+
+    return sys.modules[PACKAGE]
+
+
+def load(module):
+    integration()
+    return importlib.import_module('%s.%s' % (PACKAGE, module))
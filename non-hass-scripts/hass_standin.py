@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+# Minimal stand-in for the parts of Home Assistant that the component imports,
+# so the benchmark scripts in this folder can drive the real HassSonoffSwitch
+# entity without a full Home Assistant install, whether configured in YAML or
+# as config entries.
+# The stand-in is used even if Home Assistant is installed, so benchmark
+# results only ever measure the component itself.
+
+import json
+import os
+import re
+import sys
+import tempfile
+import types
+import uuid
+
+import voluptuous as vol
+
+import component
+
+EVENT_HOMEASSISTANT_STOP = 'homeassistant_stop'
+EVENT_HOMEASSISTANT_FINAL_WRITE = 'homeassistant_final_write'
+
+
+class SwitchDevice:
+    hass = None
+    entity_id = None
+
+    def async_schedule_update_ha_state(self, force_refresh=False):
+        self.hass.async_state_written(self)
+
+
+class Entity:
+    hass = None
+    entity_id = None
+
+
+class FakeBus:
+    def __init__(self):
+        self.listeners = {}
+        self.events = []
+
+    def async_listen_once(self, event_type, listener):
+        self.listeners.setdefault(event_type, []).append(listener)
+
+    def async_fire(self, event_type, event_data=None):
+        self.events.append((event_type, event_data))
+
+
+class FakeServiceCall:
+    def __init__(self, domain, service, data):
+        self.domain = domain
+        self.service = service
+        self.data = data
+
+
+class FakeServices:
+    def __init__(self):
+        self.services = {}
+
+    def has_service(self, domain, service):
+        return (domain, service) in self.services
+
+    def async_register(self, domain, service, service_func, schema=None):
+        self.services[(domain, service)] = (service_func, schema)
+
+    async def async_call(self, domain, service, service_data=None):
+        service_func, schema = self.services[(domain, service)]
+        data = service_data or {}
+        if schema is not None:
+            data = schema(data)
+        await service_func(FakeServiceCall(domain, service, data))
+
+
+class Store:
+    """JSON file in <config_dir>/.storage, saved like Home Assistant's."""
+
+    def __init__(self, hass, version, key):
+        self.hass = hass
+        self.version = version
+        self.path = os.path.join(hass.config_dir, '.storage', key)
+        self.saves = 0
+        self._data_func = None
+        self._timer = None
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_FINAL_WRITE,
+                                   self._async_final_write)
+
+    async def async_load(self):
+        try:
+            with open(self.path) as stored:
+                return json.load(stored)['data']
+        except FileNotFoundError:
+            return None
+
+    def async_delay_save(self, data_func, delay=0):
+        self._data_func = data_func
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.hass.loop.call_later(delay, self._write)
+
+    def _write(self):
+        self._timer = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as stored:
+            json.dump({'version': self.version, 'data': self._data_func()},
+                      stored, separators=(',', ':'))
+        self.saves += 1
+
+    async def _async_final_write(self, event):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._write()
+
+
+async def async_get_zeroconf_instance(hass):
+    """Home Assistant's shared Zeroconf instance, closed when it stops."""
+    if 'zeroconf' not in hass.data:
+        from zeroconf import Zeroconf
+
+        instance = await hass.async_add_executor_job(Zeroconf)
+        hass.data['zeroconf'] = instance
+
+        async def close(event):
+            await hass.async_add_executor_job(instance.close)
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, close)
+    return hass.data['zeroconf']
+
+
+class ConfigEntry:
+    """A config entry, as the integration's config flow would create."""
+
+    def __init__(self, domain, title, data, options=None, unique_id=None):
+        self.entry_id = uuid.uuid4().hex
+        self.domain = domain
+        self.title = title
+        self.data = data
+        self.options = dict(options or {})
+        self.unique_id = unique_id
+        self.update_listeners = []
+
+    def add_update_listener(self, listener):
+        self.update_listeners.append(listener)
+        return lambda: self.update_listeners.remove(listener)
+
+
+class FakeConfigEntries:
+    """Sets config entries up and unloads them with the real integration."""
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.entries = {}
+        self._entities = {}
+        self._component_setup = False
+
+    async def async_add(self, entry):
+        self.entries[entry.entry_id] = entry
+        return await self.async_setup(entry.entry_id)
+
+    async def async_setup(self, entry_id):
+        # Like Home Assistant, the component is set up before its entries,
+        # and can't be without a setup function
+        integration = component.integration()
+        if not self._component_setup:
+            if not hasattr(integration, 'async_setup'):
+                raise RuntimeError('No setup function defined')
+            if not await integration.async_setup(self.hass, {}):
+                return False
+            self._component_setup = True
+        return await integration.async_setup_entry(
+            self.hass, self.entries[entry_id])
+
+    async def async_unload(self, entry_id):
+        return await component.integration().async_unload_entry(
+            self.hass, self.entries[entry_id])
+
+    async def async_remove(self, entry_id):
+        await self.async_unload(entry_id)
+        del self.entries[entry_id]
+
+    async def async_reload(self, entry_id):
+        await self.async_unload(entry_id)
+        return await self.async_setup(entry_id)
+
+    def async_update_entry(self, entry, options):
+        entry.options = dict(options)
+        return [self.hass.async_create_task(listener(self.hass, entry))
+                for listener in list(entry.update_listeners)]
+
+    async def async_forward_entry_setup(self, entry, domain):
+        entities = self._entities.setdefault((entry.entry_id, domain), [])
+
+        def async_add_entities(new_entities, update_before_add=False):
+            entities.extend(new_entities)
+            self.hass.async_add_entities(new_entities)
+
+        await component.load(domain).async_setup_entry(self.hass, entry,
+                                                       async_add_entities)
+        return True
+
+    async def async_forward_entry_unload(self, entry, domain):
+        for entity in self._entities.pop((entry.entry_id, domain), []):
+            self.hass.entities.remove(entity)
+            if hasattr(entity, 'async_will_remove_from_hass'):
+                await entity.async_will_remove_from_hass()
+        return True
+
+
+class FakeHass:
+    """Just enough of the hass object for the component to run."""
+
+    def __init__(self, loop, config_dir=None):
+        self.loop = loop
+        self.config_dir = config_dir or tempfile.mkdtemp()
+        self.data = {}
+        self.bus = FakeBus()
+        self.services = FakeServices()
+        self.config_entries = FakeConfigEntries(self)
+        self.state_writes = 0
+        self.state_listeners = []
+        self.entities = []
+
+    def async_state_written(self, entity):
+        self.state_writes += 1
+        for listener in self.state_listeners:
+            listener(entity)
+
+    def async_create_task(self, target):
+        return self.loop.create_task(target)
+
+    def async_add_executor_job(self, target, *args):
+        return self.loop.run_in_executor(None, target, *args)
+
+    def async_add_entities(self, entities, update_before_add=False):
+        for entity in entities:
+            entity.hass = self
+            entity.entity_id = '%s.%s' % (
+                'sensor' if isinstance(entity, Entity) else 'switch',
+                re.sub(r'[^a-z0-9]+', '_', entity.name.lower()).strip('_'))
+            self.entities.append(entity)
+            if hasattr(entity, 'async_added_to_hass'):
+                self.loop.create_task(entity.async_added_to_hass())
+
+    async def async_stop(self):
+        for event_type in (EVENT_HOMEASSISTANT_STOP,
+                           EVENT_HOMEASSISTANT_FINAL_WRITE):
+            for listener in self.bus.listeners.get(event_type, []):
+                await listener(None)
+
+
+def has_at_least_one_key(*keys):
+    def validate(obj):
+        if not any(key in obj for key in keys):
+            raise vol.Invalid('must contain one of %s' % ', '.join(keys))
+        return obj
+    return validate
+
+
+def ensure_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def install():
+    """Register the stand-in modules, before the component is imported."""
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    module('homeassistant')
+    module('homeassistant.components')
+    module('homeassistant.helpers')
+    module('homeassistant.helpers.storage', Store=Store)
+    module('homeassistant.helpers.config_validation',
+           string=vol.Coerce(str), boolean=vol.Boolean(),
+           positive_int=vol.All(vol.Coerce(int), vol.Range(min=0)),
+           entity_id=vol.Coerce(str),
+           entity_ids=vol.All(ensure_list, [vol.Coerce(str)]),
+           ensure_list=ensure_list,
+           has_at_least_one_key=has_at_least_one_key)
+    module('homeassistant.helpers.entity', Entity=Entity)
+    module('homeassistant.components.sensor',
+           PLATFORM_SCHEMA=vol.Schema({vol.Required('platform'): str},
+                                      extra=vol.ALLOW_EXTRA))
+    module('homeassistant.components.zeroconf',
+           async_get_instance=async_get_zeroconf_instance)
+    module('homeassistant.components.switch',
+           SwitchDevice=SwitchDevice,
+           PLATFORM_SCHEMA=vol.Schema({vol.Required('platform'): str},
+                                      extra=vol.ALLOW_EXTRA))
+    module('homeassistant.const',
+           ATTR_ENTITY_ID='entity_id', CONF_HOST='host', CONF_NAME='name', CONF_ICON='icon',
+           CONF_MONITORED_CONDITIONS='monitored_conditions', CONF_SCAN_INTERVAL='scan_interval',
+           CONF_PLATFORM='platform',
+           EVENT_HOMEASSISTANT_STOP=EVENT_HOMEASSISTANT_STOP)
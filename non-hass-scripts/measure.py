@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# Measurement helpers shared by the benchmark scripts in this folder (and
+# `replay.py --bench`): event loop lag sampling, and percentiles of the
+# samples collected, alone or summarised.
+
+import asyncio
+
+
+def percentile(values, percent):
+    """Return a percentile of durations in seconds, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * len(values))))
+    return round(values[index] * 1000, 2)
+
+
+def summarise(values, percents=(50, 99)):
+    """Format percentiles of durations in seconds, e.g. 'p50=1.2ms'."""
+    return ' '.join('%s=%sms' % ('max' if percent == 100 else 'p%g' % percent,
+                                 percentile(values, percent))
+                    for percent in percents)
+
+
+async def measure_loop_lag(stop, samples, interval=0.01):
+    """Sample how late the event loop wakes up, until stop is set."""
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
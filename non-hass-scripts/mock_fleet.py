@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+# This script can be used to simulate a whole fleet of Sonoff devices in LAN
+# mode, for load and soak testing the Home Assistant component locally.
+# Unlike mock_sonoff.py, which simulates a single device with a thread per
+# client, every device here runs on one asyncio event loop on its own port,
+# and can be given several outlets, response latency and jitter, dropped
+# commands, random disconnects and spontaneous (optionally momentary) toggles,
+# or can flood their clients with updates (momentary on/off pulses, or
+# repeats of their current state, as a device stuck in a reboot loop does).
+# With --telemetry, devices also report power, voltage and current readings
+# that many times a second, as the POW and S31 do.
+# Devices speak the WebSocket protocol of LAN mode by default, or with
+# --protocol http the HTTP API of DIY mode and v3 firmware (POST
+# /zeroconf/switch, /zeroconf/switches and /zeroconf/info, with keep-alive),
+# in which case state changes are passed to the device's push listeners
+# (standing in for mDNS announcements) instead of being sent to clients.
+# HTTP devices given a --devicekey encrypt their payloads as devices paired
+# to an eWeLink account do (AES-128-CBC, needs the cryptography package),
+# and refuse requests which aren't encrypted with that key.
+# When executed (e.g. from a terminal with `python mock_fleet.py --devices 200`),
+# it prints a "deviceid host:port" line per device, then a summary of frames
+# in/out every --stats-interval seconds until stopped with CTRL+C.
+# The MockFleet class can also be used directly from other scripts, and
+# start_fleet() runs this script in a subprocess for them, so the fleet's own
+# work stays off their CPU core.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import websockets
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes)
+except ImportError:
+    Cipher = None
+
+
+def encrypt(key, data):
+    """Return (iv, ciphertext), base64 encoded, as a paired device would."""
+    iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    plaintext = padder.update(json.dumps(data).encode('utf-8')) + \
+        padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+    return (base64.b64encode(iv).decode('ascii'),
+            base64.b64encode(ciphertext).decode('ascii'))
+
+
+def decrypt(key, iv, ciphertext):
+    decryptor = Cipher(algorithms.AES(key),
+                       modes.CBC(base64.b64decode(iv))).decryptor()
+    plaintext = decryptor.update(base64.b64decode(ciphertext)) + \
+        decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return json.loads(unpadder.update(plaintext) + unpadder.finalize())
+
+
+class MockDevice:
+    def __init__(self, deviceid, outlets=0, latency=0.0, jitter=0.0,
+                 drop=0.0, disconnect_interval=0, toggle_interval=0,
+                 momentary=False, flood=0, flood_repeat=False,
+                 telemetry=0, protocol='websocket', devicekey=None,
+                 rng=None):
+        self.deviceid = deviceid
+        self.outlets = outlets
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.disconnect_interval = disconnect_interval
+        self.toggle_interval = toggle_interval
+        self.momentary = momentary
+        self.flood = flood
+        self.flood_repeat = flood_repeat
+        self.telemetry = telemetry
+        self.protocol = protocol
+        self.devicekey = devicekey
+        self.key = None
+        if devicekey is not None:
+            if Cipher is None:
+                raise RuntimeError('--devicekey needs the cryptography '
+                                   'package')
+            self.key = hashlib.md5(devicekey.encode('utf-8')).digest()
+        self.push_listeners = []
+        self.seq = 0
+        self.rng = rng or random.Random()
+
+        if outlets:
+            self.params = {'switches': [{'switch': 'off', 'outlet': outlet}
+                                        for outlet in range(outlets)]}
+        else:
+            self.params = {'switch': 'off'}
+
+        self.host = None
+        self.clients = set()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.disconnects = 0
+        self.flood_frames = 0
+        self.telemetry_frames = 0
+        self.frozen = False
+
+        self._server = None
+        self._tasks = []
+
+    async def start(self, host='127.0.0.1', port=0):
+        if self.protocol == 'http':
+            self._server = await asyncio.start_server(self.http_handler,
+                                                      host, port)
+        else:
+            self._server = await websockets.serve(self.handler, host, port)
+        self.host = '%s:%d' % (host, self._server.sockets[0].getsockname()[1])
+
+        loop = asyncio.get_event_loop()
+        if self.toggle_interval:
+            self._tasks.append(loop.create_task(self._toggle_forever()))
+        if self.disconnect_interval:
+            self._tasks.append(loop.create_task(self._disconnect_forever()))
+        if self.flood:
+            self._tasks.append(loop.create_task(self._flood_forever()))
+        if self.telemetry:
+            self._tasks.append(loop.create_task(self._telemetry_forever()))
+        return self.host
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.frozen or self.protocol == 'http':
+            # A dead device never answers the closing handshake
+            for client in list(self.clients):
+                client.transport.abort()
+            # Let the handlers see their connections go
+            await asyncio.sleep(0)
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handler(self, websocket, path=None):
+        self.clients.add(websocket)
+        if self.frozen:
+            websocket.transport.pause_reading()
+        try:
+            async for message in websocket:
+                self.frames_in += 1
+                await self.on_message(websocket, json.loads(message))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(websocket)
+
+    async def http_handler(self, reader, writer):
+        self.clients.add(writer)
+        if self.frozen:
+            writer.transport.pause_reading()
+        try:
+            while True:
+                request_line = await reader.readuntil(b'\r\n')
+                method, path, _ = request_line.decode('ascii').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readuntil(b'\r\n')
+                    if line == b'\r\n':
+                        break
+                    name, _, value = line.decode('ascii').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+                self.frames_in += 1
+
+                if method != 'POST' or not path.startswith('/zeroconf/'):
+                    # e.g. a WebSocket handshake, which v3 firmware refuses
+                    writer.write(b'HTTP/1.1 404 Not Found\r\n'
+                                 b'Content-Length: 0\r\n'
+                                 b'Connection: close\r\n\r\n')
+                    break
+
+                response = await self.on_request(
+                    path[len('/zeroconf/'):], json.loads(body or b'{}'))
+                if response is None:
+                    continue  # Dropped, the client will time out
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n%s' % (
+                                 len(payload), payload))
+                self.frames_out += 1
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def on_request(self, endpoint, request):
+        if self.drop and endpoint != 'info' and \
+                self.rng.random() < self.drop:
+            self.dropped += 1
+            return None
+
+        await self._delay()
+
+        data = request.get('data', {})
+        if self.key is not None:
+            try:
+                data = decrypt(self.key, request['iv'], data)
+            except (KeyError, TypeError, ValueError):
+                return {'seq': self.seq, 'error': 400}
+
+        if endpoint == 'info':
+            if self.key is not None:
+                iv, params = encrypt(self.key, self.params)
+                return {'seq': self.seq, 'error': 0,
+                        'deviceid': self.deviceid, 'encrypt': True,
+                        'iv': iv, 'data': params}
+            return {'seq': self.seq, 'error': 0, 'deviceid': self.deviceid,
+                    'data': self.params}
+        if endpoint == 'switch' and 'switch' in data or \
+                endpoint == 'switches' and 'switches' in data:
+            self.apply(data)
+            self.push(data)
+            return {'seq': self.seq, 'error': 0}
+        return {'seq': self.seq, 'error': 400}
+
+    def push(self, params):
+        """Announce a state change, as v3 firmware does over mDNS.
+
+        Listeners are called with the device id, the params (or their
+        ciphertext, if encrypted) and the iv (None if not encrypted).
+        """
+        self.seq += 1
+        iv = None
+        if self.key is not None:
+            iv, params = encrypt(self.key, params)
+        for listener in self.push_listeners:
+            listener(self.deviceid, params, iv)
+
+    async def on_message(self, websocket, data):
+        # Commands are dropped, but never the handshake
+        if self.drop and data.get('action') == 'update' and \
+                self.rng.random() < self.drop:
+            self.dropped += 1
+            return
+
+        await self._delay()
+
+        if data.get('action') == 'userOnline':
+            await self.send(websocket, {
+                'error': 0, 'apikey': 'apikey', 'deviceid': self.deviceid,
+                'sequence': data.get('sequence', '')})
+            await self.send(websocket, self.update_frame(self.params))
+
+        elif data.get('action') == 'update':
+            await self.send(websocket, {
+                'error': 0, 'deviceid': self.deviceid,
+                'sequence': data.get('sequence', '')})
+            self.apply(data.get('params', {}))
+            await self.broadcast(self.update_frame(data.get('params', {})))
+
+    def apply(self, params):
+        if 'switch' in params:
+            self.params['switch'] = params['switch']
+        for switch in params.get('switches', ()):
+            for current in self.params.get('switches', ()):
+                if current['outlet'] == switch['outlet']:
+                    current['switch'] = switch['switch']
+
+    def update_frame(self, params):
+        return {'userAgent': 'device', 'apikey': 'apikey',
+                'deviceid': self.deviceid, 'action': 'update',
+                'params': params}
+
+    async def send(self, websocket, payload):
+        """Send a frame, given as a dict or as an already encoded string."""
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        try:
+            await websocket.send(payload)
+            self.frames_out += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def broadcast(self, payload):
+        if self.protocol == 'http':
+            if not isinstance(payload, str):
+                payload = json.dumps(payload)
+            self.push(json.loads(payload)['params'])
+            return
+
+        for websocket in list(self.clients):
+            await self.send(websocket, payload)
+
+    async def toggle(self, outlet=None):
+        """Simulate someone pressing the button on the device."""
+        if self.outlets:
+            outlet = self.rng.randrange(self.outlets) if outlet is None \
+                else outlet
+            current = self.params['switches'][outlet]['switch']
+            state = 'off' if current == 'on' else 'on'
+            params = {'switches': [{'switch': state, 'outlet': outlet}]}
+        else:
+            state = 'off' if self.params['switch'] == 'on' else 'on'
+            params = {'switch': state}
+
+        self.apply(params)
+        await self.broadcast(self.update_frame(params))
+
+        if self.momentary and state == 'on':
+            await asyncio.sleep(1)
+            await self.toggle(outlet)
+
+    def freeze(self):
+        """Simulate the device losing power or dropping off the network.
+
+        Connections are left open but nothing is read from them any more,
+        so pings go unanswered, just as when no FIN ever arrives.
+        """
+        self.frozen = True
+        for task in self._tasks:
+            task.cancel()
+        for websocket in self.clients:
+            websocket.transport.pause_reading()
+
+    async def _delay(self):
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _toggle_forever(self):
+        while True:
+            await asyncio.sleep(self.rng.expovariate(1 / self.toggle_interval))
+            await self.toggle()
+
+    async def _flood_forever(self, tick=0.01):
+        """Send flood frames per second, in batches every tick.
+
+        Pulses are sent as on/off pairs, so the switch always ends up off
+        between batches, like a momentary input being pressed repeatedly.
+        """
+        if self.outlets:
+            pulse = [json.dumps(self.update_frame(
+                {'switches': [{'switch': state, 'outlet': 0}]}))
+                for state in ('on', 'off')]
+            self.apply({'switches': [{'switch': 'off', 'outlet': 0}]})
+        else:
+            pulse = [json.dumps(self.update_frame({'switch': state}))
+                     for state in ('on', 'off')]
+            self.apply({'switch': 'off'})
+
+        batch = max(1, int(round(self.flood * tick / 2)))
+        while True:
+            if self.flood_repeat:
+                frames = [json.dumps(self.update_frame(self.params))] * \
+                    (batch * 2)
+            else:
+                frames = pulse * batch
+            for frame in frames:
+                await self.broadcast(frame)
+            self.flood_frames += len(frames) * len(self.clients)
+            await asyncio.sleep(tick)
+
+    async def _telemetry_forever(self):
+        """Report readings of a 1kW load while switched on."""
+        while True:
+            await asyncio.sleep(1 / self.telemetry)
+            switches = self.params.get('switches') or [self.params]
+            on = any(switch['switch'] == 'on' for switch in switches)
+            voltage = self.rng.gauss(230, 2)
+            power = max(0.0, self.rng.gauss(1000, 50)) if on else 0.0
+            await self.broadcast(self.update_frame({
+                'power': '%.2f' % power, 'voltage': '%.2f' % voltage,
+                'current': '%.2f' % (power / voltage)}))
+            self.telemetry_frames += 1
+
+    async def _disconnect_forever(self):
+        while True:
+            await asyncio.sleep(
+                self.rng.expovariate(1 / self.disconnect_interval))
+            for client in list(self.clients):
+                self.disconnects += 1
+                if self.protocol == 'http':
+                    client.close()
+                else:
+                    await client.close()
+
+
+class MockFleet:
+    def __init__(self, count, seed=None, **device_options):
+        rng = random.Random(seed)
+        self.devices = [
+            MockDevice('1000%06x' % index, rng=random.Random(rng.random()),
+                       **device_options)
+            for index in range(count)]
+
+    @property
+    def hosts(self):
+        return [device.host for device in self.devices]
+
+    async def start(self, host='127.0.0.1', base_port=0):
+        """Start every device, on consecutive ports if base_port is given."""
+        for index, device in enumerate(self.devices):
+            await device.start(host, base_port + index if base_port else 0)
+        return self.hosts
+
+    async def stop(self):
+        await asyncio.gather(*[device.stop() for device in self.devices])
+
+    def start_in_thread(self, host='127.0.0.1', base_port=0):
+        """Run the fleet on its own event loop in a daemon thread.
+
+        Useful for benchmarks, so the fleet's own work doesn't show up in
+        measurements of the event loop under test.
+        """
+        loop = asyncio.new_event_loop()
+        hosts = loop.run_until_complete(self.start(host, base_port))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        return hosts
+
+    def stats(self):
+        return {
+            'frames_in': sum(device.frames_in for device in self.devices),
+            'frames_out': sum(device.frames_out for device in self.devices),
+            'dropped': sum(device.dropped for device in self.devices),
+            'disconnects': sum(device.disconnects
+                               for device in self.devices),
+            'clients': sum(len(device.clients) for device in self.devices),
+            'flood_frames': sum(device.flood_frames
+                                for device in self.devices),
+            'telemetry_frames': sum(device.telemetry_frames
+                                    for device in self.devices),
+        }
+
+
+def start_fleet(count, *arguments):
+    """Run this script in a subprocess with count devices.
+
+    Further command line arguments are passed on as given (stats are only
+    printed hourly, unless they include --stats-interval). Returns the
+    process, to terminate when done, and a (deviceid, host) pair per device.
+    """
+    command = [sys.executable, '-u', os.path.abspath(__file__),
+               '--devices', str(count), '--stats-interval', '3600']
+    fleet = subprocess.Popen(command + [str(arg) for arg in arguments],
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    return fleet, [tuple(fleet.stdout.readline().split())
+                   for _ in range(count)]
+
+
+async def run(args):
+    fleet = MockFleet(
+        args.devices, seed=args.seed, outlets=args.outlets,
+        latency=args.latency, jitter=args.jitter, drop=args.drop,
+        disconnect_interval=args.disconnect_interval,
+        toggle_interval=args.toggle_interval, momentary=args.momentary,
+        flood=args.flood, flood_repeat=args.flood_repeat,
+        telemetry=args.telemetry,
+        protocol=args.protocol, devicekey=args.devicekey)
+    await fleet.start(args.host, args.base_port)
+
+    for device in fleet.devices:
+        print(device.deviceid, device.host)
+
+    try:
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            print('%s %s' % (time.strftime('%H:%M:%S'),
+                             json.dumps(fleet.stats())))
+    finally:
+        await fleet.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=0,
+                        help='first port to use, default is random ports')
+    parser.add_argument('--outlets', type=int, default=0,
+                        help='outlets per device, 0 for single switch '
+                             'devices')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='probability of ignoring an inbound command')
+    parser.add_argument('--disconnect-interval', type=float, default=0,
+                        help='mean seconds between forced disconnects')
+    parser.add_argument('--toggle-interval', type=float, default=0,
+                        help='mean seconds between spontaneous toggles')
+    parser.add_argument('--momentary', action='store_true')
+    parser.add_argument('--flood', type=float, default=0,
+                        help='updates per second to flood each client with')
+    parser.add_argument('--flood-repeat', action='store_true',
+                        help='flood with repeats of the current state '
+                             'rather than on/off pulses')
+    parser.add_argument('--telemetry', type=float, default=0,
+                        help='power readings per second from each device')
+    parser.add_argument('--protocol', choices=['websocket', 'http'],
+                        default='websocket')
+    parser.add_argument('--devicekey',
+                        help='encrypt HTTP payloads with this device key')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--stats-interval', type=float, default=10)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
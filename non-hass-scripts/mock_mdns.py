@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# This script can be used to simulate the mDNS announcements a Sonoff device
+# makes in LAN mode (an "_ewelink._tcp" service with its device id in the "id"
+# TXT record), to test discovery without real hardware.
+# When executed (e.g. from a terminal with
+# `python mock_mdns.py --deviceid 100060af40 --address 127.0.0.1 --port 8081`),
+# it will announce the device until stopped with CTRL+C. With --move-to-port,
+# it will re-announce the device on another port after --move-after seconds,
+# which looks to the component just like a DHCP address change.
+# With --params, it announces a state in the "data1" TXT record, as DIY mode
+# and v3 firmware do, e.g. `--params '{"switch": "on"}'`, encrypted with
+# --devicekey as a device paired to an eWeLink account does.
+
+import argparse
+import hashlib
+import json
+import socket
+import time
+
+from zeroconf import ServiceInfo, Zeroconf
+
+from mock_fleet import encrypt
+
+SERVICE_TYPE = '_ewelink._tcp.local.'
+
+
+class MockMdnsResponder:
+    def __init__(self, interfaces=None):
+        self.zeroconf = Zeroconf(interfaces=interfaces or ['127.0.0.1'])
+        self.services = {}
+
+    def announce(self, deviceid, address, port, params=None, seq=None,
+                 devicekey=None):
+        """Announce a device, replacing any previous announcement of it.
+
+        Devices with HTTP (v3) firmware announce their state (params) too,
+        encrypted if they have a devicekey.
+        """
+        properties = {'id': deviceid, 'txtvers': '1', 'type': 'plug'}
+        if params is not None and devicekey is not None:
+            iv, data = encrypt(
+                hashlib.md5(devicekey.encode('utf-8')).digest(), params)
+            # TXT record strings are limited to 255 bytes
+            properties.update({'encrypt': 'true', 'iv': iv,
+                               'seq': str(seq or 1)})
+            for index in range(0, len(data), 249):
+                properties['data%d' % (index // 249 + 1)] = \
+                    data[index:index + 249]
+        elif params is not None:
+            properties.update({'type': 'diy_plug', 'encrypt': 'false',
+                               'seq': str(seq or 1),
+                               'data1': json.dumps(params)})
+
+        info = ServiceInfo(
+            SERVICE_TYPE,
+            'eWeLink_%s.%s' % (deviceid, SERVICE_TYPE),
+            addresses=[socket.inet_aton(address)],
+            port=port,
+            properties=properties,
+            server='eWeLink_%s.local.' % deviceid)
+
+        if deviceid in self.services:
+            self.zeroconf.update_service(info)
+        else:
+            self.zeroconf.register_service(info)
+        self.services[deviceid] = info
+
+    def close(self):
+        for info in self.services.values():
+            self.zeroconf.unregister_service(info)
+        self.zeroconf.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--deviceid', default='100060af40')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--move-to-port', type=int)
+    parser.add_argument('--move-after', type=float, default=30)
+    parser.add_argument('--params', type=json.loads,
+                        help='state to announce as JSON, for v3 firmware')
+    parser.add_argument('--devicekey',
+                        help='encrypt the announced state with this key')
+    args = parser.parse_args()
+
+    responder = MockMdnsResponder()
+    try:
+        responder.announce(args.deviceid, args.address, args.port,
+                           args.params, devicekey=args.devicekey)
+        print('Announced %s at %s:%d' % (args.deviceid, args.address,
+                                         args.port))
+
+        if args.move_to_port:
+            time.sleep(args.move_after)
+            responder.announce(args.deviceid, args.address, args.move_to_port,
+                               args.params, devicekey=args.devicekey)
+            print('Moved %s to %s:%d' % (args.deviceid, args.address,
+                                         args.move_to_port))
+
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        responder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -32,7 +32,42 @@ class MockWebsocketServer(WebsocketServer):
         self.port = self.socket.getsockname()[1]
 
 
+def unmask(payload, mask):
+    """XOR a frame's payload with its 4 byte masking key.
+
+    Rather than a byte at a time, the payload and the key (repeated to the
+    payload's length) are each read as one big integer and XORed in a single
+    operation, which runs word by word in C.
+    """
+    length = len(payload)
+    if not length:
+        return b''
+    key = (bytes(mask) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'little') ^
+            int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+
 class MockWebSocketHandler(WebSocketHandler):
+    def setup(self):
+        super().setup()
+        # Payloads are read into one reusable buffer, grown as needed
+        self._buffer = bytearray(4096)
+        self._fragments = []
+        self._fragments_opcode = None
+
+    def read_payload(self, length):
+        """Read a payload into the reusable buffer, returning a view of it."""
+        if len(self._buffer) < length:
+            self._buffer = bytearray(max(length, len(self._buffer) * 2))
+        view = memoryview(self._buffer)[:length]
+        read = 0
+        while read < length:
+            count = self.rfile.readinto(view[read:])
+            if not count:
+                raise ValueError('Connection closed mid-frame')
+            read += count
+        return view
+
     def read_next_message(self):
         logger = logging.getLogger()
         try:
@@ -61,19 +96,20 @@ class MockWebSocketHandler(WebSocketHandler):
             self.keep_alive = 0
             return
         if opcode == OPCODE_CONTINUATION:
-            logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warn("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
+            if self._fragments_opcode is None:
+                logger.warn("Continuation frame without a message to "
+                            "continue.")
+                self.keep_alive = 0
+                return
+        elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self._fragments_opcode is not None:
+                logger.warn("New message before the last one was finished.")
+                self.keep_alive = 0
+                return
         elif opcode == OPCODE_PING:
             logger.info("Ping received!")
-            opcode_handler = self.server._ping_received_
         elif opcode == OPCODE_PONG:
             logger.info("Pong received!")
-            opcode_handler = self.server._pong_received_
         else:
             logger.warn("Unknown opcode %#x." % opcode)
             self.keep_alive = 0
@@ -85,11 +121,34 @@ class MockWebSocketHandler(WebSocketHandler):
             payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
 
         masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8', 'ignore'))
+        try:
+            payload = unmask(self.read_payload(payload_length), masks)
+        except ValueError:
+            self.keep_alive = 0
+            return
+
+        # Control frames may arrive between the fragments of a message
+        if opcode == OPCODE_PING:
+            self.server._ping_received_(self, payload.decode('utf8', 'ignore'))
+            return
+        if opcode == OPCODE_PONG:
+            self.server._pong_received_(self, payload.decode('utf8', 'ignore'))
+            return
+
+        if not fin:
+            if opcode != OPCODE_CONTINUATION:
+                self._fragments_opcode = opcode
+            self._fragments.append(payload)
+            return
+        if self._fragments:
+            self._fragments.append(payload)
+            payload = b''.join(self._fragments)
+            self._fragments = []
+            self._fragments_opcode = None
+
+        # Binary messages are passed on as text too, as the mock only
+        # speaks JSON
+        self.server._message_received_(self, payload.decode('utf8', 'ignore'))
 
 
 class MockSonoff:
@@ -249,7 +308,7 @@ class MockSonoff:
                     'class': 'logging.handlers.RotatingFileHandler',
                     'formatter': 'default',
                     'filename': log_path,
-                    'maxBytes': 10000,
+                    'maxBytes': 10000000,
                     'backupCount': 3
                 }
             },
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# This script plays back a traffic capture (recorded with
+# `test_sonoff.py --capture`) through mock devices, to reproduce a device's
+# or a whole network's behaviour (e.g. reconnect floods or storms of
+# duplicate updates) offline.
+# When executed (e.g. from a terminal with `python replay.py capture.ndjson.gz`),
+# it will start a mock device (see `mock_fleet.py`) for every host in the
+# capture and print the address it is listening on, wait for a client to
+# connect to each, then send the frames the real devices sent, and drop
+# connections where the real devices did, at the original pace (or --speed
+# times faster, or as fast as possible with --speed 0). The mock devices
+# still answer commands from clients as usual.
+# With --bench, it will instead set up the real switch platform (on the
+# minimal Home Assistant stand-in in `hass_standin.py`) against the mock
+# devices itself, and report how the component coped with the replay:
+# state writes made and suppressed, reconnects and event loop lag.
+
+import argparse
+import asyncio
+import json
+import time
+
+from capture import read_capture
+from measure import measure_loop_lag, percentile
+from mock_fleet import MockDevice
+
+
+class CaptureReplayer:
+    def __init__(self, records, speed=1.0):
+        self.records = records
+        self.speed = speed
+        self.frames = 0
+        self.disconnects = 0
+
+        hosts = {}
+        for record in records:
+            if record.get('dir') == 'out':
+                continue
+            deviceid = hosts.get(record['host'])
+            if deviceid is None and 'frame' in record:
+                deviceid = json.loads(record['frame']).get('deviceid')
+            hosts[record['host']] = deviceid
+
+        self.devices = {host: MockDevice(deviceid or 'replay%04x' % index)
+                        for index, (host, deviceid) in enumerate(sorted(hosts.items()))}
+
+    async def start(self, host='127.0.0.1'):
+        """Start a mock device per captured host, returning captured host -> mock host."""
+        for device in self.devices.values():
+            await device.start(host)
+        return {captured: device.host for captured, device in self.devices.items()}
+
+    async def stop(self):
+        await asyncio.gather(*[device.stop() for device in self.devices.values()])
+
+    async def wait_for_clients(self, timeout):
+        started = time.monotonic()
+        while not all(device.clients for device in self.devices.values()):
+            if time.monotonic() - started > timeout:
+                raise RuntimeError('Not every mock device had a client connect')
+            await asyncio.sleep(0.05)
+
+    async def replay(self):
+        """Play the capture back, returning how long it took."""
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+
+        for record in self.records:
+            if self.speed:
+                delay = started + record['t'] / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            device = self.devices.get(record['host'])
+            if device is None:
+                continue
+
+            if record.get('dir') == 'in':
+                frame = record['frame']
+                data = json.loads(frame)
+                if data.get('action') == 'update':
+                    device.apply(data.get('params', {}))
+                self.frames += 1
+                await device.broadcast(frame)
+
+            elif record.get('event') == 'disconnect':
+                self.disconnects += 1
+                await asyncio.gather(*[websocket.close() for websocket in list(device.clients)])
+
+        return loop.time() - started
+
+
+async def bench(replayer, hosts, args):
+    import hass_standin
+    import component
+
+    hass_standin.install()
+    switch = component.load('switch')
+
+    loop = asyncio.get_event_loop()
+    hass = hass_standin.FakeHass(loop)
+    for host in hosts:
+        config = switch.PLATFORM_SCHEMA({'platform': 'sonoff_lan_mode', 'host': host, 'name': host})
+        await switch.async_setup_platform(hass, config, hass.async_add_entities)
+
+    await replayer.wait_for_clients(args.timeout)
+    while not all(entity.available for entity in hass.entities):
+        await asyncio.sleep(0.05)
+
+    lag, stop = [], asyncio.Event()
+    lag_task = loop.create_task(measure_loop_lag(stop, lag))
+    writes = hass.state_writes
+    elapsed = await replayer.replay()
+    # Let the last frames, and any reconnections, settle
+    await asyncio.sleep(args.settle)
+    stop.set()
+    await lag_task
+
+    manager = hass.data[switch.DATA_MANAGER]
+    print('replayed %d frames and %d disconnects in %.2fs' % (replayer.frames, replayer.disconnects, elapsed))
+    print('state writes=%d suppressed=%d reconnects=%d' % (
+        hass.state_writes - writes,
+        sum(entity.device_state_attributes[switch.ATTR_SUPPRESSED_WRITES] for entity in hass.entities),
+        sum(session.metrics.reconnects for session in manager.sessions.values())))
+    print('loop lag ms p50=%s p99=%s max=%s' % (percentile(lag, 50), percentile(lag, 99), percentile(lag, 100)))
+
+    await hass.async_stop()
+
+
+async def run(args):
+    header, records = read_capture(args.capture)
+    replayer = CaptureReplayer(records, args.speed)
+    hosts = await replayer.start(args.host)
+    print('%d frames from %d hosts, captured at %s' % (
+        sum(1 for record in records if 'frame' in record), len(hosts),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['started']))))
+
+    try:
+        if args.bench:
+            await bench(replayer, list(hosts.values()), args)
+        else:
+            for captured, host in hosts.items():
+                print('%s -> %s' % (captured, host))
+            await replayer.wait_for_clients(args.timeout)
+            elapsed = await replayer.replay()
+            print('replayed %d frames and %d disconnects in %.2fs' % (replayer.frames, replayer.disconnects, elapsed))
+    finally:
+        await replayer.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', help='capture file recorded with test_sonoff.py --capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='playback speed, e.g. 10 for ten times faster, or 0 for as fast as possible')
+    parser.add_argument('--host', default='127.0.0.1', help='address for the mock devices to listen on')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for clients to connect')
+    parser.add_argument('--bench', action='store_true', help='replay against the real switch platform and report')
+    parser.add_argument('--settle', type=float, default=2,
+                        help='seconds to keep measuring after the replay with --bench')
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
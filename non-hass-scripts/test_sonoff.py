@@ -1,116 +1,167 @@
 #!/usr/bin/env python3
 
-# This script can be used to test 2-way communication with a Sonoff device in LAN mode.
+# This script can be used to test 2-way communication with Sonoff devices in LAN mode.
 # When executed (e.g. from a terminal with `python test_sonoff.py`), it will open a WebSocket connection on port 8081
-# to the device on the IP address you specify below, simulating the eWeLink mobile app.
+# to the device on the IP address you specify below, simulating the eWeLink mobile app, and log its updates until
+# stopped with CTRL+C.
 # Any messages sent to or received by the device are logged to the log file 'test_sonoff.log' for further research.
+#
+# Several devices can be given on the command line instead (e.g. `python test_sonoff.py 192.168.0.112 192.168.0.113`),
+# or a whole subnet probed for devices (e.g. `python test_sonoff.py --subnet 192.168.0.0/24`). Every connection runs on
+# one asyncio event loop in a single thread, so a subnet of plugs is probed in seconds. Use --command on/off/toggle
+# to switch every device found (or --deviceid to pick one, and --outlet for one outlet of a multi-outlet device), and
+# --duration to stop after a number of seconds. A table of timings per device (connect, first update and command
+# round trip) is printed when the script stops.
+# With --capture, every frame sent and received is also recorded with its timestamp to a capture file (see
+# `capture.py`), which `replay.py` can play back through mock devices.
 
 SONOFF_LAN_IP = "localhost"  # Replace with the IP address of the Sonoff you want to test, e.g. "192.168.0.112"
+SONOFF_LAN_PORT = 8081
 LOG_LEVEL = "DEBUG"
 
+import argparse
+import asyncio
+import ipaddress
 import json
-import random
-import threading
-import time
 import logging
 import logging.config
-import websocket
-
-
-class Sonoff:
-    def __init__(self):
-        self.logger = self.configure_logger('default', 'test_sonoff.log')
-
-        self.logger.debug('Sonoff class initialising')
-
-        self._wshost = SONOFF_LAN_IP
-        self._wsport = "8081"
-        self._wsendpoint = "/"
-
-        self._ws = None
-        self._devices = []
-
-        self.thread = threading.Thread(target=self.init_websocket(self.logger))
-        self.thread.daemon = False
-        self.thread.start()
-
-    # Listen for state updates from HASS and update the device accordingly
-    async def state_listener(self, event):
-        if not self.get_ws().connected:
-            self.logger.error('websocket is not connected')
-            return
-
-        self.logger.debug('received state event change from: %s' % event.data['deviceid'])
-
-        new_state = event.data['state']
+import random
+import time
 
-        # convert from True/False to on/off
-        if isinstance(new_state, (bool)):
-            new_state = 'on' if new_state else 'off'
+import websockets
 
-        device = self.get_device(event.data['deviceid'])
-        outlet = event.data['outlet']
+from capture import TrafficCapture
 
-        if outlet is not None:
-            self.logger.info("Switching `%s - %s` on outlet %d to state: %s", device['deviceid'], device['name'],
-                             (outlet + 1), new_state)
-        else:
-            self.logger.info("Switching `%s` to state: %s", device['deviceid'], new_state)
 
-        if not device:
-            self.logger.error('unknown device to be updated')
-            return False
+class DeviceRegistry:
+    """Known devices keyed by deviceid, each with a slot per outlet.
 
-        if outlet is not None:
-            params = {'switches': device['params']['switches']}
-            params['switches'][outlet]['switch'] = new_state
+    Finding a device, merging an update into it and switching one of its outlets all cost the same however many devices
+    a client is talking to. Update params are merged into the device's params in place, and each entry of
+    params['switches'] is the outlet's slot, updated in place too, so a partial update (e.g. of a single outlet) never
+    loses the state of the others.
+    """
 
+    def __init__(self):
+        self._devices = {}
+        self._outlets = {}
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, deviceid):
+        return deviceid in self._devices
+
+    def get(self, deviceid):
+        return self._devices.get(deviceid)
+
+    def devices(self):
+        return self._devices.values()
+
+    def update(self, data):
+        """Merge a frame from a device into its entry, adding it if new.
+
+        Returns the device and a list of (outlet, state) for every switch whose state changed, with outlet None for
+        single-outlet devices.
+        """
+        deviceid = data['deviceid']
+        device = self._devices.get(deviceid)
+        if device is None:
+            device = self._devices[deviceid] = {'params': {}}
+            self._outlets[deviceid] = {}
+
+        for key, value in data.items():
+            if key != 'params':
+                device[key] = value
+
+        params = device['params']
+        outlets = self._outlets[deviceid]
+        changed = []
+
+        for key, value in data.get('params', {}).items():
+            if key == 'switches':
+                for switch in value:
+                    slot = outlets.get(switch['outlet'])
+                    if slot is None:
+                        slot = outlets[switch['outlet']] = dict(switch)
+                        params.setdefault('switches', []).append(slot)
+                    elif slot['switch'] == switch['switch']:
+                        continue
+                    slot['switch'] = switch['switch']
+                    changed.append((switch['outlet'], switch['switch']))
+            else:
+                if key == 'switch' and params.get('switch') != value:
+                    changed.append((None, value))
+                params[key] = value
+
+        return device, changed
+
+    def set_switch(self, deviceid, state, outlet=None):
+        """Record the state a device's switch (or one of its outlets) was just set to."""
+        if outlet is None:
+            self._devices[deviceid]['params']['switch'] = state
         else:
-            params = {'switch': new_state}
+            self._outlets[deviceid][outlet]['switch'] = state
+
+
+def user_online_payload():
+    return {
+        'action': "userOnline",
+        'userAgent': 'app',
+        'version': 6,
+        'nonce': ''.join([str(random.randint(0, 9)) for i in range(15)]),
+        'apkVesrion': "1.8",
+        'os': 'ios',
+        'at': 'at',  # No bearer token needed in LAN mode
+        'apikey': 'apikey',  # No apikey needed in LAN mode
+        'ts': str(int(time.time())),
+        'model': 'iPhone10,6',
+        'romVersion': '11.1.2',
+        'sequence': str(time.time()).replace('.', '')
+    }
+
+
+def update_payload(deviceid, params, sequence, control_type=4):
+    return {
+        'action': 'update',
+        'userAgent': 'app',
+        'params': params,
+        'apikey': 'apikey',  # No apikey needed in LAN mode
+        'deviceid': str(deviceid),
+        'sequence': sequence,
+        'controlType': control_type,
+        'ts': 0
+    }
 
-        payload = {
-            'action': 'update',
-            'userAgent': 'app',
-            'params': params,
-            'apikey': 'apikey',  # No apikey needed in LAN mode
-            'deviceid': str(device['deviceid']),
-            'sequence': str(time.time()).replace('.', ''),
-            'controlType': device['params']['controlType'] if 'controlType' in device['params'] else 4,
-            'ts': 0
-        }
 
-        self.logger.debug('sending state update websocket msg: %s', json.dumps(payload))
+class Sonoff:
+    """Talks to any number of devices at once, from a single asyncio event loop."""
 
-        self.get_ws().send(json.dumps(payload))
+    def __init__(self, hosts, logger, capture=None):
+        self.logger = logger
+        self.logger.debug('Sonoff class initialising')
 
-        # set also the pseudo-internal state of the device until the real refresh kicks in
-        for idxd, dev in enumerate(self._devices):
-            if dev['deviceid'] == device['deviceid']:
-                if outlet is not None:
-                    self._devices[idxd]['params']['switches'][outlet]['switch'] = new_state
-                else:
-                    self._devices[idxd]['params']['switch'] = new_state
+        self.capture = capture
 
-    def init_websocket(self, logger):
-        self.logger = logger
-        self.logger.debug('initializing websocket')
+        self._devices = DeviceRegistry()
+        self._connections = [DeviceConnection(self, host) for host in hosts]
+        self._by_deviceid = {}
 
-        self._ws = WebsocketListener(sonoff=self, on_message=self.on_message, on_error=self.on_error)
+    async def connect(self, concurrency, timeout):
+        """Connect to every host, returning once each has sent its first update or failed."""
+        semaphore = asyncio.Semaphore(concurrency)
+        for connection in self._connections:
+            connection.start(semaphore, timeout)
 
-        try:
-            # 145 interval is defined by the first websocket response after login
-            self._ws.run_forever(ping_interval=145)
-        except:
-            self.logger.error('websocket error occurred, shutting down')
-        finally:
-            self._ws.close()
+        await asyncio.gather(*[connection.ready.wait() for connection in self._connections])
 
-    def on_message(self, *args):
-        data = args[-1]  # to accommodate the weird behaviour where the function receives 2 or 3 args
+    async def close(self):
+        await asyncio.gather(*[connection.close() for connection in self._connections])
 
-        self.logger.debug('received websocket msg: %s', data)
+    def on_message(self, message, connection=None):
+        self.logger.debug('received websocket msg: %s', message)
 
-        data = json.loads(data)
+        data = json.loads(message)
 
         if 'action' in data:
             self.logger.info('received action: %s', data['action'])
@@ -120,159 +171,306 @@ class Sonoff:
                 if 'switch' in data['params'] or 'switches' in data['params']:
                     self.logger.debug('found switch/switches in websocket update msg')
 
-                    self.logger.debug(
-                        'searching for deviceid: {} in known devices {}'.format(self._devices.__str__(),
-                                                                                data['deviceid'])
-                    )
-
-                    found_device = False
-                    for idx, device in enumerate(self._devices):
-                        if device['deviceid'] == data['deviceid']:
-                            self._devices[idx]['params'] = data['params']
-                            found_device = True
+                    if data['deviceid'] not in self._devices:
+                        self.logger.debug('device %s not found in %d known devices, adding', data['deviceid'],
+                                          len(self._devices))
+                        if connection is not None:
+                            self._by_deviceid[data['deviceid']] = connection
 
-                            if 'switches' in data['params']:
-                                for switch in data['params']['switches']:
-                                    self.set_entity_state(data['deviceid'], data['params']['switch'], switch['outlet'])
-                            else:
-                                self.set_entity_state(data['deviceid'], data['params']['switch'])
+                    device, changed = self._devices.update(data)
 
-                            break
-
-                    if not found_device:
-                        self.logger.debug('device not found in known devices, adding')
-                        self.add_device(data)
+                    for outlet, state in changed:
+                        self.set_entity_state(data['deviceid'], state, outlet)
 
         elif 'deviceid' in data:
             self.logger.debug('received hello from deviceid: %s, no action required', data['deviceid'])
 
-    def on_error(self, *args):
-        error = args[-1]  # to accommodate the case when the function receives 2 or 3 args
-        self.logger.error('websocket error: %s' % str(error))
+        return data
+
+    async def set_state(self, deviceid, new_state, outlet=None, timeout=5):
+        """Switch a device (or one outlet of it), returning the round trip time, or None if it didn't confirm."""
+        device = self.get_device(deviceid)
+        connection = self._by_deviceid.get(deviceid)
+
+        if not device or connection is None:
+            self.logger.error('unknown device to be updated')
+            return None
+
+        # convert from True/False to on/off
+        if isinstance(new_state, (bool)):
+            new_state = 'on' if new_state else 'off'
+
+        if outlet is not None:
+            self.logger.info("Switching `%s - %s` on outlet %d to state: %s", device['deviceid'], device.get('name'),
+                             (outlet + 1), new_state)
+            params = {'switches': [{'switch': new_state if slot['outlet'] == outlet else slot['switch'],
+                                    'outlet': slot['outlet']}
+                                   for slot in device['params']['switches']]}
+        else:
+            self.logger.info("Switching `%s` to state: %s", device['deviceid'], new_state)
+            params = {'switch': new_state}
+
+        latency = await connection.send_update(params, device['params'].get('controlType', 4), timeout)
+
+        # set also the pseudo-internal state of the device until the real refresh kicks in
+        self._devices.set_switch(deviceid, new_state, outlet)
+        return latency
+
+    def get_state(self, deviceid, outlet=None):
+        device = self.get_device(deviceid)
+        if outlet is None:
+            return device['params'].get('switch')
+        return next((slot['switch'] for slot in device['params'].get('switches', ()) if slot['outlet'] == outlet),
+                    None)
 
     def set_entity_state(self, deviceid, state, outlet=None):
         entity_id = 'switch.%s%s' % (deviceid, '_' + str(outlet + 1) if outlet is not None else '')
         self.logger.info("Success! TODO: update HASS state for entity: `%s` to state: %s", entity_id, state)
 
     def add_device(self, device):
-        self._devices.append(device)
+        self._devices.update(device)
         return self._devices
 
     def get_devices(self):
-        return self._devices
+        return list(self._devices.devices())
 
     def get_device(self, deviceid):
-        for device in self.get_devices():
-            if 'deviceid' in device and device['deviceid'] == deviceid:
-                return device
+        return self._devices.get(deviceid)
+
+    def summary(self):
+        """Return a table of timings for every host which was connected to."""
+        lines = ['%-22s %-12s %10s %12s %8s %14s %8s' % ('host', 'deviceid', 'connect ms', 'first upd ms', 'updates',
+                                                        'cmd mean ms', 'misses')]
+        for connection in self._connections:
+            if connection.connect_time is None:
+                continue
+            latencies = connection.command_latencies
+            lines.append('%-22s %-12s %10.1f %12s %8d %14s %8d' % (
+                connection.host, connection.deviceid or '-', connection.connect_time * 1000,
+                '-' if connection.first_update_time is None else '%.1f' % (connection.first_update_time * 1000),
+                connection.updates,
+                '-' if not latencies else '%.1f' % (sum(latencies) / len(latencies) * 1000),
+                connection.command_misses))
+        return '\n'.join(lines)
+
+
+class DeviceConnection:
+    """The WebSocket connection to one device, with its timings."""
+
+    def __init__(self, sonoff, host):
+        self.logger = sonoff.logger
+        self._sonoff = sonoff
+        self._capture = sonoff.capture
 
-    def get_ws(self):
-        return self._ws
+        self.host = host if ':' in host else '%s:%d' % (host, SONOFF_LAN_PORT)
+        self.deviceid = None
+        self.ready = asyncio.Event()
+        self.connect_time = None
+        self.first_update_time = None
+        self.updates = 0
+        self.command_latencies = []
+        self.command_misses = 0
 
-    def get_wshost(self):
-        return self._wshost
+        self._ws = None
+        self._task = None
+        self._last_sequence = 0
+        self._pending = {}
 
-    def get_wsport(self):
-        return self._wsport
+    def start(self, semaphore, timeout):
+        self._task = asyncio.get_event_loop().create_task(self.run(semaphore, timeout))
 
-    def get_wsendpoint(self):
-        return self._wsendpoint
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
-    def configure_logger(self, name, log_path):
-        logging.config.dictConfig({
-            'version': 1,
-            'formatters': {
-                'default': {'format': '%(asctime)s - %(levelname)s - %(message)s', 'datefmt': '%Y-%m-%d %H:%M:%S'}
-            },
-            'handlers': {
-                'console': {
-                    'level': 'DEBUG',
-                    'class': 'logging.StreamHandler',
-                    'formatter': 'default',
-                    'stream': 'ext://sys.stdout'
-                },
-                'file': {
-                    'level': 'DEBUG',
-                    'class': 'logging.handlers.RotatingFileHandler',
-                    'formatter': 'default',
-                    'filename': log_path,
-                    'maxBytes': 10000,
-                    'backupCount': 3
-                }
-            },
-            'loggers': {
-                'default': {
-                    'level': LOG_LEVEL,
-                    'handlers': ['console', 'file']
-                }
-            },
-            'disable_existing_loggers': False
-        })
-        return logging.getLogger(name)
+    async def run(self, semaphore, timeout):
+        websocket_host = 'ws://{}/'.format(self.host)
+        started = time.monotonic()
 
+        try:
+            async with semaphore:
+                self.logger.debug('connecting to host: %s' % websocket_host)
+                # 145 interval is defined by the first websocket response after login
+                self._ws = await asyncio.wait_for(websockets.connect(websocket_host, ping_interval=145), timeout)
+        except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as ex:
+            self.logger.debug('could not connect to %s: %s', self.host, ex)
+            self.ready.set()
+            return
 
-class WebsocketListener(threading.Thread, websocket.WebSocketApp):
-    def __init__(self, sonoff, on_message=None, on_error=None):
-        self.logger = sonoff.logger
-        self._sonoff = sonoff
+        self.connect_time = time.monotonic() - started
+        self.logger.info('connected to %s in %.3fs', self.host, self.connect_time)
+        if self._capture is not None:
+            self._capture.event(self.host, 'connect')
 
-        websocket_host = 'ws://{}:{}{}'.format(self._sonoff.get_wshost(),
-                                               self._sonoff.get_wsport(),
-                                               self._sonoff.get_wsendpoint())
-
-        self.logger.info('WebsocketListener initialising, connecting to host: %s' % websocket_host)
-
-        threading.Thread.__init__(self)
-        websocket.WebSocketApp.__init__(self, websocket_host,
-                                        on_open=self.on_open,
-                                        on_error=on_error,
-                                        on_message=on_message,
-                                        on_close=self.on_close)
-
-        self.connected = False
-        self.last_update = time.time()
-
-    def on_open(self, *args):
-        self.connected = True
-        self.last_update = time.time()
-
-        payload = {
-            'action': "userOnline",
-            'userAgent': 'app',
-            'version': 6,
-            'nonce': ''.join([str(random.randint(0, 9)) for i in range(15)]),
-            'apkVesrion': "1.8",
-            'os': 'ios',
-            'at': 'at',  # No bearer token needed in LAN mode
-            'apikey': 'apikey',  # No apikey needed in LAN mode
-            'ts': str(int(time.time())),
-            'model': 'iPhone10,6',
-            'romVersion': '11.1.2',
-            'sequence': str(time.time()).replace('.', '')
-        }
-
-        self.logger.debug('sending user online websocket msg: %s', json.dumps(payload))
-
-        self.send(json.dumps(payload))
-
-    def on_close(self, *args):
-        self.logger.debug('websocket closed')
-        self.connected = False
-
-    def run_forever(self, sockopt=None, sslopt=None, ping_interval=5, ping_timeout=None,
-                    http_proxy_host=None, http_proxy_port=None,
-                    http_no_proxy=None, http_proxy_auth=None,
-                    skip_utf8_validation=False,
-                    host=None, origin=None, dispatcher=None,
-                    suppress_origin=False, proxy_type=None):
-        self.logger.debug('attempting to call WebSocketApp run_forever with ping_interval: {}'.format(ping_interval))
-
-        websocket.WebSocketApp.run_forever(self,
-                                           sockopt=sockopt,
-                                           sslopt=sslopt,
-                                           ping_interval=ping_interval,
-                                           ping_timeout=ping_timeout)
+        try:
+            payload = json.dumps(user_online_payload())
+            self.logger.debug('sending user online websocket msg: %s', payload)
+            await self.send(payload)
+
+            # Devices answer userOnline with their current state, but don't wait on one which doesn't for ever
+            asyncio.get_event_loop().call_later(timeout, self.ready.set)
+
+            async for message in self._ws:
+                if self._capture is not None:
+                    self._capture.frame(self.host, 'in', message)
+                self.on_message(message, started)
+        except websockets.exceptions.ConnectionClosed as ex:
+            self.logger.error('websocket to %s closed: %s', self.host, ex)
+        finally:
+            self.ready.set()
+            for future, _ in self._pending.values():
+                future.cancel()
+            if self._capture is not None:
+                self._capture.event(self.host, 'disconnect')
+            await self._ws.close()
+
+    async def send(self, payload):
+        if self._capture is not None:
+            self._capture.frame(self.host, 'out', payload)
+        await self._ws.send(payload)
+
+    def on_message(self, message, started):
+        data = self._sonoff.on_message(message, self)
+
+        if self.deviceid is None and 'deviceid' in data:
+            self.deviceid = data['deviceid']
+
+        if data.get('action') == 'update':
+            self.updates += 1
+            if self.first_update_time is None:
+                self.first_update_time = time.monotonic() - started
+                self.ready.set()
+
+        elif 'sequence' in data and data['sequence'] in self._pending:
+            future, sent = self._pending.pop(data['sequence'])
+            if not future.done():
+                future.set_result(time.monotonic() - sent)
+
+    async def send_update(self, params, control_type=4, timeout=5):
+        """Send an update frame, returning the time until the device acknowledged it, or None if it didn't."""
+        sequence = max(int(time.time() * 1000), self._last_sequence + 1)
+        self._last_sequence = sequence
+        sequence = str(sequence)
+
+        payload = json.dumps(update_payload(self.deviceid, params, sequence, control_type))
+        future = asyncio.get_event_loop().create_future()
+        self._pending[sequence] = (future, time.monotonic())
+
+        self.logger.debug('sending state update websocket msg: %s', payload)
+        try:
+            await self.send(payload)
+            latency = await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError, websockets.exceptions.ConnectionClosed):
+            self._pending.pop(sequence, None)
+            self.command_misses += 1
+            self.logger.error('%s did not acknowledge update %s', self.host, sequence)
+            return None
+
+        self.command_latencies.append(latency)
+        return latency
+
+
+def configure_logger(name, log_path, log_level=LOG_LEVEL):
+    logging.config.dictConfig({
+        'version': 1,
+        'formatters': {
+            'default': {'format': '%(asctime)s - %(levelname)s - %(message)s', 'datefmt': '%Y-%m-%d %H:%M:%S'}
+        },
+        'handlers': {
+            'console': {
+                'level': 'DEBUG',
+                'class': 'logging.StreamHandler',
+                'formatter': 'default',
+                'stream': 'ext://sys.stdout'
+            },
+            'file': {
+                'level': 'DEBUG',
+                'class': 'logging.handlers.RotatingFileHandler',
+                'formatter': 'default',
+                'filename': log_path,
+                'maxBytes': 10000000,
+                'backupCount': 3
+            }
+        },
+        'loggers': {
+            name: {
+                'level': log_level,
+                'handlers': ['console', 'file']
+            }
+        },
+        'disable_existing_loggers': False
+    })
+    return logging.getLogger(name)
+
+
+async def run(args, logger):
+    if args.subnet:
+        hosts = ['%s:%d' % (address, args.port) for address in ipaddress.ip_network(args.subnet, strict=False).hosts()]
+    else:
+        hosts = args.hosts or [SONOFF_LAN_IP]
+
+    capture = TrafficCapture(args.capture) if args.capture else None
+    sonoff = Sonoff(hosts, logger, capture)
+    started = time.monotonic()
+    try:
+        await sonoff.connect(args.concurrency, args.timeout)
+        devices = sonoff.get_devices()
+        logger.info('found %d devices on %d hosts in %.2fs', len(devices), len(hosts), time.monotonic() - started)
+
+        if args.command:
+            targets = [args.deviceid] if args.deviceid else [device['deviceid'] for device in devices]
+            states = {}
+            for deviceid in targets:
+                if args.command == 'toggle':
+                    states[deviceid] = 'off' if sonoff.get_state(deviceid, args.outlet) == 'on' else 'on'
+                else:
+                    states[deviceid] = args.command
+
+            commands_started = time.monotonic()
+            latencies = await asyncio.gather(*[sonoff.set_state(deviceid, states[deviceid], args.outlet, args.timeout)
+                                               for deviceid in targets])
+            logger.info('%d of %d devices acknowledged `%s` in %.2fs', sum(1 for latency in latencies if latency),
+                        len(targets), args.command, time.monotonic() - commands_started)
+
+        if args.duration is None:
+            await asyncio.Event().wait()
+        else:
+            await asyncio.sleep(args.duration)
+    finally:
+        await sonoff.close()
+        if capture is not None:
+            capture.close()
+            logger.info('captured %d frames to %s', capture.frames, args.capture)
+        print(sonoff.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hosts', nargs='*', help='device addresses, optionally with a port (default: SONOFF_LAN_IP)')
+    parser.add_argument('--subnet', help='probe every address in a subnet, e.g. 192.168.0.0/24')
+    parser.add_argument('--port', type=int, default=SONOFF_LAN_PORT, help='port to probe with --subnet')
+    parser.add_argument('--concurrency', type=int, default=256, help='connection attempts in flight at once')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds to wait for each connection, first update and command acknowledgement')
+    parser.add_argument('--command', choices=['on', 'off', 'toggle'], help='switch every device found')
+    parser.add_argument('--deviceid', help='only switch this device')
+    parser.add_argument('--outlet', type=int, help='outlet to switch on multi-outlet devices (from 0)')
+    parser.add_argument('--duration', type=float, help='seconds to keep logging updates for (default: until CTRL+C)')
+    parser.add_argument('--capture', help='record every frame to this capture file (gzipped if it ends in .gz)')
+    parser.add_argument('--log-level', default=LOG_LEVEL)
+    args = parser.parse_args()
+
+    logger = configure_logger('default', 'test_sonoff.log', args.log_level.upper())
+
+    try:
+        asyncio.run(run(args, logger))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
-    Sonoff()
+    main()
@@ -0,0 +1,238 @@
+"""
+Connection health and power monitoring sensors for Sonoff LAN Mode devices.
+
+Exposes the per-device metrics collected by each device's session (which the
+switches also show as attributes) as sensor entities, so that the slow or
+unstable devices in a fleet can be graphed and alerted on.
+
+Power monitoring devices (e.g. the POW and S31) can also have their power,
+voltage and current readings exposed. These are downsampled by the session,
+and each sensor reports the mean (with the min and max as attributes) of
+the readings since it last updated, so a device reporting every second
+still only writes a state every scan_interval.
+
+Devices added as config entries get the sensors chosen in the entry's
+options, polled every 30 seconds.
+
+For more details about this platform, please refer to the documentation at
+https://github.com/beveradb/sonoff-lan-mode-homeassistant
+"""
+from datetime import timedelta
+
+import homeassistant.helpers.config_validation as cv
+import voluptuous as vol
+from homeassistant.components.sensor import PLATFORM_SCHEMA
+from homeassistant.const import (CONF_HOST, CONF_NAME,
+                                 CONF_MONITORED_CONDITIONS,
+                                 CONF_SCAN_INTERVAL)
+from homeassistant.helpers.entity import Entity
+
+from .switch import (CONF_DEVICE_ID, async_get_manager,
+                     async_load_state_cache, async_start_discovery)
+
+DEFAULT_NAME = 'Sonoff Switch'
+
+SCAN_INTERVAL = timedelta(seconds=30)
+
+# Metric attribute: (name suffix, unit, icon)
+SENSOR_TYPES = {
+    'reconnects': ('Reconnects', None, 'mdi:lan-disconnect'),
+    'connected_ratio': ('Connected Ratio', None, 'mdi:lan-connect'),
+    'ping_rtt_ms': ('Ping RTT', 'ms', 'mdi:timer'),
+    'messages_in': ('Messages In', None, 'mdi:download'),
+    'messages_out': ('Messages Out', None, 'mdi:upload'),
+    'bytes_in': ('Bytes In', 'B', 'mdi:download'),
+    'bytes_out': ('Bytes Out', 'B', 'mdi:upload'),
+    'last_message_age_s': ('Last Message Age', 's', 'mdi:clock-outline'),
+    'command_latency_mean_ms': ('Command Latency', 'ms', 'mdi:timer'),
+    'queue_depth': ('Queued Commands', None, 'mdi:tray-full'),
+    'command_age_mean_ms': ('Command Age', 'ms', 'mdi:clock-outline'),
+    'commands_queued': ('Commands Queued', None, 'mdi:tray-plus'),
+    'commands_superseded': ('Commands Superseded', None, 'mdi:call-merge'),
+    'command_frames': ('Command Frames', None, 'mdi:upload'),
+    'retry_frames': ('Retry Frames', None, 'mdi:replay'),
+    'commands_retried': ('Commands Retried', None, 'mdi:replay'),
+    'commands_expired': ('Commands Expired', None, 'mdi:timer-off'),
+    'updates_coalesced': ('Updates Coalesced', None, 'mdi:call-merge'),
+    'frames_dropped': ('Frames Dropped', None, 'mdi:delete-sweep'),
+}
+
+# Device reading: (name suffix, unit, icon)
+TELEMETRY_TYPES = {
+    'power': ('Power', 'W', 'mdi:flash'),
+    'voltage': ('Voltage', 'V', 'mdi:sine-wave'),
+    'current': ('Current', 'A', 'mdi:current-ac'),
+}
+
+ATTR_MIN = 'min'
+ATTR_MAX = 'max'
+ATTR_SAMPLES = 'samples'
+
+DEFAULT_CONDITIONS = ['reconnects', 'connected_ratio', 'ping_rtt_ms',
+                      'last_message_age_s', 'command_latency_mean_ms']
+
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
+    vol.Optional(CONF_HOST): cv.string,
+    vol.Optional(CONF_DEVICE_ID): cv.string,
+    vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+    vol.Optional(CONF_MONITORED_CONDITIONS, default=DEFAULT_CONDITIONS):
+        vol.All(cv.ensure_list,
+                [vol.In(list(SENSOR_TYPES) + list(TELEMETRY_TYPES))])
+}), cv.has_at_least_one_key(CONF_HOST, CONF_DEVICE_ID))
+
+
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
+    """Set up the Sonoff LAN Mode health sensor platform."""
+    window = config.get(CONF_SCAN_INTERVAL, SCAN_INTERVAL).total_seconds()
+    await _async_setup_sensors(
+        hass, config.get(CONF_HOST), config.get(CONF_DEVICE_ID),
+        config.get(CONF_NAME), config.get(CONF_MONITORED_CONDITIONS),
+        window, async_add_entities)
+
+
+async def async_setup_entry(hass, entry, async_add_entities):
+    """Set up the sensors chosen in a device config entry's options."""
+    conditions = entry.options.get(CONF_MONITORED_CONDITIONS)
+    if conditions:
+        await _async_setup_sensors(
+            hass, entry.data.get(CONF_HOST), entry.data.get(CONF_DEVICE_ID),
+            entry.data.get(CONF_NAME, DEFAULT_NAME), conditions,
+            SCAN_INTERVAL.total_seconds(), async_add_entities,
+            entry.unique_id)
+
+
+async def _async_setup_sensors(hass, host, device_id, name, conditions,
+                               window, async_add_entities, unique_id=None):
+    # Sessions opened here must start from the cached state too
+    await async_load_state_cache(hass)
+
+    if device_id is not None:
+        await async_start_discovery(hass)
+
+    sensors = []
+    for condition in conditions:
+        sensor_id = unique_id and "%s_%s" % (unique_id, condition)
+        if condition in TELEMETRY_TYPES:
+            sensors.append(HassSonoffTelemetrySensor(
+                hass, host, device_id, name, condition, window, sensor_id))
+        else:
+            sensors.append(HassSonoffHealthSensor(
+                hass, host, device_id, name, condition, sensor_id))
+
+    async_add_entities(sensors)
+
+
+class HassSonoffHealthSensor(Entity):
+    """One health metric of a Sonoff LAN Mode device's connection."""
+
+    def __init__(self, hass, host, device_id, name, condition,
+                 unique_id=None):
+        self._name = "%s %s" % (name, SENSOR_TYPES[condition][0])
+        self._unique_id = unique_id
+        self._condition = condition
+        self._state = None
+        self._sonoff_device = async_get_manager(hass).async_get_handle(
+            host, None, deviceid=device_id)
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def unique_id(self):
+        """Return an id for the entity registry, for config entries only."""
+        return self._unique_id
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return SENSOR_TYPES[self._condition][2]
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of the metric, if any."""
+        return SENSOR_TYPES[self._condition][1]
+
+    @property
+    def state(self):
+        """Return the current value of the metric."""
+        return self._state
+
+    async def async_will_remove_from_hass(self):
+        """Release the shared device session when the entity goes away."""
+        await self._sonoff_device.async_close()
+
+    async def async_update(self):
+        """Read the latest value of the metric from the device session."""
+        self._state = \
+            self._sonoff_device.metrics_attributes()[self._condition]
+
+
+class HassSonoffTelemetrySensor(Entity):
+    """A downsampled power, voltage or current reading from a device."""
+
+    def __init__(self, hass, host, device_id, name, condition, window,
+                 unique_id=None):
+        self._name = "%s %s" % (name, TELEMETRY_TYPES[condition][0])
+        self._unique_id = unique_id
+        self._condition = condition
+        self._window = window
+        self._state = None
+        self._attributes = {}
+        self._sonoff_device = async_get_manager(hass).async_get_handle(
+            host, None, deviceid=device_id)
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def unique_id(self):
+        """Return an id for the entity registry, for config entries only."""
+        return self._unique_id
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return TELEMETRY_TYPES[self._condition][2]
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of the reading."""
+        return TELEMETRY_TYPES[self._condition][1]
+
+    @property
+    def available(self):
+        """Return True while the device is reporting the reading."""
+        return self._sonoff_device.available and self._state is not None
+
+    @property
+    def state(self):
+        """Return the mean of the readings since the last update."""
+        return self._state
+
+    @property
+    def device_state_attributes(self):
+        """Return the min and max readings, and how many there were."""
+        return self._attributes
+
+    async def async_will_remove_from_hass(self):
+        """Release the shared device session when the entity goes away."""
+        await self._sonoff_device.async_close()
+
+    async def async_update(self):
+        """Summarise the readings the session has buffered."""
+        summary = self._sonoff_device.telemetry(self._condition,
+                                                self._window)
+        if summary is None:
+            self._state = None
+            self._attributes = {}
+            return
+
+        low, high, mean, samples = summary
+        self._state = round(mean, 2)
+        self._attributes = {ATTR_MIN: low, ATTR_MAX: high,
+                            ATTR_SAMPLES: samples}
@@ -0,0 +1,212 @@
+"""
+Lightweight statistics helpers for the Sonoff LAN Mode platform.
+
+These are updated from the message path, so they only ever increment
+preallocated counters and never allocate per sample.
+"""
+import bisect
+import math
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2000, 5000)
+
+# Seconds per downsampled telemetry interval, and how many are kept
+DEFAULT_TELEMETRY_INTERVAL = 10
+DEFAULT_TELEMETRY_SLOTS = 60
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of latencies, recorded in seconds."""
+
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds=DEFAULT_LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(self.bounds, milliseconds)] += 1
+        self.total += milliseconds
+        self.count += 1
+
+    @property
+    def mean(self):
+        """Return the mean latency in milliseconds, or None if empty."""
+        if not self.count:
+            return None
+        return round(self.total / self.count, 1)
+
+    def as_dict(self):
+        """Return bucket counts keyed by upper bound, for state attributes."""
+        buckets = {'<=%dms' % bound: count
+                   for bound, count in zip(self.bounds, self.counts)}
+        buckets['>%dms' % self.bounds[-1]] = self.counts[-1]
+        return buckets
+
+
+class DownsamplingBuffer:
+    """Ring buffer of the min, max and mean of readings per interval.
+
+    Readings are folded into the slot of the interval they arrive in, so a
+    device reporting many times a second costs a few comparisons per
+    reading, and no more memory than one reporting once a minute. The last
+    slots intervals are kept, which can be summarised over any window of
+    whole intervals. Times are event loop times, in seconds.
+    """
+
+    __slots__ = ('interval', 'numbers', 'mins', 'maxs', 'totals', 'counts',
+                 'last', 'last_time')
+
+    def __init__(self, interval=DEFAULT_TELEMETRY_INTERVAL,
+                 slots=DEFAULT_TELEMETRY_SLOTS):
+        self.interval = interval
+        self.numbers = [None] * slots
+        self.mins = [0.0] * slots
+        self.maxs = [0.0] * slots
+        self.totals = [0.0] * slots
+        self.counts = [0] * slots
+        self.last = None
+        self.last_time = None
+
+    def add(self, value, now):
+        number = int(now // self.interval)
+        index = number % len(self.numbers)
+        if self.numbers[index] != number:
+            self.numbers[index] = number
+            self.mins[index] = self.maxs[index] = value
+            self.totals[index] = value
+            self.counts[index] = 1
+        else:
+            if value < self.mins[index]:
+                self.mins[index] = value
+            elif value > self.maxs[index]:
+                self.maxs[index] = value
+            self.totals[index] += value
+            self.counts[index] += 1
+        self.last = value
+        self.last_time = now
+
+    def summary(self, now, window, since=None):
+        """Return (min, max, mean, count) over the last window seconds.
+
+        Only completed intervals count. Given the time of the previous
+        summary as since, the intervals completed after it are used instead
+        of the window, so consecutive summaries cover every reading exactly
+        once however far apart they are taken (up to the buffer's length).
+        Returns None if there were no readings.
+        """
+        current = int(now // self.interval)
+        if since is None:
+            first = current - max(1, int(math.ceil(window / self.interval)))
+        else:
+            first = int(since // self.interval)
+        first = max(first, current - len(self.numbers))
+        low = high = None
+        total, count = 0.0, 0
+
+        for number in range(first, current):
+            index = number % len(self.numbers)
+            if self.numbers[index] != number:
+                continue
+            if low is None or self.mins[index] < low:
+                low = self.mins[index]
+            if high is None or self.maxs[index] > high:
+                high = self.maxs[index]
+            total += self.totals[index]
+            count += self.counts[index]
+
+        if not count:
+            return None
+        return low, high, total / count, count
+
+
+class DeviceMetrics:
+    """Connection health counters and gauges for one device session.
+
+    Times are event loop times, in seconds.
+    """
+
+    __slots__ = ('created', 'connections', 'connected_since',
+                 'connected_total', 'ping_rtt', 'messages_in', 'messages_out',
+                 'bytes_in', 'bytes_out', 'last_message', 'command_latency',
+                 'queue_depth', 'command_age', 'commands_queued',
+                 'commands_superseded', 'command_frames', 'retry_frames',
+                 'commands_retried', 'commands_expired', 'updates_coalesced',
+                 'frames_dropped', 'transport')
+
+    def __init__(self, now):
+        self.created = now
+        self.connections = 0
+        self.connected_since = None
+        self.connected_total = 0.0
+        self.ping_rtt = None
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_message = None
+        self.command_latency = LatencyHistogram()
+        self.queue_depth = 0
+        self.command_age = LatencyHistogram()
+        self.commands_queued = 0
+        self.commands_superseded = 0
+        self.command_frames = 0
+        self.retry_frames = 0
+        self.commands_retried = 0
+        self.commands_expired = 0
+        self.updates_coalesced = 0
+        self.frames_dropped = 0
+        self.transport = None
+
+    @property
+    def reconnects(self):
+        return max(0, self.connections - 1)
+
+    def connected(self, now):
+        self.connections += 1
+        self.connected_since = now
+
+    def disconnected(self, now):
+        if self.connected_since is not None:
+            self.connected_total += now - self.connected_since
+            self.connected_since = None
+
+    def connected_ratio(self, now):
+        """Return the fraction of the session's lifetime spent connected."""
+        connected = self.connected_total
+        if self.connected_since is not None:
+            connected += now - self.connected_since
+        lifetime = now - self.created
+        return round(connected / lifetime, 3) if lifetime > 0 else 0.0
+
+    def as_attributes(self, now):
+        """Return the metrics as a flat dict, e.g. for state attributes."""
+        return {
+            'reconnects': self.reconnects,
+            'connected_ratio': self.connected_ratio(now),
+            'ping_rtt_ms': None if self.ping_rtt is None
+            else round(self.ping_rtt * 1000, 1),
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'last_message_age_s': None if self.last_message is None
+            else round(now - self.last_message, 1),
+            'command_latency': self.command_latency.as_dict(),
+            'command_latency_mean_ms': self.command_latency.mean,
+            'queue_depth': self.queue_depth,
+            'command_age': self.command_age.as_dict(),
+            'command_age_mean_ms': self.command_age.mean,
+            'commands_queued': self.commands_queued,
+            'commands_superseded': self.commands_superseded,
+            'command_frames': self.command_frames,
+            'retry_frames': self.retry_frames,
+            'commands_retried': self.commands_retried,
+            'commands_expired': self.commands_expired,
+            'updates_coalesced': self.updates_coalesced,
+            'frames_dropped': self.frames_dropped,
+            'transport': self.transport,
+        }
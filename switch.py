@@ -3,64 +3,376 @@ Support for Sonoff smart home devices, such as smart switches (e.g. Sonoff
 Basic), plugs (e.g. Sonoff S20), and wall switches (e.g. Sonoff Touch),
 when these devices are in "LAN Mode", directly over the local network.
 
+Devices can be configured on the platform in YAML, or added from the
+integrations page as config entries (see config_flow.py), one per device.
+
 For more details about this platform, please refer to the documentation at
 https://github.com/beveradb/sonoff-lan-mode-homeassistant
 """
+import asyncio
 import logging
+import time
 
 import homeassistant.helpers.config_validation as cv
 import voluptuous as vol
 from homeassistant.components.switch import (SwitchDevice, PLATFORM_SCHEMA)
-from homeassistant.const import CONF_HOST, CONF_NAME, CONF_ICON
+from homeassistant.const import (ATTR_ENTITY_ID, CONF_HOST, CONF_NAME,
+                                 CONF_ICON, CONF_MONITORED_CONDITIONS,
+                                 CONF_PLATFORM, EVENT_HOMEASSISTANT_STOP)
+from homeassistant.helpers.storage import Store
+
+from . import DOMAIN
+from .log_helpers import DEFAULT_DIAGNOSTICS_PER_MINUTE
+from .transport import TRANSPORTS
 
-REQUIREMENTS = ['pysonofflan>=0.3.0']
+REQUIREMENTS = ['websockets>=7.0']
+DEPENDENCIES = ['zeroconf']
 
 _LOGGER = logging.getLogger('homeassistant.components.switch.sonoff_lan_mode')
 
 DEFAULT_NAME = 'Sonoff Switch'
 DEFAULT_ICON = 'mdi:flash'
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
-    vol.Required(CONF_HOST): cv.string,
+DATA_MANAGER = 'sonoff_lan_mode_manager'
+DATA_DISCOVERY = 'sonoff_lan_mode_discovery'
+DATA_ENTITIES = 'sonoff_lan_mode_entities'
+DATA_STATE_CACHE = 'sonoff_lan_mode_state_cache'
+
+STORAGE_KEY = 'sonoff_lan_mode.state'
+STORAGE_VERSION = 1
+STATE_SAVE_DELAY = 10
+
+CONF_DEVICE_ID = 'device_id'
+
+CONF_OUTLETS = 'outlets'
+CONF_COMMAND_WINDOW = 'command_window'
+CONF_OPTIMISTIC = 'optimistic'
+CONF_CONFIRM_TIMEOUT = 'confirm_timeout'
+CONF_LOG_LEVEL = 'log_level'
+CONF_DIAGNOSTICS_PER_MINUTE = 'diagnostics_per_minute'
+CONF_PING_INTERVAL = 'ping_interval'
+CONF_PING_TIMEOUT = 'ping_timeout'
+CONF_COMMAND_DEADLINE = 'command_deadline'
+CONF_MAX_UPDATE_RATE = 'max_update_rate'
+CONF_TRANSPORT = 'transport'
+CONF_DEVICE_KEY = 'device_key'
+
+LOG_LEVELS = ['critical', 'error', 'warning', 'info', 'debug']
+
+DEFAULT_CONFIRM_TIMEOUT = 2.0
+
+ATTR_CONFIRM_LATENCY = 'confirm_latency'
+ATTR_CONFIRM_LATENCY_MEAN = 'confirm_latency_mean_ms'
+ATTR_CONFIRM_MISSES = 'confirm_misses'
+ATTR_SUPPRESSED_WRITES = 'suppressed_state_writes'
+
+SERVICE_BULK_SET = 'bulk_set'
+EVENT_BULK_SET_RESULT = 'sonoff_lan_mode_bulk_set_result'
+ATTR_STATE = 'state'
+ATTR_TARGETS = 'targets'
+ATTR_MAX_CONCURRENT = 'max_concurrent'
+ATTR_RESULTS = 'results'
+DEFAULT_BULK_CONCURRENCY = 50
+
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
+    vol.Optional(CONF_HOST): cv.string,
+    vol.Optional(CONF_DEVICE_ID): cv.string,
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
-    vol.Optional(CONF_ICON, default=DEFAULT_ICON) : cv.string
+    vol.Optional(CONF_ICON, default=DEFAULT_ICON) : cv.string,
+    vol.Optional(CONF_OUTLETS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_COMMAND_WINDOW, default=0): vol.All(
+        vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_OPTIMISTIC, default=False): cv.boolean,
+    vol.Optional(CONF_CONFIRM_TIMEOUT, default=DEFAULT_CONFIRM_TIMEOUT):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_LOG_LEVEL): vol.All(vol.Lower, vol.In(LOG_LEVELS)),
+    vol.Optional(CONF_DIAGNOSTICS_PER_MINUTE,
+                 default=DEFAULT_DIAGNOSTICS_PER_MINUTE): cv.positive_int,
+    vol.Optional(CONF_PING_INTERVAL): vol.All(vol.Coerce(float),
+                                              vol.Range(min=1)),
+    vol.Optional(CONF_PING_TIMEOUT): vol.All(vol.Coerce(float),
+                                             vol.Range(min=0.5)),
+    vol.Optional(CONF_COMMAND_DEADLINE): vol.All(vol.Coerce(float),
+                                                 vol.Range(min=0)),
+    vol.Optional(CONF_MAX_UPDATE_RATE): vol.All(vol.Coerce(float),
+                                                vol.Range(min=0)),
+    vol.Optional(CONF_TRANSPORT, default='auto'): vol.All(
+        vol.Lower, vol.In(TRANSPORTS)),
+    vol.Optional(CONF_DEVICE_KEY): cv.string,
+}), cv.has_at_least_one_key(CONF_HOST, CONF_DEVICE_ID))
+
+BULK_SET_TARGET_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+    vol.Required(ATTR_STATE): cv.boolean,
 })
 
+BULK_SET_SCHEMA = vol.All(vol.Schema({
+    vol.Inclusive(ATTR_ENTITY_ID, 'entities'): cv.entity_ids,
+    vol.Inclusive(ATTR_STATE, 'entities'): cv.boolean,
+    vol.Optional(ATTR_TARGETS, default=[]): vol.All(
+        cv.ensure_list, [BULK_SET_TARGET_SCHEMA]),
+    vol.Optional(ATTR_MAX_CONCURRENT, default=DEFAULT_BULK_CONCURRENCY):
+        vol.All(vol.Coerce(int), vol.Range(min=1)),
+}), cv.has_at_least_one_key(ATTR_ENTITY_ID, ATTR_TARGETS))
+
 
 async def async_setup_platform(hass, config, async_add_entities,
                                discovery_info=None):
     """Set up the Sonoff LAN Mode Switch platform."""
+    await _async_setup_device(hass, config, async_add_entities)
+
+
+async def async_setup_entry(hass, entry, async_add_entities):
+    """Set up the switches of a device added as a config entry.
+
+    The entry's data and options are validated like YAML config. Its
+    entities are removed again when the entry is unloaded, closing the
+    device's session and leaving every other device's alone.
+    """
+    options = {key: value for key, value in entry.options.items()
+               if key != CONF_MONITORED_CONDITIONS}
+    config = PLATFORM_SCHEMA(dict(entry.data, **options,
+                                  **{CONF_PLATFORM: DOMAIN}))
+    await _async_setup_device(hass, config, async_add_entities,
+                              entry.unique_id)
+
+
+async def _async_setup_device(hass, config, async_add_entities,
+                              unique_id=None):
     host = config.get(CONF_HOST)
     name = config.get(CONF_NAME)
     icon = config.get(CONF_ICON)
+    outlets = config.get(CONF_OUTLETS)
+    device_id = config.get(CONF_DEVICE_ID)
+    options = {
+        'device_id': device_id,
+        'command_window': config.get(CONF_COMMAND_WINDOW),
+        'optimistic': config.get(CONF_OPTIMISTIC),
+        'confirm_timeout': config.get(CONF_CONFIRM_TIMEOUT),
+        'diagnostics_per_minute': config.get(CONF_DIAGNOSTICS_PER_MINUTE),
+        'ping_interval': config.get(CONF_PING_INTERVAL),
+        'ping_timeout': config.get(CONF_PING_TIMEOUT),
+        'command_deadline': config.get(CONF_COMMAND_DEADLINE),
+        'max_update_rate': config.get(CONF_MAX_UPDATE_RATE),
+        'transport': config.get(CONF_TRANSPORT),
+        'device_key': config.get(CONF_DEVICE_KEY),
+    }
+
+    # Only touch the platform's log level when explicitly asked to, so that
+    # the logger: integration stays in control otherwise.
+    if CONF_LOG_LEVEL in config:
+        _LOGGER.setLevel(config[CONF_LOG_LEVEL].upper())
+
+    await async_load_state_cache(hass)
+
+    # Devices configured by id are tracked across address changes, and
+    # HTTP devices announce their state changes over mDNS (discovery is
+    # also started once a device is detected to be one, see
+    # async_get_manager)
+    if device_id is not None or options['transport'] == 'http' or \
+            options['device_key'] is not None:
+        await async_start_discovery(hass)
+
+    async_register_services(hass)
+
+    if outlets is None:
+        entities = [HassSonoffSwitch(hass, host, name, icon,
+                                     unique_id=unique_id, **options)]
+    else:
+        # One entity per outlet, all sharing the device's single session
+        entities = [HassSonoffSwitch(hass, host, "%s %d" % (name, outlet + 1),
+                                     icon, outlet,
+                                     unique_id=unique_id and
+                                     "%s_%d" % (unique_id, outlet),
+                                     **options)
+                    for outlet in range(outlets)]
+
+    # Entities start with their cached state (or unavailable, if there is
+    # none) and are updated by their device callbacks as sessions connect
+    # in the background, so setup never waits on them.
+    async_add_entities(entities)
+
+
+def async_get_manager(hass):
+    """Return the connection manager shared by all Sonoff entities."""
+    manager = hass.data.get(DATA_MANAGER)
+
+    if manager is None:
+        from .connection import SonoffConnectionManager
+
+        manager = SonoffConnectionManager(hass.loop, _LOGGER)
+        hass.data[DATA_MANAGER] = manager
+
+        async def async_stop_manager(event):
+            await manager.async_stop()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP,
+                                   async_stop_manager)
+
+        def async_http_detected():
+            # A device found to speak HTTP only reports its state over mDNS
+            hass.async_create_task(async_start_discovery(hass))
+
+        manager.http_listener = async_http_detected
+
+    return manager
+
+
+async def async_load_state_cache(hass):
+    """Restore the devices' last known states, as saved by the last run.
+
+    The cache is only loaded once, however many platforms are set up, and
+    from then on is saved a few seconds after any device's state changes.
+    """
+    if DATA_STATE_CACHE not in hass.data:
+        hass.data[DATA_STATE_CACHE] = hass.async_create_task(
+            _async_load_state_cache(hass))
+
+    await hass.data[DATA_STATE_CACHE]
+
+
+async def _async_load_state_cache(hass):
+    manager = async_get_manager(hass)
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+
+    data = await store.async_load()
+    if data is not None:
+        manager.restored.update(data.get('devices', {}))
+
+    def async_state_changed():
+        store.async_delay_save(lambda: {'devices': manager.snapshot()},
+                               STATE_SAVE_DELAY)
+
+    manager.state_listener = async_state_changed
+
+
+async def async_start_discovery(hass):
+    """Start browsing for LAN Mode devices, if not already running."""
+    if DATA_DISCOVERY not in hass.data:
+        hass.data[DATA_DISCOVERY] = hass.async_create_task(
+            _async_start_discovery(hass))
+
+    await hass.data[DATA_DISCOVERY]
+
+
+async def _async_start_discovery(hass):
+    from homeassistant.components.zeroconf import async_get_instance
+    from .discovery import SonoffDiscovery
 
-    async_add_entities([HassSonoffSwitch(hass, host, name, icon)], True)
+    # Browse on Home Assistant's shared mDNS instance rather than opening
+    # another set of multicast sockets
+    zeroconf = await async_get_instance(hass)
+    discovery = SonoffDiscovery(async_get_manager(hass), zeroconf=zeroconf)
+    await hass.async_add_executor_job(discovery.start)
+
+    async def async_stop_discovery(event):
+        await hass.async_add_executor_job(discovery.stop)
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_discovery)
+
+    return discovery
+
+
+def async_register_services(hass):
+    """Register the platform's services, if not already registered."""
+    if hass.services.has_service(DOMAIN, SERVICE_BULK_SET):
+        return
+
+    async def async_handle_bulk_set(call):
+        targets = [(target[ATTR_ENTITY_ID], target[ATTR_STATE])
+                   for target in call.data[ATTR_TARGETS]]
+        targets.extend((entity_id, call.data[ATTR_STATE])
+                       for entity_id in call.data.get(ATTR_ENTITY_ID, []))
+
+        results = await async_bulk_set(hass, targets,
+                                       call.data[ATTR_MAX_CONCURRENT])
+
+        failed = sorted(entity_id for entity_id, result in results.items()
+                        if not result['success'])
+        if failed:
+            _LOGGER.warning("Sonoff LAN Mode bulk_set: %d of %d switches "
+                            "did not confirm: %s", len(failed), len(results),
+                            ', '.join(failed))
+        hass.bus.async_fire(EVENT_BULK_SET_RESULT, {ATTR_RESULTS: results})
+
+    hass.services.async_register(DOMAIN, SERVICE_BULK_SET,
+                                 async_handle_bulk_set,
+                                 schema=BULK_SET_SCHEMA)
+
+
+async def async_bulk_set(hass, targets,
+                         max_concurrent=DEFAULT_BULK_CONCURRENCY):
+    """Switch many Sonoff switches at once.
+
+    Takes (entity_id, state) pairs, and returns a dict of entity_id ->
+    {'success': bool, 'latency_ms': float or None} once every switch has
+    confirmed or timed out. Up to max_concurrent switches are sent their
+    command and await confirmation at once, and each further switch is only
+    sent its command when one of those has confirmed or timed out. A scene
+    of at most max_concurrent switches so takes about one device round trip
+    rather than one per device (and the outlets of a multi-outlet device
+    still share a frame); a larger one takes a round trip per
+    max_concurrent switches.
+    """
+    entities = hass.data.get(DATA_ENTITIES, {})
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def async_set(entity_id, state):
+        entity = entities.get(entity_id)
+        if entity is None:
+            _LOGGER.warning("Sonoff LAN Mode bulk_set: %s is not a Sonoff "
+                            "LAN Mode switch", entity_id)
+            return {'success': False, 'latency_ms': None}
+
+        async with semaphore:
+            latency = await entity.async_switch_confirmed(state)
+
+        return {'success': latency is not None,
+                'latency_ms': None if latency is None
+                              else round(latency * 1000, 1)}
+
+    results = await asyncio.gather(*[async_set(entity_id, state)
+                                     for entity_id, state in targets])
+    return dict(zip([entity_id for entity_id, _ in targets], results))
 
 
 class HassSonoffSwitch(SwitchDevice):
     """Home Assistant representation of a Sonoff LAN Mode device."""
 
-    def __init__(self, hass, host, name, icon):
-        from pysonofflan import SonoffSwitch
-
-        _LOGGER.setLevel(logging.DEBUG)
+    def __init__(self, hass, host, name, icon, outlet=None, device_id=None,
+                 command_window=None, optimistic=False,
+                 confirm_timeout=DEFAULT_CONFIRM_TIMEOUT,
+                 diagnostics_per_minute=DEFAULT_DIAGNOSTICS_PER_MINUTE,
+                 ping_interval=None, ping_timeout=None,
+                 command_deadline=None, max_update_rate=None,
+                 transport=None, device_key=None, unique_id=None):
+        from .log_helpers import RateLimitedLogger
+        from .stats import LatencyHistogram
 
         self._name = name
+        self._unique_id = unique_id
         self._icon = icon
         self._state = None
         self._available = False
-        self._shared_state = {}
-        self._sonoff_device = SonoffSwitch(
-            host=host,
-            callback_after_update=self.device_update_callback,
-            shared_state=self._shared_state,
-            logger=_LOGGER,
-            loop=hass.loop,
-            ping_interval=145
-        )
+        self._stale = False
+        self._optimistic = optimistic
+        self._confirm_timeout = confirm_timeout
+        self._confirm_latency = LatencyHistogram()
+        self._confirm_misses = 0
+        self._diagnostics = RateLimitedLogger(_LOGGER, diagnostics_per_minute)
+        self._published = None
+        self._suppressed_writes = 0
+        self._sonoff_device = async_get_manager(hass).async_get_handle(
+            host, self.device_update_callback, outlet, command_window,
+            device_id, ping_interval, ping_timeout, command_deadline,
+            max_update_rate, transport, device_key)
+
+        # Show the cached state straight away, if the device has one
+        if self._sonoff_device.basic_info is not None:
+            self._read_device_state()
 
         _LOGGER.debug("HassSonoffSwitch __init__ finished creating "
-                      "SonoffSwitch")
+                      "device handle")
 
     @property
     def icon(self):
@@ -69,64 +381,175 @@ class HassSonoffSwitch(SwitchDevice):
 
     @property
     def name(self):
-        _LOGGER.debug("HassSonoffSwitch returning _name: %s" % self._name)
+        """Return the name of the switch."""
         return self._name
 
+    @property
+    def unique_id(self):
+        """Return an id for the entity registry, for config entries only."""
+        return self._unique_id
+
     @property
     def available(self) -> bool:
         """Return if switch is available."""
-        _LOGGER.debug("HassSonoffSwitch returning _available: %s" %
-                      self._available)
         return self._available
 
     @property
     def is_on(self):
         """Return true if switch is on."""
-        _LOGGER.debug("HassSonoffSwitch returning _state: %s" % self._state)
         return self._state
 
+    @property
+    def assumed_state(self):
+        """Return true while showing the cached state from the last run."""
+        return self._stale
+
+    @property
+    def device_state_attributes(self):
+        """Return the confirmation statistics and device health metrics."""
+        attributes = self._tracked_attributes()
+        attributes[ATTR_SUPPRESSED_WRITES] = self._suppressed_writes
+        attributes.update(self._sonoff_device.metrics_attributes())
+        return attributes
+
+    def _tracked_attributes(self):
+        """Return the attributes which warrant a state write on change."""
+        return {
+            ATTR_CONFIRM_LATENCY: self._confirm_latency.as_dict(),
+            ATTR_CONFIRM_LATENCY_MEAN: self._confirm_latency.mean,
+            ATTR_CONFIRM_MISSES: self._confirm_misses,
+        }
+
     async def turn_on(self, **kwargs):
         """Turn the switch on."""
-        _LOGGER.info("Sonoff LAN Mode switch %s switching on" % self._name)
-        await self._sonoff_device.turn_on()
+        _LOGGER.info("Sonoff LAN Mode switch %s switching on", self._name)
+        await self._async_switch(True)
 
     async def turn_off(self, **kwargs):
         """Turn the switch off."""
-        _LOGGER.info("Sonoff LAN Mode switch %s switching off" % self._name)
-        await self._sonoff_device.turn_off()
+        _LOGGER.info("Sonoff LAN Mode switch %s switching off", self._name)
+        await self._async_switch(False)
+
+    async def _async_switch(self, state):
+        """Send a switch command and track its confirmation in the background.
+
+        In optimistic mode the new state is shown straight away, and rolled
+        back to the device's last reported state if the device does not
+        confirm the command within the confirmation timeout.
+        """
+        self.hass.async_create_task(await self._async_send_switch(state))
+
+    async def async_switch_confirmed(self, state):
+        """Switch on or off and wait for the device to confirm it.
+
+        Returns the confirmation latency in seconds, or None if the device
+        did not confirm within the confirmation timeout.
+        """
+        return await (await self._async_send_switch(state))
+
+    async def _async_send_switch(self, state):
+        """Send a switch command, returning a coroutine to track it."""
+        previous_state = self._state
+        if self._optimistic:
+            self._state = state
+            self._async_publish_state()
+
+        started = time.monotonic()
+        if state:
+            sequence = await self._sonoff_device.turn_on()
+        else:
+            sequence = await self._sonoff_device.turn_off()
+
+        return self._async_track_confirmation(sequence, state, previous_state,
+                                              started)
+
+    async def _async_track_confirmation(self, sequence, state, previous_state,
+                                        started):
+        confirmed = sequence is not None and \
+            await self._sonoff_device.async_wait_confirmed(
+                sequence, self._confirm_timeout)
+
+        if confirmed:
+            latency = time.monotonic() - started
+            self._confirm_latency.add(latency)
+            return latency
+
+        self._confirm_misses += 1
+        _LOGGER.warning(
+            "Sonoff LAN Mode switch %s did not confirm switching %s within "
+            "%.1fs", self._name, 'on' if state else 'off',
+            self._confirm_timeout)
+
+        if self._optimistic and self._state == state:
+            device_state = self._sonoff_device.state
+            if device_state is None:
+                self._state = previous_state
+            else:
+                self._state = \
+                    device_state == self._sonoff_device.SWITCH_STATE_ON
+            self._async_publish_state()
+
+        return None
+
+    def _async_publish_state(self):
+        """Schedule a state write, unless nothing changed since the last one.
+
+        Device callbacks fire for keepalive-triggered and duplicate updates
+        too, and every write costs a state_changed event, a recorder write
+        and a frontend push, so unchanged states are skipped and counted.
+        """
+        # Health metrics change with every frame, so they are refreshed
+        # whenever the state is written but never trigger a write themselves.
+        published = (self._state, self._available, self._stale,
+                     self._tracked_attributes())
+
+        if published == self._published:
+            self._suppressed_writes += 1
+            return
+
+        self._published = published
+        self.async_schedule_update_ha_state()
 
     async def device_update_callback(self, callback_self):
         """Handle state updates announced by the device itself."""
-        _LOGGER.info(
+        self._diagnostics.debug(
             "Sonoff LAN Mode switch %s received updated state from "
-            "the device: %s, available: %s" % (self._name,
-                                self._sonoff_device.state,
-                                self._sonoff_device.available)
-        )
+            "the device: %s, available: %s", self._name,
+            self._sonoff_device.state, self._sonoff_device.available)
 
         await self.async_update()
 
+    async def async_added_to_hass(self):
+        """Make the switch addressable by the platform's services."""
+        self.hass.data.setdefault(DATA_ENTITIES, {})[self.entity_id] = self
+
+    async def async_will_remove_from_hass(self):
+        """Release the shared device session when the entity goes away."""
+        self.hass.data.get(DATA_ENTITIES, {}).pop(self.entity_id, None)
+        await self._sonoff_device.async_close()
+
     @property
     def should_poll(self) -> bool:
         return False
 
+    def _read_device_state(self):
+        """Copy the state of the device (or its cached state) to the entity."""
+        self._stale = self._sonoff_device.stale
+        self._available = self._sonoff_device.available or self._stale
+        self._state = \
+            self._sonoff_device.state == self._sonoff_device.SWITCH_STATE_ON
+
     async def async_update(self):
         """Update the device state."""
-        _LOGGER.debug("HassSonoffSwitch async_update called")
         try:
             if self._sonoff_device.basic_info is None:
-                _LOGGER.debug(
-                    "Sonoff device basic info still none, waiting for init "
-                    "message")
+                self._diagnostics.debug(
+                    "Sonoff device %s basic info still none, waiting for "
+                    "init message", self._name)
                 return
 
-            self._available = self._sonoff_device.available
-
-            self._state = \
-                self._sonoff_device.state == \
-                self._sonoff_device.SWITCH_STATE_ON
-
-            self.async_schedule_update_ha_state()
+            self._read_device_state()
+            self._async_publish_state()
 
         except Exception as ex:
             if self._available:
@@ -0,0 +1,399 @@
+"""
+Transports carrying frames between a device session and a Sonoff device.
+
+Sessions speak in eWeLink LAN mode frames (JSON strings, as built by the
+codec), and a transport gets them to and from the device:
+
+- WebSocketTransport speaks the original LAN mode protocol, a WebSocket on
+  port 8081 which carries those frames as they are.
+- HttpTransport speaks the LAN HTTP API of DIY mode and v3 firmware, which
+  dropped the WebSocket: commands are POSTed to /zeroconf/<endpoint> on
+  port 8081, and the device announces state changes in its mDNS TXT records
+  rather than over a connection. Outgoing frames are translated into
+  requests, and replies and pushed state into the frames a WebSocket device
+  would have sent, so the session doesn't need to know which is in use.
+
+Devices paired to an eWeLink account encrypt the data of their requests
+and responses (see encryption.py); HttpTransport handles that when it is
+given the device's cipher.
+
+HTTP requests go through a HttpConnectionPool shared by every session,
+which keeps a few idle keep-alive connections open to each device, so a
+command usually costs one round trip rather than a TCP handshake as well.
+
+Transports raise OSError (or asyncio.TimeoutError) when the device can't be
+reached, and websockets' exceptions for WebSocket protocol errors.
+
+Like connection.py, this module has no Home Assistant imports.
+"""
+import asyncio
+import socket
+import time
+
+import websockets
+
+from .codec import decode, dumps
+from .encryption import DecryptionError
+
+CONNECT_TIMEOUT = 10
+CLOSE_TIMEOUT = 1
+HTTP_TIMEOUT = 5
+DEFAULT_POOL_SIZE = 2
+TCP_KEEPALIVE_IDLE = 30
+TCP_KEEPALIVE_INTERVAL = 5
+TCP_KEEPALIVE_COUNT = 3
+
+TRANSPORT_AUTO = 'auto'
+TRANSPORT_WEBSOCKET = 'websocket'
+TRANSPORT_HTTP = 'http'
+TRANSPORTS = [TRANSPORT_AUTO, TRANSPORT_WEBSOCKET, TRANSPORT_HTTP]
+
+
+def enable_tcp_keepalive(sock, idle=TCP_KEEPALIVE_IDLE,
+                         interval=TCP_KEEPALIVE_INTERVAL,
+                         count=TCP_KEEPALIVE_COUNT):
+    """Have the kernel probe an idle connection and drop it if it's dead.
+
+    The tuning options are platform specific, so any that are missing are
+    skipped and the system defaults apply.
+    """
+    if sock is None:
+        return
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', idle),
+                          ('TCP_KEEPINTVL', interval),
+                          ('TCP_KEEPCNT', count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                            value)
+
+
+class TransportClosed(ConnectionError):
+    """The transport was closed, or the device went away."""
+
+
+class HttpError(ConnectionError):
+    """The device answered an HTTP request with an error."""
+
+
+class _StaleConnection(ConnectionError):
+    """A pooled connection was closed before the device answered at all."""
+
+
+class WebSocketTransport:
+    """The original LAN mode protocol: frames over a WebSocket."""
+
+    name = TRANSPORT_WEBSOCKET
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._websocket = None
+
+    async def connect(self):
+        websocket = await asyncio.wait_for(
+            websockets.connect('ws://%s:%d/' % (self.host, self.port),
+                               ping_interval=None,
+                               close_timeout=CLOSE_TIMEOUT),
+            CONNECT_TIMEOUT)
+        enable_tcp_keepalive(websocket.transport.get_extra_info('socket'))
+        self._websocket = websocket
+
+    async def send(self, message):
+        await self._websocket.send(message)
+
+    async def recv(self):
+        return await self._websocket.recv()
+
+    async def ping(self):
+        """Send a ping, returning a future which resolves on the pong."""
+        return await self._websocket.ping()
+
+    def abort(self):
+        """Drop the connection without a closing handshake."""
+        if self._websocket.transport is not None:
+            self._websocket.transport.abort()
+
+    async def close(self):
+        await self._websocket.close()
+
+
+class HttpConnectionPool:
+    """Idle keep-alive HTTP connections to devices, shared by sessions.
+
+    At most size idle connections are kept per device (0 to open a new
+    connection for every request).
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self.connections_opened = 0
+        self.requests = 0
+        self._idle = {}
+
+    async def async_request(self, host, port, path, body):
+        """POST a JSON body to a device, returning the decoded response.
+
+        A pooled connection may have been closed by the device since it
+        was last used, in which case the request is sent again on the next
+        one, or on a new connection. That is only done if none of the
+        response arrived, as otherwise the device may have acted on it
+        already; any other failure is final.
+        """
+        payload = dumps(body).encode('utf-8')
+        idle = self._idle.get((host, port))
+
+        while idle:
+            reader, writer = idle.pop()
+            try:
+                return await self._async_request(host, port, reader, writer,
+                                                 path, payload)
+            except _StaleConnection:
+                continue
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+        enable_tcp_keepalive(writer.get_extra_info('socket'))
+        self.connections_opened += 1
+        try:
+            return await self._async_request(host, port, reader, writer,
+                                             path, payload)
+        except _StaleConnection as ex:
+            raise TransportClosed('%s:%d closed the connection' %
+                                  (host, port)) from ex
+
+    async def _async_request(self, host, port, reader, writer, path,
+                             payload):
+        """Send a request over a connection and read the device's response.
+
+        The connection is closed on any failure, or kept for reuse.
+        """
+        self.requests += 1
+        try:
+            writer.write(
+                b'POST %s HTTP/1.1\r\nHost: %s:%d\r\n'
+                b'Content-Type: application/json\r\nContent-Length: %d\r\n'
+                b'Connection: keep-alive\r\n\r\n%s' % (
+                    path.encode('ascii'), host.encode('ascii'), port,
+                    len(payload), payload))
+
+            status, headers, body = await asyncio.wait_for(
+                self._async_read_response(reader), HTTP_TIMEOUT)
+        except _StaleConnection:
+            writer.close()
+            raise
+        # Before OSError, which TimeoutError is a subclass of on Python 3.11
+        except asyncio.TimeoutError as ex:
+            writer.close()
+            raise TransportClosed('%s:%d did not answer %s within %ds' %
+                                  (host, port, path, HTTP_TIMEOUT)) from ex
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            writer.close()
+            raise TransportClosed('%s:%d closed the connection during the '
+                                  'response to %s' % (host, port, path)) \
+                from ex
+        except (ValueError, IndexError, asyncio.LimitOverrunError) as ex:
+            # A status line or headers which can't be parsed
+            writer.close()
+            raise HttpError('%s:%d sent a malformed response to %s: %r' %
+                            (host, port, path, ex)) from ex
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get(b'connection', b'').lower() == b'close' or \
+                len(self._idle.get((host, port), ())) >= self.size:
+            writer.close()
+        else:
+            self._idle.setdefault((host, port), []).append((reader, writer))
+
+        if status != 200:
+            raise HttpError('%s:%d answered %s with HTTP %d' %
+                            (host, port, path, status))
+        try:
+            return decode(body)
+        except ValueError as ex:
+            raise HttpError('%s:%d answered %s with a body which is not '
+                            'JSON: %s' % (host, port, path, ex)) from ex
+
+    @staticmethod
+    async def _async_read_response(reader):
+        try:
+            status_line = await reader.readuntil(b'\r\n')
+        except asyncio.IncompleteReadError as ex:
+            if ex.partial:
+                raise
+            raise _StaleConnection() from ex
+        except ConnectionResetError as ex:
+            raise _StaleConnection() from ex
+        status = int(status_line.split(None, 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(
+            int(headers.get(b'content-length', 0)))
+        return status, headers, body
+
+    def discard(self, host, port):
+        """Close the idle connections to a device, e.g. once it's gone."""
+        for _, writer in self._idle.pop((host, port), ()):
+            writer.close()
+
+    def close(self):
+        for host, port in list(self._idle):
+            self.discard(host, port)
+
+
+class HttpTransport:
+    """The LAN HTTP API of DIY mode and v3 firmware, translated to frames.
+
+    The device's reply to a command is reported as the acknowledgement
+    and the update a WebSocket device would have sent, and state pushed
+    over mDNS (see push) as an update.
+
+    With a cipher, request data is sent encrypted and encrypted response
+    data decrypted.
+    """
+
+    name = TRANSPORT_HTTP
+
+    def __init__(self, host, port, pool, deviceid=None, cipher=None):
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.deviceid = deviceid
+        self.cipher = cipher
+        self._frames = asyncio.Queue()
+        self._closed = False
+        self._params = None
+
+    async def connect(self):
+        """Fetch the device's state, which doubles as a reachability check.
+
+        The state is reported as the update a WebSocket device sends after
+        the handshake, so the handshake itself needn't go anywhere.
+        """
+        await self._async_info(force=True)
+
+    async def send(self, message):
+        if self._closed:
+            raise TransportClosed('Transport to %s:%d is closed' %
+                                  (self.host, self.port))
+
+        frame = decode(message)
+        if frame.get('action') == 'userOnline':
+            return
+
+        params = frame.get('params', {})
+        response = {}
+        if 'switch' in params:
+            response = await self._async_request(
+                'switch', {'switch': params['switch']})
+        if 'switches' in params:
+            response = await self._async_request(
+                'switches', {'switches': params['switches']})
+
+        self._put({'error': response.get('error', 0),
+                   'sequence': frame.get('sequence')})
+        if response.get('error', 0) == 0:
+            self._update(params)
+
+    async def recv(self):
+        frame = await self._frames.get()
+        if frame is None:
+            raise TransportClosed('Transport to %s:%d is closed' %
+                                  (self.host, self.port))
+        return frame
+
+    async def ping(self):
+        """Ask for the device's info, returning a task resolving on reply."""
+        return asyncio.ensure_future(self._async_info())
+
+    def push(self, params):
+        """Pass on state the device announced over mDNS."""
+        self._update(params)
+
+    def abort(self):
+        self.pool.discard(self.host, self.port)
+        self._close()
+
+    async def close(self):
+        self._close()
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._frames.put_nowait(None)
+
+    async def _async_info(self, force=False):
+        response = await self._async_request('info', {})
+        if response.get('error', 0) != 0:
+            # e.g. an encrypted device given the wrong key, or none at all
+            raise HttpError('%s:%d answered /zeroconf/info with error %s' %
+                            (self.host, self.port, response['error']))
+        if self.deviceid is None and response.get('deviceid'):
+            self.deviceid = response['deviceid']
+
+        data = response.get('data') or {}
+        if isinstance(data, str):
+            # Some firmware sends the data object JSON encoded
+            try:
+                data = decode(data)
+            except ValueError as ex:
+                raise HttpError('%s:%d sent malformed /zeroconf/info data: '
+                                '%s' % (self.host, self.port, ex)) from ex
+        if not isinstance(data, dict):
+            raise HttpError('%s:%d sent /zeroconf/info data which is not a '
+                            'JSON object' % (self.host, self.port))
+        params = {key: value for key, value in data.items()
+                  if key in ('switch', 'switches')}
+        if params and (force or params != self._params):
+            self._update(params)
+
+    async def _async_request(self, endpoint, data):
+        body = {'deviceid': self.deviceid or '', 'data': data}
+        if self.cipher is not None:
+            iv, body['data'] = self.cipher.encrypt(data)
+            body.update({'encrypt': True, 'iv': iv, 'selfApikey': '123',
+                         'sequence': str(int(time.time() * 1000))})
+
+        try:
+            response = await self.pool.async_request(
+                self.host, self.port, '/zeroconf/%s' % endpoint, body)
+        except asyncio.TimeoutError as ex:
+            raise TransportClosed('%s:%d did not answer /zeroconf/%s' %
+                                  (self.host, self.port, endpoint)) from ex
+        if not isinstance(response, dict):
+            raise HttpError('%s:%d answered /zeroconf/%s with something '
+                            'other than a JSON object' %
+                            (self.host, self.port, endpoint))
+
+        if response.get('encrypt') and response.get('data'):
+            if self.cipher is None:
+                raise HttpError('%s:%d sent encrypted data, but no device '
+                                'key is configured' % (self.host, self.port))
+            try:
+                response['data'] = self.cipher.decrypt(
+                    response.get('iv', ''), response['data'])
+            except DecryptionError as ex:
+                raise HttpError('%s:%d sent data which could not be '
+                                'decrypted, check its device key: %s' %
+                                (self.host, self.port, ex)) from ex
+        return response
+
+    def _update(self, params):
+        self._params = params
+        frame = {'userAgent': 'device', 'apikey': 'apikey',
+                 'action': 'update', 'params': params}
+        if self.deviceid is not None:
+            frame['deviceid'] = self.deviceid
+        self._put(frame)
+
+    def _put(self, frame):
+        if not self._closed:
+            self._frames.put_nowait(dumps(frame))